@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Memory benchmark: cached course role strings vs. compact cached course IDs.
+
+Fills a memory cache with the course lookups of `users` users, each member of `courses` courses
+out of a catalog of `catalog` courses, as returned by the user courses webservice (json).
+Run with `PYTHONPATH=src python benchmarks/bench_course_roles_memory.py [users] [courses] [catalog]`.
+"""
+import gc
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+
+from tobiraauth.caching import MemoryCacheBackend
+from tobiraauth.common import compact_course_ids, get_course_roles
+
+
+def fill_cache(responses: dict, convert) -> MemoryCacheBackend:
+    cache = MemoryCacheBackend('user_course_roles', maxsize=None)
+    for username, body in responses.items():
+        cache.set_nowait(username, convert(json.loads(body)), 300)
+    return cache
+
+
+def measure(responses: dict, convert):
+    """Return the cache and the memory in bytes allocated by the cache entries."""
+    gc.collect()
+    tracemalloc.start()
+    cache = fill_cache(responses, convert)
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return cache, allocated
+
+
+def main(users: int = 10_000, courses: int = 100, catalog: int = 5_000):
+    rng = random.Random(42)
+    responses = {f'user{i}': json.dumps(rng.sample(range(100_000, 100_000 + catalog), courses))
+                 for i in range(users)}
+
+    role_strings, role_strings_bytes = measure(responses, get_course_roles)
+    course_ids, course_ids_bytes = measure(responses, compact_course_ids)
+    assert get_course_roles(course_ids.get_nowait('user0').value) == role_strings.get_nowait('user0').value
+
+    number = 2_000
+    cached_roles = role_strings.get_nowait('user0').value
+    cached_ids = course_ids.get_nowait('user0').value
+    copy_roles = min(timeit.repeat(lambda: list(cached_roles), number=number, repeat=5))
+    render_roles = min(timeit.repeat(lambda: get_course_roles(cached_ids), number=number, repeat=5))
+
+    print(f'{users} users, {courses} courses per user, {catalog} courses')
+    print(f'cached role strings:       {role_strings_bytes / 2 ** 20:8.1f} MiB '
+          f'({role_strings_bytes / users:8.0f} bytes/user)')
+    print(f'cached compact course IDs: {course_ids_bytes / 2 ** 20:8.1f} MiB '
+          f'({course_ids_bytes / users:8.0f} bytes/user)')
+    print(f'saving:                    {(role_strings_bytes - course_ids_bytes) / 2 ** 20:8.1f} MiB '
+          f'({(1 - course_ids_bytes / role_strings_bytes) * 100:.0f}%)')
+    print(f'roles from cached strings: {copy_roles / number * 1e6:8.3f} us/request')
+    print(f'roles rendered from IDs:   {render_roles / number * 1e6:8.3f} us/request')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Micro-benchmark: per-request config resolution vs. the precompiled request profile.
+
+Run with `PYTHONPATH=src python benchmarks/bench_request_profile.py`.
+"""
+import timeit
+
+from sanic import Sanic
+
+from tobiraauth.config import ConfigConstants
+from tobiraauth.profile import compile_request_profile
+from tobiraauth.utils import get_config
+
+HEADERS = {
+    ConfigConstants.USERNAME_HEADER: 'jane@edu.org',
+    ConfigConstants.GIVEN_NAME_HEADER: 'Jane',
+    ConfigConstants.SURNAME_HEADER: 'Doe',
+    ConfigConstants.EMAIL_HEADER: 'jane@edu.org',
+    ConfigConstants.HOME_ORGANIZATION_HEADER: 'edu.org',
+}
+
+
+def resolve_per_request(app: Sanic, headers: dict):
+    """The header and custom role handling as done before the request profile was introduced."""
+    username = headers.get(get_config(app, 'username_header', ConfigConstants.USERNAME_HEADER), None)
+    display_name = headers.get(get_config(app, 'display_name_header', ConfigConstants.DISPLAY_NAME_HEADER), None)
+    email = headers.get(get_config(app, 'email_header', ConfigConstants.EMAIL_HEADER), None)
+    home_organization = headers.get(
+        get_config(app, 'home_organization', ConfigConstants.HOME_ORGANIZATION_HEADER), None)
+    if display_name is None:
+        given_name = headers.get(get_config(app, 'given_name_header', ConfigConstants.GIVEN_NAME_HEADER), None)
+        surname = headers.get(get_config(app, 'surname_header', ConfigConstants.SURNAME_HEADER), None)
+        if given_name is not None and surname is not None:
+            display_name = get_config(app, 'display_name_format', '{given_name} {surname}').format(
+                given_name=given_name, surname=surname)
+    roles = []
+    custom_roles = get_config(app, 'custom_roles', None)
+    if custom_roles is not None:
+        for role in custom_roles.split(','):
+            role = role.strip()
+            if role.strip() != '':
+                if '{' in role:
+                    roles.append(role.format(username=username, email=email, home_organization=home_organization))
+                else:
+                    roles.append(role)
+    headers.get(get_config(app, 'affiliation_header', ConfigConstants.AFFILIATION_HEADER), None)
+    return username, display_name, email, roles
+
+
+def resolve_with_profile(app: Sanic, headers: dict):
+    """The header and custom role handling using the precompiled request profile."""
+    profile = app.ctx.request_profile
+    username = headers.get(profile.username_header, None)
+    display_name = headers.get(profile.display_name_header, None)
+    email = headers.get(profile.email_header, None)
+    home_organization = headers.get(profile.home_organization_header, None)
+    if display_name is None:
+        given_name = headers.get(profile.given_name_header, None)
+        surname = headers.get(profile.surname_header, None)
+        if given_name is not None and surname is not None:
+            display_name = profile.format_display_name(given_name=given_name, surname=surname)
+    roles = list(profile.static_roles)
+    for format_role in profile.templated_roles:
+        roles.append(format_role(username=username, email=email, home_organization=home_organization))
+    headers.get(profile.affiliation_header, None)
+    return username, display_name, email, roles
+
+
+def main(number: int = 200_000):
+    app = Sanic('bench-request-profile')
+    app.config.CUSTOM_ROLES = ('ROLE_CUSTOM_USERNAME_{username}, ROLE_CUSTOM_EMAIL_{email}, '
+                               'ROLE_CUSTOM_HOME_ORG_{home_organization}, ROLE_CUSTOM_A, ROLE_CUSTOM_B')
+    app.ctx.request_profile = compile_request_profile(app)
+    *legacy_user, legacy_roles = resolve_per_request(app, HEADERS)
+    *profile_user, profile_roles = resolve_with_profile(app, HEADERS)
+    assert legacy_user == profile_user and set(legacy_roles) == set(profile_roles)
+
+    per_request = min(timeit.repeat(lambda: resolve_per_request(app, HEADERS), number=number, repeat=5))
+    with_profile = min(timeit.repeat(lambda: resolve_with_profile(app, HEADERS), number=number, repeat=5))
+    print(f'per-request config resolution: {per_request / number * 1e6:8.3f} us/request')
+    print(f'precompiled request profile:   {with_profile / number * 1e6:8.3f} us/request')
+    print(f'saving:                        {(per_request - with_profile) / number * 1e6:8.3f} us/request '
+          f'({(1 - with_profile / per_request) * 100:.0f}%)')
+
+
+if __name__ == '__main__':
+    main()
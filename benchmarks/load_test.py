@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Load test of the auth and login callbacks using the dummy user service as upstream.
+
+The dummy user service runs in a separate service instance on TCP. For each worker count
+and transport, the service is started with `sanic tobiraauth.server:create_app`, listening
+on TCP (`tcp`) or on a Unix domain socket (`uds`, `TOBIRA_AUTH_UNIX_SOCKET`). Each scenario
+runs twice: first with a cold cache right after startup, then with a warm cache. Throughput
+and latency percentiles are printed and stored as json, so results of different releases
+and transports can be compared.
+
+Run from the project root, e.g.
+`PYTHONPATH=src python benchmarks/load_test.py --workers 1 2 4 --requests 5000 --output results.json`
+or, comparing the transports, `... --transports tcp uds --concurrency 1`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from httpx import AsyncClient, AsyncHTTPTransport, Limits
+
+from tobiraauth.config import ConfigConstants
+
+PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_process(port: int, workers: int, env: dict) -> subprocess.Popen:
+    """Start a service instance in its own process group, see `stop_process`."""
+    env = {**os.environ, 'PYTHONPATH': os.path.join(PROJECT_PATH, 'src'), **env}
+    command = [sys.executable, '-m', 'sanic', 'tobiraauth.server:create_app', '--factory',
+               '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+               '--no-motd', '--no-access-logs']
+    return subprocess.Popen(command, env=env, cwd=PROJECT_PATH, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_process(process: subprocess.Popen):
+    """Stop the main process and the worker processes of a service instance."""
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def start_upstream(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    """Start the dummy user service used as upstream of the tested service."""
+    return start_process(port, 1, {
+        'TOBIRA_AUTH_ENABLE_DUMMY_USER_SERVICE': 'true',
+        'TOBIRA_AUTH_DUMMY_USER_SERVICE_LATENCY': str(args.upstream_latency),
+        'TOBIRA_AUTH_DUMMY_USER_SERVICE_ERROR_RATE': str(args.upstream_error_rate),
+    })
+
+
+def start_server(port: int, workers: int, upstream_url: str, unix_socket: str = None,
+                 extra_env: dict = None) -> subprocess.Popen:
+    """Start the service with the dummy user service at `upstream_url` as upstream.
+    If `unix_socket` is set, the service listens on this Unix domain socket instead of the port."""
+    env = {
+        'TOBIRA_AUTH_ENABLE_AUTH_CALLBACK': 'true',
+        'TOBIRA_AUTH_ENABLE_LOGIN_CALLBACK': 'true',
+        'TOBIRA_AUTH_USER_COURSES_WS_URL': f'{upstream_url}/user/{{username}}/courses',
+        'TOBIRA_AUTH_USER_LOGIN_WS_URL': f'{upstream_url}/user/login/{{username}}',
+    }
+    if unix_socket:
+        env['TOBIRA_AUTH_UNIX_SOCKET'] = unix_socket
+    env.update(extra_env or {})
+    return start_process(port, workers, env)
+
+
+def create_client(concurrency: int, unix_socket: str = None) -> AsyncClient:
+    """Return a client with up to `concurrency` keep-alive connections, using the Unix domain socket if set."""
+    limits = Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return AsyncClient(transport=AsyncHTTPTransport(uds=unix_socket, limits=limits), timeout=30.0)
+
+
+async def wait_until_ready(base_url: str, timeout: float = 30.0, unix_socket: str = None):
+    deadline = time.monotonic() + timeout
+    async with create_client(1, unix_socket) as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(f'{base_url}/', timeout=1.0)
+                if response.status_code == 200:
+                    return
+            except Exception:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f'Service at {base_url} did not start within {timeout} seconds.')
+
+
+def user_population(size: int, skew: float, count: int, seed: int) -> List[str]:
+    """Draw `count` usernames from a population with Zipf-like popularity (skew 0 means uniform)."""
+    rng = random.Random(seed)
+    weights = [1.0 / (rank ** skew) for rank in range(1, size + 1)]
+    return [f'bench-{index}' for index in rng.choices(range(size), weights=weights, k=count)]
+
+
+async def run_requests(base_url: str, endpoint: str, usernames: List[str], concurrency: int,
+                       unix_socket: str = None) -> dict:
+    """Send one request per username with bounded concurrency and measure the latencies."""
+    latencies = []
+    errors = 0
+    queue = iter(usernames)
+
+    async def worker(client: AsyncClient):
+        nonlocal errors
+        for username in queue:
+            start = time.perf_counter()
+            try:
+                if endpoint == 'auth':
+                    response = await client.get(f'{base_url}/auth/',
+                                                headers={ConfigConstants.USERNAME_HEADER: username})
+                else:
+                    response = await client.post(f'{base_url}/login/',
+                                                 json={'userid': username, 'password': 'opencast'})
+                if response.status_code != 200 or response.json().get('outcome') != 'user':
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async with create_client(concurrency, unix_socket) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+    return summarize(latencies, errors, duration)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies: List[float], errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'duration_s': round(duration, 4),
+        'throughput_rps': round(len(latencies) / duration, 2) if duration > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+async def run_scenarios(workers: int, transport: str, upstream_url: str, args: argparse.Namespace) -> List[dict]:
+    """Run cold and warm cache scenarios for all endpoints against a freshly started service."""
+    results = []
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory() as socket_dir:
+        unix_socket = os.path.join(socket_dir, 'tobira-auth.sock') if transport == 'uds' else None
+        process = start_server(port, workers, upstream_url, unix_socket)
+        try:
+            await wait_until_ready(base_url, unix_socket=unix_socket)
+            for endpoint in args.endpoints:
+                usernames = user_population(args.users, args.skew, args.requests, args.seed)
+                for cache_state in ('cold', 'warm'):
+                    result = await run_requests(base_url, endpoint, usernames, args.concurrency, unix_socket)
+                    result.update({'endpoint': f'/{endpoint}/', 'workers': workers, 'transport': transport,
+                                   'cache': cache_state})
+                    results.append(result)
+                    print(f'{result["endpoint"]:8} workers={workers:<3} {transport:3} cache={cache_state:5} '
+                          f'{result["throughput_rps"]:10.1f} req/s  p50={result["p50_ms"]:8.2f} ms  '
+                          f'p95={result["p95_ms"]:8.2f} ms  p99={result["p99_ms"]:8.2f} ms  '
+                          f'errors={result["errors"]}')
+        finally:
+            stop_process(process)
+    return results
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2], help='Sanic worker counts to test')
+    parser.add_argument('--endpoints', nargs='+', choices=['auth', 'login'], default=['auth', 'login'])
+    parser.add_argument('--transports', nargs='+', choices=['tcp', 'uds'], default=['tcp'],
+                        help='Listen on TCP or on a Unix domain socket')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent client connections')
+    parser.add_argument('--users', type=int, default=500, help='Size of the user population')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf skew of the user popularity, 0 for uniform access')
+    parser.add_argument('--upstream-latency', type=float, default=0.02,
+                        help='Latency in seconds injected into the dummy user service')
+    parser.add_argument('--upstream-error-rate', type=float, default=0.0,
+                        help='Error rate (0..1) injected into the dummy user service')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='benchmark-results.json', help='Json file to store the results in')
+    return parser.parse_args(argv)
+
+
+async def main(argv: List[str] = None):
+    args = parse_args(argv)
+    results = []
+    upstream_port = free_port()
+    upstream_url = f'http://127.0.0.1:{upstream_port}'
+    upstream = start_upstream(upstream_port, args)
+    try:
+        await wait_until_ready(upstream_url)
+        for workers in args.workers:
+            for transport in args.transports:
+                results += await run_scenarios(workers, transport, upstream_url, args)
+    finally:
+        stop_process(upstream)
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -17,6 +17,8 @@ VENV_PATH="${PROJECT_PATH}/venv"
 set -a
 . "$ENV_FILE"
 set +a
+# create the directory of the unix domain socket, if configured
+[ -n "${TOBIRA_AUTH_UNIX_SOCKET}" ] && mkdir -p "$(dirname "${TOBIRA_AUTH_UNIX_SOCKET}")"
 # activate python environment
 [ -n ${VENV_PATH} ] && . "${VENV_PATH}/bin/activate"
 # run app
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import time
+from typing import List, Tuple
+
+from sanic import Blueprint, Request, Sanic
+from sanic.log import logger
+from sanic.response import HTTPResponse, json as json_response
+
+from tobiraauth.utils import get_config, get_private_dir, is_authorized
+
+admin_bp = Blueprint('admin', url_prefix='/admin')
+
+
+def get_invalidation_dir(app: Sanic) -> str:
+    """Return the invalidation directory shared by the workers, `CACHE_INVALIDATION_DIR` or
+    `invalidations` in the runtime directory, see `get_private_dir`.
+
+    :raises PermissionError: if the directory is owned by another user or writable by others
+    """
+    return get_private_dir(app, 'CACHE_INVALIDATION_DIR', 'invalidations')
+
+
+def get_applied_invalidations(app: Sanic) -> set:
+    """Return the names of the invalidation files applied by this worker.
+    Invalidations published before the worker started are treated as applied."""
+    applied = getattr(app.ctx, 'applied_invalidations', None)
+    if applied is None:
+        applied = app.ctx.applied_invalidations = {
+            filename for filename in os.listdir(get_invalidation_dir(app)) if filename.endswith('.json')
+        }
+    return applied
+
+
+def publish_invalidation(app: Sanic, event: dict) -> str:
+    """Write the invalidation into the invalidation directory shared by all workers.
+
+    :param app: Sanic app instance
+    :param event: `{"usernames": [...]}` or `{"clear": true}`
+    :return: The file name of the invalidation
+    """
+    applied = get_applied_invalidations(app)
+    filename = f'{time.time_ns():020d}-{os.getpid()}.json'
+    path = os.path.join(get_invalidation_dir(app), filename)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(event, f)
+    os.replace(f'{path}.tmp', path)
+    applied.add(filename)
+    return filename
+
+
+def read_invalidations(app: Sanic) -> List[Tuple[str, dict]]:
+    """Return the invalidations not applied by this worker yet, oldest first.
+    Invalidation files older than the retention time are removed."""
+    applied = get_applied_invalidations(app)
+    invalidation_dir = get_invalidation_dir(app)
+    interval = float(get_config(app, 'CACHE_INVALIDATION_INTERVAL', 1.0))
+    expired = time.time_ns() - int(max(60.0, 10 * interval) * 1e9)
+    filenames = sorted(filename for filename in os.listdir(invalidation_dir) if filename.endswith('.json'))
+    invalidations = []
+    for filename in filenames:
+        path = os.path.join(invalidation_dir, filename)
+        timestamp = filename.split('-', 1)[0]
+        if not timestamp.isdigit():
+            continue
+        if int(timestamp) < expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        if filename in applied:
+            continue
+        try:
+            with open(path) as f:
+                invalidations.append((filename, json.load(f)))
+        except (OSError, ValueError):
+            continue
+    applied.intersection_update(filenames)
+    return invalidations
+
+
+async def apply_invalidation(app: Sanic, event: dict) -> int:
+    """Invalidate the entries of the users or clear all caches of this worker.
+
+    :param app: Sanic app instance
+    :param event: `{"usernames": [...]}` or `{"clear": true}`
+    :return: Number of invalidated entries, 0 if the caches have been cleared
+    """
+    caches = list((getattr(app.ctx, 'caches', None) or {}).values())
+    if event.get('clear'):
+        for cache in caches:
+            await cache.clear()
+        return 0
+    usernames = event.get('usernames') or ()
+    invalidated = 0
+    for cache in caches:
+        invalidated += await cache.invalidate(usernames)
+    return invalidated
+
+
+async def apply_pending_invalidations(app: Sanic):
+    """Apply the invalidations published by other workers."""
+    applied = get_applied_invalidations(app)
+    for filename, event in read_invalidations(app):
+        await apply_invalidation(app, event)
+        applied.add(filename)
+
+
+def get_usernames(payload) -> List[str]:
+    if not isinstance(payload, dict):
+        return []
+    usernames = payload.get('usernames', [payload.get('username')])
+    if not isinstance(usernames, list) or not all(isinstance(username, str) and username for username in usernames):
+        return []
+    return usernames
+
+
+@admin_bp.get('/caches')
+async def cache_stats(request: Request) -> HTTPResponse:
+    """Cache statistics endpoint
+
+    Returns size, hit rate and age distribution of the caches of the worker handling the request,
+    e.g. `user_course_roles`, `credentials` and `login_payloads`. Requires the
+    `Authorization: Bearer <ADMIN_TOKEN>` header.
+    """
+    if not is_authorized(request, 'ADMIN_TOKEN'):
+        return json_response({'error': 'Unauthorized.'}, status=401)
+    caches = getattr(request.app.ctx, 'caches', None) or {}
+    return json_response({
+        'pid': os.getpid(),
+        'caches': {name: await cache.stats() for name, cache in sorted(caches.items())},
+    })
+
+
+@admin_bp.post('/caches/invalidate')
+async def invalidate_users(request: Request) -> HTTPResponse:
+    """Cache invalidation endpoint
+
+    Deletes all cached entries of the users in the json body, `{"username": "..."}` or
+    `{"usernames": ["...", ...]}`, e.g. after a course membership change.
+    The invalidation is applied by all workers within `CACHE_INVALIDATION_INTERVAL` seconds.
+    Requires the `Authorization: Bearer <ADMIN_TOKEN>` header.
+    """
+    if not is_authorized(request, 'ADMIN_TOKEN'):
+        return json_response({'error': 'Unauthorized.'}, status=401)
+    try:
+        usernames = get_usernames(request.json)
+    except Exception:
+        usernames = []
+    if not usernames:
+        return json_response({'error': 'Expected json object with username or usernames.'}, status=400)
+    event = {'usernames': usernames}
+    publish_invalidation(request.app, event)
+    invalidated = await apply_invalidation(request.app, event)
+    logger.info('Invalidated cached entries of %s users.', len(usernames))
+    return json_response({'usernames': usernames, 'invalidated': invalidated})
+
+
+@admin_bp.post('/caches/clear')
+async def clear_caches(request: Request) -> HTTPResponse:
+    """Cache clear endpoint
+
+    Clears all caches of all workers. Requires the `Authorization: Bearer <ADMIN_TOKEN>` header.
+    """
+    if not is_authorized(request, 'ADMIN_TOKEN'):
+        return json_response({'error': 'Unauthorized.'}, status=401)
+    event = {'clear': True}
+    publish_invalidation(request.app, event)
+    await apply_invalidation(request.app, event)
+    logger.info('Cleared all caches.')
+    return json_response({'cleared': True})
+
+
+async def poll_invalidations(app: Sanic):
+    interval = float(get_config(app, 'CACHE_INVALIDATION_INTERVAL', 1.0))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await apply_pending_invalidations(app)
+        except OSError as e:
+            logger.warning('Unable to read cache invalidations. %s', e)
+
+
+@admin_bp.after_server_start
+async def start_invalidation_poll(app: Sanic):
+    get_applied_invalidations(app)
+    app.add_task(poll_invalidations, name='tobira_auth_poll_invalidations')
+
+
+@admin_bp.before_server_stop
+async def stop_invalidation_poll(app: Sanic):
+    await app.cancel_task('tobira_auth_poll_invalidations', raise_exception=False)
@@ -1,19 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import time
+from collections import deque
+from json import loads
+from typing import List, Optional
 
-from sanic import Blueprint, Request
+from sanic import Blueprint, Request, Sanic
 from sanic.log import logger
-from sanic.response import json, JSONResponse
-from tobiraauth.common import get_user_roles, get_user_role
+from sanic.response import HTTPResponse, json
+from tobiraauth.caching import MISSING, MemoryCacheBackend, create_memory_cache_backend, get_cache_backend, \
+    has_negative_result, limit_time_to_live, mark_negative_result
+from tobiraauth.common import USER_COURSE_ROLES_NEGATIVE_TIME_TO_LIVE, USER_COURSE_ROLES_TIME_TO_LIVE, \
+    get_user_roles, get_user_role, register_callback_middleware
 
-from tobiraauth.config import ConfigConstants
+from tobiraauth.encoding import NO_USER, json_bytes
+from tobiraauth.metrics import observe_stage
+from tobiraauth.profile import RequestProfile, get_request_profile
 from tobiraauth.utils import get_config
 
 auth_callback_bp = Blueprint('auth_callback', url_prefix='/auth')
+register_callback_middleware(auth_callback_bp)
+
+auth_batch_bp = Blueprint('auth_batch', url_prefix='/auth/batch')
+register_callback_middleware(auth_batch_bp)
 
 
 @auth_callback_bp.get('/')
-async def auth_callback(request: Request) -> JSONResponse:
+async def auth_callback(request: Request) -> HTTPResponse:
     """Tobira-Auth auth callback endpoint
 
     Allways returns a json with `outcome` filed. If its value is `no-user`, the username header is missing.
@@ -25,64 +39,197 @@ async def auth_callback(request: Request) -> JSONResponse:
     - `email`: The users email address
     - `roles`: List of user roles based on affiliation header and additional metadata like courses, the user belongs to.
 
+    If `AUTH_LATENCY_BUDGET` is set and the course roles are not available within the budget,
+    the user roles without course roles are returned, see `get_user_roles`.
+
+    If `AUTH_RESPONSE_CACHE` is enabled, the encoded response is cached by the identity header values,
+    see `get_response_cache`.
+
     :param request: The request.
     :return: Tobira-Auth callback json.
     """
-    username = request.headers.get(
-        get_config(request.app, 'username_header', ConfigConstants.USERNAME_HEADER),
-        None)
+    start = time.perf_counter()
+    profile = get_request_profile(request.app)
+    headers = request.headers
+    username = headers.get(profile.username_header, None)
 
     if username is None:
-        return json({'outcome': 'no-user'})
-
-    display_name = request.headers.get(
-        get_config(request.app, 'display_name_header', ConfigConstants.DISPLAY_NAME_HEADER),
-        None)
-    email = request.headers.get(
-        get_config(request.app, 'email_header', ConfigConstants.EMAIL_HEADER),
-        None)
-    home_organization = request.headers.get(
-        get_config(request.app, 'home_organization', ConfigConstants.HOME_ORGANIZATION_HEADER),
-        None)
-
-    if display_name is None:
-        given_name = request.headers.get(
-            get_config(request.app, 'given_name_header', ConfigConstants.GIVEN_NAME_HEADER),
-            None)
-        surname = request.headers.get(
-            get_config(request.app, 'surname_header', ConfigConstants.SURNAME_HEADER),
-            None)
-        if given_name is not None and surname is not None:
-            display_name_format = get_config(request.app, 'display_name_format', '{given_name} {surname}')
-            display_name = display_name_format.format(given_name=given_name, surname=surname)
+        return json_bytes(NO_USER)
+
+    display_name = headers.get(profile.display_name_header, None)
+    given_name = headers.get(profile.given_name_header, None)
+    surname = headers.get(profile.surname_header, None)
+    email = headers.get(profile.email_header, None)
+    home_organization = headers.get(profile.home_organization_header, None)
+    affiliations = headers.getall(profile.affiliation_header, [])
+    response_cache = get_response_cache(request.app)
+    if response_cache is not None:
+        cache_key = (username, display_name, given_name, surname, email, home_organization, tuple(affiliations))
+        entry = response_cache.get_nowait(cache_key)
+        if entry is not MISSING:
+            return json_bytes(entry.value)
+    if profile.latency_budget > 0:
+        request.ctx.deadline = start + profile.latency_budget
+    display_name = get_display_name(profile, display_name, given_name, surname)
+    observe_stage(request.app, 'header_parsing', start)
+    result = await get_user_result(request, username, display_name, email=email,
+                                   home_organization=home_organization, affiliations=affiliations)
+    body = profile.json_dumps(result)
+    # Responses without the course roles still being looked up in the background are not cached,
+    # the next request gets the course roles from the filled course cache.
+    if response_cache is not None and not getattr(request.ctx, 'latency_budget_exceeded', False):
+        # Do not keep responses built from fallback results longer than the fallback results themselves.
+        if has_negative_result(request):
+            response_cache.set_nowait(cache_key, body, USER_COURSE_ROLES_NEGATIVE_TIME_TO_LIVE, negative=True)
+        else:
+            time_to_live = get_response_time_to_live(request, response_cache)
+            if time_to_live is None or time_to_live > 0:
+                response_cache.set_nowait(cache_key, body, time_to_live)
+    return json_bytes(body)
+
+
+def get_response_time_to_live(request: Request, response_cache: MemoryCacheBackend) -> Optional[float]:
+    """Return the time to live of the response, at most until the cached course roles it is built from
+    expire (0 or less if they are stale), see `limit_time_to_live`."""
+    return limit_time_to_live(request, response_cache.time_to_live)
+
+
+def get_response_cache(app: Sanic) -> Optional[MemoryCacheBackend]:
+    """Return the auth callback response cache, if `AUTH_RESPONSE_CACHE` is enabled.
+
+    The cache maps the identity header values of a request to the encoded response, so a repeated
+    request is answered with a single lookup. Responses expire with the cached course roles, the time to
+    live defaults to the one of the `user_course_roles` cache and a response is not cached longer than the
+    cached results it is built from, see `get_response_time_to_live`.
+    The cache is a memory cache registered as `auth_responses` cache of the app, see `get_cache_backend`.
+    It is configurable like the other caches, see `create_cache_backend`, its default size is
+    `AUTH_RESPONSE_CACHE_MAXSIZE`.
+
+    :param app: Sanic app instance
+    :return: response cache or None
+    """
+    response_cache = getattr(app.ctx, 'response_cache', None)
+    if response_cache is None:
+        response_cache = False
+        if get_config(app, 'AUTH_RESPONSE_CACHE', False):
+            course_ids = get_cache_backend(app, 'user_course_roles', time_to_live=USER_COURSE_ROLES_TIME_TO_LIVE)
+            response_cache = create_memory_cache_backend(
+                app, 'auth_responses', int(get_config(app, 'AUTH_RESPONSE_CACHE_MAXSIZE', 10000)),
+                time_to_live=course_ids.time_to_live)
+            caches = getattr(app.ctx, 'caches', None)
+            if caches is None:
+                caches = app.ctx.caches = {}
+            caches['auth_responses'] = response_cache
+        app.ctx.response_cache = response_cache
+    return response_cache or None
+
+
+@auth_batch_bp.post('/')
+async def auth_batch(request: Request):
+    """Tobira-Auth batch auth callback endpoint
+
+    Resolve many users in one request. The request body is a json list (or json lines) of user descriptors:
+
+    - `username`: The username (required)
+    - `displayName`, `givenName`, `surname`: The users name, see auth callback
+    - `email`: The users email address
+    - `affiliations`: List of user affiliations or affiliations concatenated by ';'
+    - `homeOrganization`: The users home organization
 
+    The response is streamed as json lines (NDJSON). Each line contains the auth callback json
+    of the user descriptor at the same position. Users are resolved with bounded concurrency
+    configured by `AUTH_BATCH_CONCURRENCY`.
+
+    :param request: The request.
+    """
+    try:
+        if request.content_type.startswith('application/x-ndjson'):
+            descriptors = [loads(line) for line in request.body.splitlines() if line.strip()]
+        else:
+            descriptors = request.json
+        if not isinstance(descriptors, list):
+            raise ValueError('Expected a list of user descriptors.')
+    except Exception as e:
+        logger.warning('auth_batch: Unable to read user descriptors from request. %s', e)
+        return json({'error': 'Expected a json list or json lines of user descriptors.'}, status=400)
+
+    concurrency = max(1, int(get_config(request.app, 'AUTH_BATCH_CONCURRENCY', 10)))
+    json_dumps = get_request_profile(request.app).json_dumps
+    response = await request.respond(content_type='application/x-ndjson')
+    pending = deque()
+    try:
+        for descriptor in descriptors:
+            pending.append(asyncio.ensure_future(get_user_result_from_descriptor(request, descriptor)))
+            if len(pending) >= concurrency:
+                await response.send(json_dumps(await pending.popleft()) + b'\n')
+        while pending:
+            await response.send(json_dumps(await pending.popleft()) + b'\n')
+    finally:
+        for task in pending:
+            task.cancel()
+    await response.eof()
+
+
+async def get_user_result_from_descriptor(request: Request, descriptor: dict) -> dict:
+    """Return the auth callback dict for a user descriptor of the batch endpoint."""
+    username = descriptor.get('username', None) if isinstance(descriptor, dict) else None
+    if not username or not isinstance(username, str):
+        return {'outcome': 'no-user'}
+    affiliations = descriptor.get('affiliations', None) or []
+    if isinstance(affiliations, str):
+        affiliations = [affiliations]
+    display_name = get_display_name(get_request_profile(request.app),
+                                    descriptor.get('displayName', None),
+                                    descriptor.get('givenName', None),
+                                    descriptor.get('surname', None))
+    return await get_user_result(request, username, display_name,
+                                 email=descriptor.get('email', None),
+                                 home_organization=descriptor.get('homeOrganization', None),
+                                 affiliations=affiliations)
+
+
+def get_display_name(profile: RequestProfile, display_name: Optional[str],
+                     given_name: Optional[str], surname: Optional[str]) -> Optional[str]:
+    """Return the display name or format it from given name and surname, if it is not set."""
+    if display_name is None and given_name is not None and surname is not None:
+        display_name = profile.format_display_name(given_name=given_name, surname=surname)
+    return display_name
+
+
+async def get_user_result(request: Request, username: str, display_name: Optional[str], email: Optional[str],
+                          home_organization: Optional[str], affiliations: List[str]) -> dict:
+    """Build the auth callback dict of the user including the user roles.
+
+    :param request: The request.
+    :param username: The username
+    :param display_name: The users full name
+    :param email: The users email address
+    :param home_organization: The users home organization
+    :param affiliations: The users affiliation values
+    :return: Tobira-Auth callback dict.
+    """
+    profile = get_request_profile(request.app)
     result = {
       'outcome': 'user',
       'username': username,
       'displayName': display_name,
       'email': email,
       'userRole': get_user_role(username),
-      'roles': []
+      'roles': list(profile.static_roles)
     }
 
-    custom_roles = get_config(request.app, 'custom_roles', None)
-    if custom_roles is not None:
-        for role in custom_roles.split(','):
-            role = role.strip()
-            if role.strip() != '':
-                if '{' in role:
-                    result.get('roles').append(role.format(
-                        username=username,
-                        email=email,
-                        home_organization=home_organization,
-                    ))
-                else:
-                    result.get('roles').append(role)
+    for format_role in profile.templated_roles:
+        result.get('roles').append(format_role(
+            username=username,
+            email=email,
+            home_organization=home_organization,
+        ))
     try:
-        user_roles = await get_user_roles(request, username, email)
+        user_roles = await get_user_roles(request, username, email, affiliations, home_organization)
         if len(result.get('roles')) > 0:
             user_roles.extend(result.get('roles'))
         result['roles'] = list({*user_roles})
     except:
-        logger.exception(f'Unable to get user roles for user {username}.')
-    return json(result)
+        logger.exception('Unable to get user roles for user %s.', username)
+        mark_negative_result(request)
+    return result
@@ -0,0 +1,911 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Collection, Hashable, List, NamedTuple, Optional, Tuple
+
+from sanic import Request, Sanic
+from sanic.log import logger
+
+from tobiraauth.utils import get_config, get_private_dir
+
+MISSING = object()
+
+# Upper bounds in seconds of the entry age buckets reported by `CacheBackend.stats`.
+AGE_BUCKETS = (60, 300, 900, 3600, 14400, 86400)
+
+EVICTION_POLICIES = ('lru', 'lfu')
+
+
+class CacheEntry(NamedTuple):
+    """A cached value. Stale values are expired but may still be served while they are refreshed.
+    Negative values have been cached because the cached function failed. `fresh_until` is the time
+    (`time.time()`) the value expires, None if it never expires."""
+    value: Any
+    stale: bool
+    negative: bool = False
+    fresh_until: Optional[float] = None
+
+
+def expiration_times(now: float, time_to_live: Optional[float],
+                     stale_time_to_live: Optional[float]) -> Tuple[Optional[float], Optional[float]]:
+    """Return the time until an entry is fresh and the time it expires (including the stale window)."""
+    if not time_to_live:
+        return None, None
+    fresh_until = now + time_to_live
+    return fresh_until, fresh_until + (stale_time_to_live or 0)
+
+
+def approximate_size(value: Any) -> int:
+    """Return the approximate memory in bytes of a cached value, including the items of lists, tuples and dicts."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(sys.getsizeof(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(key) + approximate_size(item) for key, item in value.items())
+    return size
+
+
+class FrequencySketch:
+    """Count-min sketch of the approximate access frequencies of cache keys, see `MemoryCacheBackend`.
+
+    Each of the 4 rows has 4 counters per cache entry (`capacity`). Counters saturate at 15
+    and all counters are halved every `10 * capacity` increments, so the frequencies follow
+    changes in popularity.
+    """
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+    def __init__(self, capacity: int):
+        self.width = 1 << max(6, (4 * capacity - 1).bit_length())
+        self.mask = self.width - 1
+        self.table = bytearray(self.width * len(self.SEEDS))
+        self.sample_size = 10 * capacity
+        self.additions = 0
+
+    def indexes(self, key: Hashable) -> List[int]:
+        key_hash = hash(key)
+        return [row * self.width + ((((key_hash ^ seed) * seed) >> 32) & self.mask)
+                for row, seed in enumerate(self.SEEDS)]
+
+    def frequency(self, key: Hashable) -> int:
+        table = self.table
+        return min(table[index] for index in self.indexes(key))
+
+    def increment(self, key: Hashable):
+        table = self.table
+        indexes = self.indexes(key)
+        minimum = min(table[index] for index in indexes)
+        if minimum < 15:
+            # Conservative update, only the smallest counters are incremented.
+            for index in indexes:
+                if table[index] == minimum:
+                    table[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.table = bytearray(counter >> 1 for counter in table)
+            self.additions //= 2
+
+
+def key_username(key: Hashable) -> Hashable:
+    """Return the username of a cache key. Keys of user related caches start with the username,
+    see `default_cache_key`, tuple keys have the username as first element."""
+    if isinstance(key, tuple):
+        return key[0] if key else None
+    if isinstance(key, str):
+        return key.split('\x1f', 1)[0]
+    return key
+
+
+class CacheBackend:
+    """Storage of a named cache.
+
+    Backends store JSON serializable values or bytes with an expiration time and evict
+    the least recently used entries if the cache grows beyond `maxsize` entries.
+    `time_to_live` is the configured time to live of the values of the cache, see `create_cache_backend`.
+    """
+    policy = 'lru'
+
+    def __init__(self, name: str, maxsize: Optional[int] = 1024, time_to_live: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.time_to_live = time_to_live
+        self.max_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    @property
+    def size(self) -> Optional[int]:
+        """Number of entries, if available without querying the storage."""
+        return None
+
+    @property
+    def bytes(self) -> Optional[int]:
+        """Approximate memory of the entries, if tracked."""
+        return None
+
+    async def get(self, key: str) -> Any:
+        """Return the `CacheEntry` or `MISSING` if the key is not cached or expired."""
+        raise NotImplementedError()
+
+    async def set(self, key: str, value: Any, time_to_live: Optional[float], stale_time_to_live: float = 0,
+                  negative: bool = False):
+        """Store the value. A `time_to_live` of None means the value never expires.
+        After `time_to_live` the value is stale for another `stale_time_to_live` seconds."""
+        raise NotImplementedError()
+
+    async def delete(self, key: str):
+        raise NotImplementedError()
+
+    async def clear(self):
+        raise NotImplementedError()
+
+    async def invalidate(self, usernames: Collection[str]) -> int:
+        """Delete all entries of the users, see `key_username`.
+
+        :return: Number of deleted entries
+        """
+        raise NotImplementedError()
+
+    async def entry_ages(self, now: float) -> List[float]:
+        """Return the age in seconds of all entries not expired yet."""
+        raise NotImplementedError()
+
+    async def stats(self) -> dict:
+        """Return size, hit rate, age distribution and configuration of the cache.
+
+        The age distribution maps the upper bounds of `AGE_BUCKETS` to the number of entries
+        with an age in the bucket. Rejections are new entries not admitted by the `lfu` policy.
+        """
+        ages = await self.entry_ages(time.time())
+        buckets = [0] * (len(AGE_BUCKETS) + 1)
+        for age in ages:
+            buckets[bisect_left(AGE_BUCKETS, age)] += 1
+        lookups = self.hits + self.misses
+        return {
+            'size': len(ages),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'time_to_live': self.time_to_live,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'rejections': self.rejections,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'age_seconds': dict(zip([str(bucket) for bucket in AGE_BUCKETS] + ['+Inf'], buckets)),
+        }
+
+    def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Per process cache with time to live, limited to `maxsize` entries and `max_bytes` bytes.
+
+    With the `lru` policy, the least recently used entries are evicted. With the `lfu` policy,
+    the access frequencies of all keys are tracked (`FrequencySketch`). New entries are on probation
+    until their first hit. The victim is the least recently used entry on probation, or the least
+    recently used entry if none is on probation. A new entry is only admitted to a full cache if its
+    key is used more frequently than the key of the victim. Keys seen once, e.g. in a scan over all
+    users, do not displace frequently used entries.
+    """
+
+    def __init__(self, name: str, maxsize: Optional[int] = 1024, time_to_live: Optional[float] = None,
+                 max_bytes: Optional[int] = None, policy: str = 'lru'):
+        super().__init__(name, maxsize, time_to_live)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sketch = FrequencySketch(maxsize or 1024) if policy == 'lfu' else None
+        self._bytes = 0
+        # key -> (value, fresh_until, expires_at, negative, stored_at, size)
+        self._entries = OrderedDict()
+        # Keys of the entries on probation (lfu policy)
+        self._probation = OrderedDict()
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> Optional[int]:
+        return self._bytes if self.max_bytes else None
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[5]
+            self._probation.pop(key, None)
+
+    def _victim(self) -> Hashable:
+        return next(iter(self._probation or self._entries))
+
+    def _is_full(self, size: int) -> bool:
+        return bool((self.maxsize and len(self._entries) >= self.maxsize)
+                    or (self.max_bytes and self._bytes + size > self.max_bytes))
+
+    def get_nowait(self, key: Hashable) -> Any:
+        """Synchronous variant of `get`. Any hashable object may be used as key."""
+        if self.sketch is not None:
+            self.sketch.increment(key)
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        value, fresh_until, expires_at, negative, _, _ = entry
+        now = time.time()
+        if expires_at is not None and expires_at < now:
+            self._remove(key)
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        if self.sketch is not None:
+            self._probation.pop(key, None)
+        self.hits += 1
+        return CacheEntry(value, fresh_until is not None and fresh_until < now, negative, fresh_until)
+
+    def set_nowait(self, key: Hashable, value: Any, time_to_live: Optional[float], stale_time_to_live: float = 0,
+                   negative: bool = False):
+        """Synchronous variant of `set`. Any hashable object may be used as key."""
+        now = time.time()
+        fresh_until, expires_at = expiration_times(now, time_to_live, stale_time_to_live)
+        size = approximate_size(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            self._remove(key)
+            self.rejections += 1
+            return
+        probation = self.sketch is not None
+        if key in self._entries:
+            probation = key in self._probation
+            self._remove(key)
+        elif self.sketch is not None and self._entries and self._is_full(size):
+            if self.sketch.frequency(key) <= self.sketch.frequency(self._victim()):
+                self.rejections += 1
+                return
+        while self._entries and self._is_full(size):
+            self._remove(self._victim())
+            self.evictions += 1
+        self._entries[key] = (value, fresh_until, expires_at, negative, now, size)
+        self._bytes += size
+        if probation:
+            self._probation[key] = None
+
+    async def get(self, key: str) -> Any:
+        return self.get_nowait(key)
+
+    async def set(self, key: str, value: Any, time_to_live: Optional[float], stale_time_to_live: float = 0,
+                  negative: bool = False):
+        self.set_nowait(key, value, time_to_live, stale_time_to_live, negative)
+
+    async def delete(self, key: str):
+        self._remove(key)
+
+    async def clear(self):
+        self._entries.clear()
+        self._probation.clear()
+        self._bytes = 0
+
+    async def invalidate(self, usernames: Collection[str]) -> int:
+        usernames = set(usernames)
+        keys = [key for key in self._entries if key_username(key) in usernames]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    async def entry_ages(self, now: float) -> List[float]:
+        return [now - stored_at for _, _, expires_at, _, stored_at, _ in self._entries.values()
+                if expires_at is None or expires_at >= now]
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Cache stored in a SQLite database file in WAL mode.
+
+    All worker processes on a host using the same database file share the cached values.
+    The queries run in a thread of the backend, so waiting for the database lock does not block
+    the event loop. Access times of hits are written in batches, with the next `set` or after
+    `ACCESS_FLUSH_INTERVAL` seconds. The least recently used entries beyond `maxsize` are evicted
+    after a worker wrote 10% of `maxsize` entries, so the cache may temporarily hold more entries.
+    The database file must be owned by the service user and not be accessible by others, otherwise
+    other users could read cached personal data or plant cache entries, e.g. roles.
+    """
+    ACCESS_FLUSH_INTERVAL = 1.0
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(self, name: str, path: str, maxsize: Optional[int] = 1024, time_to_live: Optional[float] = None):
+        super().__init__(name, maxsize, time_to_live)
+        self.path = path
+        self.eviction_margin = (maxsize or 0) // 10
+        self._connection = None
+        self._executor = None
+        # key -> access time of hits not written yet
+        self._accessed = {}
+        self._accessed_flushed = time.monotonic()
+        # Entries written since the last eviction check
+        self._writes = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # The cache may contain personal data, do not make it readable for other users.
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            try:
+                stat = os.fstat(fd)
+            finally:
+                os.close(fd)
+            # The mode only applies to new files, another user may have created the file.
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                raise PermissionError(f'Cache database {self.path} must be owned by the service user '
+                                      f'and not be accessible by others.')
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'name TEXT NOT NULL, key TEXT NOT NULL, value NOT NULL, '
+                               'fresh_until REAL, expires_at REAL, accessed_at REAL NOT NULL, '
+                               'negative INTEGER NOT NULL DEFAULT 0, stored_at REAL, '
+                               'PRIMARY KEY (name, key))')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(cache)')]
+            # Database files created by older versions
+            for column, definition in (('negative', 'INTEGER NOT NULL DEFAULT 0'), ('stored_at', 'REAL')):
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE cache ADD COLUMN {column} {definition}')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (name, accessed_at)')
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Run the blocking database call in the thread of the backend."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'tobira-auth-cache-{self.name}')
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _take_accessed(self, force: bool = False) -> List[Tuple[float, str, str]]:
+        """Return the access times to write and reset them, if they are due or `force` is set."""
+        if not self._accessed or not (force or len(self._accessed) >= self.ACCESS_FLUSH_SIZE
+                                      or time.monotonic() - self._accessed_flushed >= self.ACCESS_FLUSH_INTERVAL):
+            return []
+        accessed = [(accessed_at, self.name, key) for key, accessed_at in self._accessed.items()]
+        self._accessed = {}
+        self._accessed_flushed = time.monotonic()
+        return accessed
+
+    def _write_access_times(self, accessed: List[Tuple[float, str, str]]):
+        if accessed:
+            self.connection.executemany('UPDATE cache SET accessed_at = MAX(accessed_at, ?) '
+                                        'WHERE name = ? AND key = ?', accessed)
+
+    def _get(self, key: str, now: float, accessed: List[Tuple[float, str, str]]) -> Optional[tuple]:
+        connection = self.connection
+        self._write_access_times(accessed)
+        row = connection.execute('SELECT value, fresh_until, expires_at, negative FROM cache '
+                                 'WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+        if row is None:
+            return None
+        value, fresh_until, expires_at, negative = row
+        if expires_at is not None and expires_at < now:
+            connection.execute('DELETE FROM cache WHERE name = ? AND key = ? AND expires_at < ?',
+                               (self.name, key, now))
+            return None
+        if not isinstance(value, bytes):
+            value = json.loads(value)
+        return value, fresh_until, bool(negative)
+
+    def _set(self, key: str, value: Any, fresh_until: Optional[float], expires_at: Optional[float], now: float,
+             negative: bool, accessed: List[Tuple[float, str, str]]):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._write_access_times(accessed)
+            connection.execute('INSERT OR REPLACE INTO cache '
+                               '(name, key, value, fresh_until, expires_at, accessed_at, negative, stored_at) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (self.name, key, value if isinstance(value, bytes) else json.dumps(value),
+                                fresh_until, expires_at, now, int(negative), now))
+            self._writes += 1
+            if self.maxsize and self._writes > self.eviction_margin:
+                self._writes = 0
+                count, = connection.execute('SELECT COUNT(*) FROM cache WHERE name = ?', (self.name,)).fetchone()
+                if count > self.maxsize:
+                    cursor = connection.execute('DELETE FROM cache WHERE name = ? AND key IN ('
+                                                'SELECT key FROM cache WHERE name = ? '
+                                                'ORDER BY accessed_at LIMIT ?)',
+                                                (self.name, self.name, count - self.maxsize))
+                    self.evictions += max(cursor.rowcount, 0)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _execute(self, sql: str, parameters: Any, many: bool = False) -> int:
+        if many:
+            cursor = self.connection.executemany(sql, parameters)
+        else:
+            cursor = self.connection.execute(sql, parameters)
+        return max(cursor.rowcount, 0)
+
+    def _entry_ages(self, now: float) -> List[float]:
+        rows = self.connection.execute('SELECT COALESCE(stored_at, accessed_at) FROM cache '
+                                       'WHERE name = ? AND (expires_at IS NULL OR expires_at >= ?)',
+                                       (self.name, now))
+        return [now - stored_at for stored_at, in rows]
+
+    async def get(self, key: str) -> Any:
+        now = time.time()
+        row = await self._run(self._get, key, now, self._take_accessed())
+        if row is None:
+            self.misses += 1
+            return MISSING
+        value, fresh_until, negative = row
+        self._accessed[key] = now
+        self.hits += 1
+        return CacheEntry(value, fresh_until is not None and fresh_until < now, negative, fresh_until)
+
+    async def set(self, key: str, value: Any, time_to_live: Optional[float], stale_time_to_live: float = 0,
+                  negative: bool = False):
+        now = time.time()
+        fresh_until, expires_at = expiration_times(now, time_to_live, stale_time_to_live)
+        self._accessed.pop(key, None)
+        await self._run(self._set, key, value, fresh_until, expires_at, now, negative, self._take_accessed(True))
+
+    async def delete(self, key: str):
+        self._accessed.pop(key, None)
+        await self._run(self._execute, 'DELETE FROM cache WHERE name = ? AND key = ?', (self.name, key))
+
+    async def clear(self):
+        self._accessed.clear()
+        await self._run(self._execute, 'DELETE FROM cache WHERE name = ?', (self.name,))
+
+    async def invalidate(self, usernames: Collection[str]) -> int:
+        # Keys of the user are the username or start with the username followed by \x1f.
+        return await self._run(self._execute,
+                               'DELETE FROM cache WHERE name = ? AND (key = ? OR (key > ? AND key < ?))',
+                               [(self.name, username, f'{username}\x1f', f'{username}\x20') for username in usernames],
+                               True)
+
+    async def entry_ages(self, now: float) -> List[float]:
+        return await self._run(self._entry_ages, now)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._connection is not None:
+            try:
+                self._write_access_times(self._take_accessed(True))
+            except sqlite3.Error as e:
+                logger.warning('Unable to write cache access times of %s. %s', self.name, e)
+            self._connection.close()
+            self._connection = None
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls with the same key.
+
+    The first caller (leader) starts the call, concurrent callers with the same key await
+    the result of the leader instead of starting their own call. The call runs as task,
+    so a cancelled caller does not cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def start(self, key: str, call: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """Start `call` as task, unless a call with the same key is already running.
+
+        :return: The running task
+        """
+        task = self._in_flight.get(key, None)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return task
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `call` once for all concurrent callers using the same key and return its result."""
+        return await asyncio.shield(self.start(key, call))
+
+
+class RefreshAheadScheduler:
+    """Track how often the keys of a cache are used to refresh frequently used entries before they expire.
+
+    Entries used at least `min_accesses` times since they have been (re)loaded become due for
+    a refresh `window` seconds before they expire. Other entries expire as usual. The arguments
+    of the cached function are kept per key, `refresh(key, *args)` reloads the entry of a key.
+    At most `maxsize` keys are tracked, the least recently used keys are dropped first.
+    """
+
+    def __init__(self, name: str, window: float = 30.0, min_accesses: int = 2, maxsize: Optional[int] = 1024):
+        self.name = name
+        self.window = window
+        self.min_accesses = min_accesses
+        self.maxsize = maxsize
+        self.refresh: Optional[Callable[..., Awaitable[Any]]] = None
+        # key -> [accesses, fresh_until, args]
+        self._keys = OrderedDict()
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def touch(self, key: str, args: tuple):
+        """Count an access of the key. `args` are the arguments to reload the entry of the key."""
+        item = self._keys.get(key, None)
+        if item is None:
+            item = self._keys[key] = [0, None, args]
+            if self.maxsize and len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+        item[0] += 1
+
+    def loaded(self, key: str, fresh_until: Optional[float]):
+        """Record that the entry of the key has been (re)loaded and is fresh until `fresh_until`."""
+        item = self._keys.get(key, None)
+        if item is not None:
+            item[0] = 0
+            item[1] = fresh_until
+
+    def due(self, now: float, limit: int) -> List[Tuple[str, tuple]]:
+        """Return up to `limit` keys due for a refresh with their arguments, the entries expiring first
+        come first. Keys not used frequently enough are dropped once their entry expired."""
+        candidates = []
+        for key, item in list(self._keys.items()):
+            accesses, fresh_until, _ = item
+            if fresh_until is None or fresh_until - now > self.window:
+                continue
+            if accesses >= self.min_accesses:
+                candidates.append((fresh_until, key))
+            elif fresh_until < now:
+                del self._keys[key]
+        due = []
+        for fresh_until, key in sorted(candidates)[:limit]:
+            item = self._keys[key]
+            # Not due again until the refresh loaded the entry.
+            item[1] = None
+            due.append((key, item[2]))
+        self.refreshes += len(due)
+        return due
+
+
+def get_cache_config(app: Sanic, name: str, env_name: str, default: Any = None) -> Any:
+    """Return the config value `CACHE_<NAME>_<ENV_NAME>` of the named cache, falling back
+    to `CACHE_<ENV_NAME>` of all caches and the default."""
+    value = get_config(app, f'CACHE_{name}_{env_name}', None)
+    if value is None:
+        value = get_config(app, f'CACHE_{env_name}', None)
+    return default if value is None else value
+
+
+def create_cache_backend(app: Sanic, name: str, maxsize: Optional[int],
+                         time_to_live: Optional[float] = None) -> CacheBackend:
+    """Create the cache backend configured by `CACHE_BACKEND`.
+
+    Size, time to live and eviction policy of the cache may be configured per cache, e.g.
+    `CACHE_USER_COURSE_ROLES_MAXSIZE`, or for all caches, e.g. `CACHE_MAXSIZE`, see `get_cache_config`.
+    The byte limit and the eviction policy apply to the memory backend only. The database file
+    of the sqlite backend is `CACHE_SQLITE_PATH` or `cache/cache.sqlite` in the runtime directory,
+    see `get_private_dir`.
+
+    :param app: Sanic app instance
+    :param name: The cache name
+    :param maxsize: Default maximum number of cache entries
+    :param time_to_live: Default time in seconds values are cached
+    :return: cache backend
+    :raises PermissionError: if the default cache directory is owned by another user or writable by others
+    """
+    backend = str(get_config(app, 'CACHE_BACKEND', 'memory')).lower()
+    if backend == 'sqlite':
+        path = get_config(app, 'CACHE_SQLITE_PATH', None) or \
+            os.path.join(get_private_dir(app, None, 'cache'), 'cache.sqlite')
+        return SQLiteCacheBackend(name, path, int(get_cache_config(app, name, 'MAXSIZE', maxsize or 0)) or None,
+                                  time_to_live=float(get_cache_config(app, name, 'TIME_TO_LIVE', time_to_live or 0)) or None)
+    if backend != 'memory':
+        logger.warning(f'Unknown cache backend {backend}. Falling back to memory cache backend.')
+    return create_memory_cache_backend(app, name, maxsize, time_to_live)
+
+
+def create_memory_cache_backend(app: Sanic, name: str, maxsize: Optional[int],
+                                time_to_live: Optional[float] = None) -> MemoryCacheBackend:
+    """Create a memory cache backend regardless of `CACHE_BACKEND`, configured like `create_cache_backend`.
+
+    :param app: Sanic app instance
+    :param name: The cache name
+    :param maxsize: Default maximum number of cache entries
+    :param time_to_live: Default time in seconds values are cached
+    :return: memory cache backend
+    """
+    maxsize = int(get_cache_config(app, name, 'MAXSIZE', maxsize or 0)) or None
+    time_to_live = float(get_cache_config(app, name, 'TIME_TO_LIVE', time_to_live or 0)) or None
+    policy = str(get_cache_config(app, name, 'POLICY', 'lru')).lower()
+    if policy not in EVICTION_POLICIES:
+        logger.warning(f'Unknown cache eviction policy {policy}. Falling back to lru.')
+        policy = 'lru'
+    max_bytes = int(get_cache_config(app, name, 'MAX_BYTES', 0)) or None
+    return MemoryCacheBackend(name, maxsize, time_to_live=time_to_live, max_bytes=max_bytes, policy=policy)
+
+
+def get_cache_backend(app: Sanic, name: str, maxsize: Optional[int] = 1024,
+                      time_to_live: Optional[float] = 300) -> CacheBackend:
+    """Return the named cache backend of the app, create it on first use.
+
+    :param app: Sanic app instance
+    :param name: The cache name
+    :param maxsize: Default maximum number of cache entries
+    :param time_to_live: Default time in seconds values are cached, see `CacheBackend.time_to_live`
+    :return: cache backend
+    """
+    caches = getattr(app.ctx, 'caches', None)
+    if caches is None:
+        caches = app.ctx.caches = {}
+    cache = caches.get(name, None)
+    if cache is None:
+        cache = caches[name] = create_cache_backend(app, name, maxsize, time_to_live)
+    return cache
+
+
+def get_single_flight(app: Sanic, name: str) -> SingleFlight:
+    """Return the single flight call deduplication of the named cache.
+
+    :param app: Sanic app instance
+    :param name: The cache name
+    :return: single flight instance
+    """
+    single_flights = getattr(app.ctx, 'single_flights', None)
+    if single_flights is None:
+        single_flights = app.ctx.single_flights = {}
+    single_flight = single_flights.get(name, None)
+    if single_flight is None:
+        single_flight = single_flights[name] = SingleFlight()
+    return single_flight
+
+
+def get_refresh_ahead(app: Sanic, name: str, maxsize: Optional[int] = 1024) -> Optional[RefreshAheadScheduler]:
+    """Return the refresh ahead scheduler of the named cache, if `REFRESH_AHEAD` is enabled.
+
+    :param app: Sanic app instance
+    :param name: The cache name
+    :param maxsize: Default maximum number of tracked keys, the size of the cache.
+        Configurable by `REFRESH_AHEAD_MAXSIZE`.
+    :return: refresh ahead scheduler or None
+    """
+    schedulers = getattr(app.ctx, 'refresh_ahead', None)
+    if schedulers is None:
+        schedulers = app.ctx.refresh_ahead = {}
+    scheduler = schedulers.get(name, MISSING)
+    if scheduler is MISSING:
+        scheduler = None
+        if get_config(app, 'REFRESH_AHEAD', False):
+            scheduler = RefreshAheadScheduler(
+                name,
+                window=float(get_config(app, 'REFRESH_AHEAD_WINDOW', 30.0)),
+                min_accesses=int(get_config(app, 'REFRESH_AHEAD_MIN_ACCESSES', 2)),
+                maxsize=int(get_config(app, 'REFRESH_AHEAD_MAXSIZE', maxsize or 0)) or None,
+            )
+        schedulers[name] = scheduler
+    return scheduler
+
+
+def refresh_flight_key(key: str) -> Tuple[str, str]:
+    """Return the `SingleFlight` key of background refreshes of the cache key. Refreshes return
+    no result, cache misses must not await them, so they do not share the key of the misses."""
+    return 'refresh', key
+
+
+async def refresh_entry(semaphore: asyncio.Semaphore, single_flight: SingleFlight, key: str,
+                        refresh: Callable[[], Awaitable[Any]]):
+    async with semaphore:
+        await single_flight.do(refresh_flight_key(key), refresh)
+
+
+async def run_refresh_ahead(app: Sanic):
+    """Refresh the due entries of all caches with refresh ahead, see `RefreshAheadScheduler`.
+
+    At most `REFRESH_AHEAD_RATE` refreshes per second are started and at most
+    `REFRESH_AHEAD_CONCURRENCY` refreshes run at the same time.
+    """
+    interval = float(get_config(app, 'REFRESH_AHEAD_INTERVAL', 1.0))
+    limit = max(1, int(float(get_config(app, 'REFRESH_AHEAD_RATE', 10.0)) * interval))
+    semaphore = asyncio.Semaphore(max(1, int(get_config(app, 'REFRESH_AHEAD_CONCURRENCY', 4))))
+    tasks = set()
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            # Do not queue up more refreshes than can be started in one interval.
+            available = limit - len(tasks)
+            now = time.time()
+            for name, scheduler in list((getattr(app.ctx, 'refresh_ahead', None) or {}).items()):
+                if scheduler is None or scheduler.refresh is None or available <= 0:
+                    continue
+                for key, args in scheduler.due(now, available):
+                    task = asyncio.ensure_future(refresh_entry(semaphore, get_single_flight(app, name), key,
+                                                               partial(scheduler.refresh, key, *args)))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    available -= 1
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def setup_refresh_ahead(app: Sanic):
+    """Server start listener starting the refresh ahead task, if `REFRESH_AHEAD` is enabled."""
+    if get_config(app, 'REFRESH_AHEAD', False) and not getattr(app.ctx, 'refresh_ahead_running', False):
+        app.ctx.refresh_ahead_running = True
+        app.add_task(run_refresh_ahead, name='tobira_auth_refresh_ahead')
+
+
+async def stop_refresh_ahead(app: Sanic):
+    """Server stop listener stopping the refresh ahead task."""
+    if getattr(app.ctx, 'refresh_ahead_running', False):
+        app.ctx.refresh_ahead_running = False
+        await app.cancel_task('tobira_auth_refresh_ahead', raise_exception=False)
+
+
+async def close_caches(app: Sanic):
+    """Server stop listener closing all cache backends."""
+    for cache in (getattr(app.ctx, 'caches', None) or {}).values():
+        cache.close()
+
+
+def mark_negative_result(request: Request):
+    """Mark that a negative (fallback) result has been used to handle the request."""
+    ctx = getattr(request, 'ctx', None)
+    if ctx is not None:
+        ctx.negative_result = True
+
+
+def has_negative_result(request: Request) -> bool:
+    """Return True, if a negative (fallback) result has been used to handle the request."""
+    return getattr(getattr(request, 'ctx', None), 'negative_result', False)
+
+
+def limit_fresh_until(request: Request, fresh_until: Optional[float]):
+    """Record that a cached result used to handle the request is fresh until `fresh_until` (`time.time()`).
+    Results derived from it, e.g. cached responses, must not be cached longer, see `get_fresh_until`."""
+    ctx = getattr(request, 'ctx', None)
+    if ctx is not None and fresh_until is not None:
+        current = getattr(ctx, 'fresh_until', None)
+        ctx.fresh_until = fresh_until if current is None else min(current, fresh_until)
+
+
+def get_fresh_until(request: Request) -> Optional[float]:
+    """Return the time until all cached results used to handle the request are fresh, None if unknown."""
+    return getattr(getattr(request, 'ctx', None), 'fresh_until', None)
+
+
+def limit_time_to_live(request: Request, time_to_live: Optional[float]) -> Optional[float]:
+    """Return the time to live of a result derived from the cached results used to handle the request,
+    at most until they expire (0 or less if they are stale), see `get_fresh_until`."""
+    fresh_until = get_fresh_until(request)
+    if fresh_until is not None:
+        remaining = fresh_until - time.time()
+        time_to_live = remaining if time_to_live is None else min(time_to_live, remaining)
+    return time_to_live
+
+
+class BackgroundRequest:
+    """Request passed to a cached function refreshing its result in the background.
+
+    It provides the app and an empty `ctx` only, so the refreshes do not keep finished requests alive.
+    """
+
+    def __init__(self, app: Sanic):
+        self.app = app
+        self.ctx = SimpleNamespace()
+
+
+def default_cache_key(*args) -> str:
+    return '\x1f'.join(str(arg) for arg in args)
+
+
+def cached(name: str, time_to_live: Optional[float] = 300, maxsize: Optional[int] = 1024,
+           key: Callable[..., str] = default_cache_key, stale_time_to_live: float = 0,
+           negative_time_to_live: Optional[float] = None, negative_value: Callable[[], Any] = None,
+           refresh_ahead: bool = False):
+    """Cache the result of an async function taking the request as first argument.
+
+    The remaining arguments are used to build the cache key. The cache backend is
+    resolved from the request app, see `get_cache_backend`. Concurrent cache misses
+    for the same key are coalesced into one call, see `SingleFlight`.
+
+    Within `stale_time_to_live` seconds after a result expired, it is still returned
+    while a background task refreshes it. If the refresh fails, the stale result is kept.
+
+    If `negative_value` is set and the function raises an exception on a cache miss,
+    `negative_value()` is returned and cached for `negative_time_to_live` seconds.
+    Otherwise the exception is raised and nothing will be cached. Requests getting
+    a negative result are marked, see `has_negative_result`. The time until the result is fresh
+    is recorded on the request, see `limit_fresh_until`.
+
+    With `refresh_ahead`, frequently used results are refreshed in the background before
+    they expire, if `REFRESH_AHEAD` is enabled, see `RefreshAheadScheduler`. Background refreshes
+    call the function with a `BackgroundRequest`, it must only use the app of the request.
+
+    :param name: The cache name
+    :param time_to_live: Default time in seconds a result is cached, None for non expiring results.
+        The time to live and size of the cache are configurable, see `create_cache_backend`.
+    :param maxsize: Default maximum number of cache entries, None for unlimited size
+    :param key: Function building the cache key from the arguments (without request)
+    :param stale_time_to_live: Time in seconds an expired result may be served while it is refreshed
+    :param negative_time_to_live: Time in seconds a negative result is cached
+    :param negative_value: Factory of the negative result returned if the function fails
+    :param refresh_ahead: Whether frequently used results may be refreshed before they expire
+    """
+    def decorator(func):
+        async def refresh(app: Sanic, cache: CacheBackend, scheduler: Optional[RefreshAheadScheduler],
+                          cache_key: str, *args):
+            try:
+                result = await func(BackgroundRequest(app), *args)
+            except Exception as e:
+                logger.debug('%s: Refresh failed, keeping stale result. %s: %s', name, type(e).__name__, e)
+                return
+            await cache.set(cache_key, result, cache.time_to_live, stale_time_to_live)
+            if scheduler is not None:
+                scheduler.loaded(cache_key, time.time() + cache.time_to_live if cache.time_to_live else None)
+
+        @wraps(func)
+        async def wrapper(request: Request, *args):
+            cache = get_cache_backend(request.app, name, maxsize, time_to_live)
+            single_flight = get_single_flight(request.app, name)
+            scheduler = get_refresh_ahead(request.app, name, cache.maxsize) if refresh_ahead else None
+            cache_key = key(*args)
+            entry = await cache.get(cache_key)
+            if scheduler is not None:
+                if scheduler.refresh is None:
+                    scheduler.refresh = partial(refresh, request.app, cache, scheduler)
+                scheduler.touch(cache_key, args)
+            if entry is not MISSING:
+                if entry.negative:
+                    mark_negative_result(request)
+                limit_fresh_until(request, entry.fresh_until)
+                if not entry.stale:
+                    return entry.value
+
+            async def load():
+                try:
+                    result = await func(request, *args)
+                except Exception as e:
+                    if negative_value is None:
+                        raise
+                    logger.debug('%s: Caching negative result. %s: %s', name, type(e).__name__, e)
+                    result = negative_value()
+                    await cache.set(cache_key, result, negative_time_to_live, negative=True)
+                    return result, True
+                await cache.set(cache_key, result, cache.time_to_live, stale_time_to_live)
+                if scheduler is not None:
+                    scheduler.loaded(cache_key, time.time() + cache.time_to_live if cache.time_to_live else None)
+                return result, False
+
+            if entry is MISSING:
+                result, negative = await single_flight.do(cache_key, load)
+                if negative:
+                    mark_negative_result(request)
+                elif cache.time_to_live:
+                    limit_fresh_until(request, time.time() + cache.time_to_live)
+                return result
+            single_flight.start(refresh_flight_key(cache_key),
+                                partial(refresh, request.app, cache, scheduler, cache_key, *args))
+            return entry.value
+        return wrapper
+    return decorator
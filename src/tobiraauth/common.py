@@ -1,13 +1,64 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import importlib
 import re
+import sys
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
-from cache import AsyncTTL
-from httpx import AsyncClient
-from sanic import Request
+from sanic import Blueprint, Request, Sanic
 from sanic.log import logger
-from tobiraauth.config import ConfigConstants
-from tobiraauth.utils import get_config, is_admin, is_admin_mail
+from tobiraauth.caching import MISSING, cached, close_caches, get_cache_backend, get_single_flight, \
+    limit_fresh_until, mark_negative_result, setup_refresh_ahead, stop_refresh_ahead
+from tobiraauth.course_index import close_course_index, get_course_index, setup_course_index
+from tobiraauth.http_client import close_http_client, setup_http_client
+from tobiraauth.logs import log_access
+from tobiraauth.metrics import count_upstream_response, get_metrics, observe_stage, record_request, \
+    start_request_timer
+from tobiraauth.profile import get_request_profile, setup_request_profile
+from tobiraauth.rules import ADMIN_ROLES, parse_list
+from tobiraauth.upstream import upstream_request
+from tobiraauth.utils import get_config
+
+USER_COURSE_ROLES_TIME_TO_LIVE = 300
+USER_COURSE_ROLES_NEGATIVE_TIME_TO_LIVE = 10
+
+# One object per course ID shared by the cached course IDs of all users, see `compact_course_ids`.
+# The table is shared by all apps of the process and cleared when it reaches `COURSE_IDS_MAXSIZE` entries,
+# so course IDs no longer in use are dropped. Course IDs of cached entries stay valid, they are not shared
+# with the course IDs interned after the table was cleared.
+COURSE_IDS: Dict[Any, Any] = {}
+COURSE_IDS_MAXSIZE = 100000
+
+
+def register_callback_listeners(app: Sanic):
+    """Register the server listeners shared by all callback endpoints on the app.
+
+    The listeners are registered on the app, not on the callback blueprints: Sanic does not run
+    the server listeners of blueprints added on server start, see `tobiraauth.server.register_blueprints`.
+
+    :param app: Sanic app instance
+    """
+    app.before_server_start(setup_http_client)
+    app.after_server_stop(close_http_client)
+    app.before_server_start(setup_request_profile)
+    app.before_server_start(setup_role_providers)
+    app.after_server_stop(close_caches)
+    app.before_server_start(setup_refresh_ahead)
+    app.before_server_stop(stop_refresh_ahead)
+    app.before_server_start(setup_course_index)
+    app.after_server_stop(close_course_index)
+
+
+def register_callback_middleware(blueprint: Blueprint):
+    """Register the middleware shared by all callback blueprints.
+
+    :param blueprint: The callback blueprint
+    """
+    blueprint.on_request(start_request_timer)
+    blueprint.on_response(record_request)
+    blueprint.on_response(log_access)
 
 
 def get_user_role(username: str) -> str:
@@ -22,12 +73,180 @@ def get_user_role(username: str) -> str:
     return f'ROLE_USER_{re.sub("[^a-zA-Z0-9]", "_", username.strip()).upper()}'
 
 
-async def get_user_roles(request: Request, username: str, mail: str = None):
+class UserAttributes(NamedTuple):
+    """Attributes of the user role providers may use to resolve roles."""
+    username: str
+    mail: Optional[str]
+    affiliations: Tuple[str, ...]
+    home_organization: Optional[str]
+
+
+class RoleProvider:
+    """Source of user roles, see `get_user_roles`.
+
+    Subclasses implement `load_roles`. The roles are cached per user in the cache
+    `role_provider_<name>`, by default for `ROLE_PROVIDER_<NAME>_TIME_TO_LIVE` seconds,
+    see `create_cache_backend`. Concurrent lookups of the same user are coalesced.
+    Providers may override `get_roles` to handle caching on their own.
+
+    If a provider does not return within `ROLE_PROVIDER_<NAME>_TIMEOUT` seconds or fails,
+    its roles are omitted. A lookup exceeding the timeout still fills the cache.
+    """
+    name = 'custom'
+    time_to_live: Optional[float] = 300
+    timeout: Optional[float] = None
+
+    def __init__(self, app: Sanic):
+        timeout = get_config(app, f'ROLE_PROVIDER_{self.name}_TIMEOUT', self.timeout)
+        self.timeout = float(timeout) if timeout else None
+        time_to_live = get_config(app, f'ROLE_PROVIDER_{self.name}_TIME_TO_LIVE', self.time_to_live)
+        self.time_to_live = float(time_to_live) if time_to_live else None
+
+    def cache_key(self, user: UserAttributes) -> str:
+        """Return the cache key of the user. Override, if the roles depend on more than the username."""
+        return user.username
+
+    async def get_roles(self, request: Request, user: UserAttributes) -> List[str]:
+        """Return the roles of the user.
+
+        :param request: The request.
+        :param user: The user attributes
+        :return: List of roles, may be empty
+        """
+        cache = get_cache_backend(request.app, f'role_provider_{self.name}', time_to_live=self.time_to_live)
+        cache_key = self.cache_key(user)
+        entry = await cache.get(cache_key)
+        if entry is not MISSING:
+            limit_fresh_until(request, entry.fresh_until)
+            return entry.value
+
+        async def load():
+            # Interned, so the cached roles of all users share one string per role.
+            roles = [sys.intern(role) for role in await self.load_roles(request, user)]
+            await cache.set(cache_key, roles, cache.time_to_live)
+            return roles
+
+        roles = await get_single_flight(request.app, cache.name).do(cache_key, load)
+        if cache.time_to_live:
+            limit_fresh_until(request, time.time() + cache.time_to_live)
+        return roles
+
+    async def load_roles(self, request: Request, user: UserAttributes) -> List[str]:
+        """Resolve the roles of the user, e.g. by calling a webservice."""
+        raise NotImplementedError()
+
+
+class RuleRoleProvider(RoleProvider):
+    """Admin roles and the roles assigned by the role rules, see `tobiraauth.rules`."""
+    name = 'rules'
+
+    async def get_roles(self, request: Request, user: UserAttributes) -> List[str]:
+        role_rules = get_request_profile(request.app).role_rules
+        start = time.perf_counter()
+        admin = role_rules.is_admin(user.username, user.mail)
+        observe_stage(request.app, 'admin_check', start)
+        rule_roles = role_rules.get_roles(user.affiliations, user.mail, user.home_organization)
+        if admin:
+            return [*ADMIN_ROLES, *rule_roles]
+        return rule_roles
+
+
+class CourseRoleProvider(RoleProvider):
+    """Course roles from the course index, if configured. For users not in the index
+    the course webservice is queried, see `get_user_course_ids`. If the request has a deadline
+    (`request.ctx.deadline`, see `AUTH_LATENCY_BUDGET`), course roles not available by then are omitted."""
+    name = 'courses'
+
+    async def get_roles(self, request: Request, user: UserAttributes) -> List[str]:
+        course_index = get_course_index(request.app)
+        course_ids = course_index.lookup(user.username) if course_index is not None else None
+        if course_ids is None:
+            deadline = getattr(request.ctx, 'deadline', None)
+            if deadline is None:
+                course_ids = await get_user_course_ids(request, user.username)
+            else:
+                course_ids = await get_user_course_ids_until(request, user.username, deadline)
+        # The role strings are built per response only, the caches hold the course IDs.
+        return get_course_roles(course_ids or ())
+
+
+ROLE_PROVIDERS = {
+    RuleRoleProvider.name: RuleRoleProvider,
+    CourseRoleProvider.name: CourseRoleProvider,
+}
+
+
+def load_role_provider(app: Sanic, name: str) -> RoleProvider:
+    """Create the role provider by the name of a built-in provider or a `package.module:ClassName` reference."""
+    provider_class = ROLE_PROVIDERS.get(name, None)
+    if provider_class is None:
+        module_name, _, class_name = name.partition(':')
+        provider_class = getattr(importlib.import_module(module_name), class_name)
+    return provider_class(app)
+
+
+def compile_role_providers(app: Sanic) -> Tuple[RoleProvider, ...]:
+    """Create the role providers configured by `ROLE_PROVIDERS`.
+
+    :param app: Sanic app instance
+    :return: role providers
+    """
+    providers = []
+    for name in parse_list(get_config(app, 'ROLE_PROVIDERS', 'rules,courses')):
+        try:
+            providers.append(load_role_provider(app, name))
+        except Exception:
+            logger.exception(f'Unable to load role provider {name}.')
+    return tuple(providers)
+
+
+def get_role_providers(app: Sanic) -> Tuple[RoleProvider, ...]:
+    """Return the role providers of the app, create them on first use."""
+    providers = getattr(app.ctx, 'role_providers', None)
+    if providers is None:
+        providers = app.ctx.role_providers = compile_role_providers(app)
+    return providers
+
+
+async def setup_role_providers(app: Sanic):
+    """Server start listener creating the role providers."""
+    app.ctx.role_providers = compile_role_providers(app)
+
+
+async def run_role_provider(request: Request, provider: RoleProvider, user: UserAttributes) -> List[str]:
+    """Return the roles of the provider or an empty list, if it failed or exceeded its timeout."""
+    try:
+        if provider.timeout is None:
+            return await provider.get_roles(request, user)
+        return await asyncio.wait_for(provider.get_roles(request, user), provider.timeout)
+    except asyncio.TimeoutError:
+        reason = 'timeout'
+        logger.warning('Role provider %s timed out for %s.', provider.name, user.username)
+    except Exception as e:
+        reason = 'error'
+        logger.warning('Role provider %s failed for %s. %s: %s',
+                       provider.name, user.username, type(e).__name__, e)
+    get_metrics(request.app).inc('tobira_auth_role_provider_failures_total',
+                                 (('provider', provider.name), ('reason', reason)))
+    mark_negative_result(request)
+    return []
+
+
+async def get_user_roles(request: Request, username: str, mail: str = None, affiliations: List[str] = None,
+                         home_organization: str = None):
     """Returns a list of user roles for the given user.
 
+    Every user gets the anonymous, user and per-user roles. Additional roles are resolved
+    by the role providers configured by `ROLE_PROVIDERS`, by default the admin and rule roles
+    (`RuleRoleProvider`) and the course roles (`CourseRoleProvider`). All providers run concurrently,
+    their roles are merged without duplicates.
+
     :param request: The request.
     :param username: The username to get the roles for.
     :param mail: The users mail address for admin privileges check.
+    :param affiliations: The users affiliation values, each may contain multiple affiliations concatenated by ';'.
+        If not set, the values of the affiliation header of the request are used.
+    :param home_organization: The users home organization.
     :return: User roles list, may be empty.
     """
 
@@ -37,60 +256,109 @@ async def get_user_roles(request: Request, username: str, mail: str = None):
         get_user_role(username),
         f'ROLE_AAI_USER_{username.strip()}'
     ]
-    user_affiliations_headers = request.headers.getall(
-        get_config(request.app, 'affiliation_header', ConfigConstants.AFFILIATION_HEADER),
-        [])
-    if is_admin(request.app, username) or is_admin_mail(request.app, mail):
-        roles += [
-            'ROLE_TOBIRA_ADMIN',
-            'ROLE_TOBIRA_UPLOAD',
-            'ROLE_TOBIRA_STUDIO',
-            'ROLE_TOBIRA_EDITOR',
-        ]
-    else:
-        for user_affiliations in user_affiliations_headers:
-            for user_affiliation in user_affiliations.split(';'):
-                if 'staff' in user_affiliation.strip():
-                    roles += [
-                        'ROLE_TOBIRA_UPLOAD',
-                        'ROLE_TOBIRA_STUDIO',
-                        'ROLE_TOBIRA_EDITOR',
-                    ]
-    try:
-        course_roles = await get_user_course_roles(request, username)
-        if course_roles and isinstance(course_roles, list):
-            roles += course_roles
-    except:
-        logger.warning(f'Unable to get user course roles for {username}.')
-    return roles
+    if affiliations is None:
+        affiliations = request.headers.getall(get_request_profile(request.app).affiliation_header, [])
+    user = UserAttributes(username, mail, tuple(affiliations), home_organization)
+    results = await asyncio.gather(*(run_role_provider(request, provider, user)
+                                     for provider in get_role_providers(request.app)))
+    for provider_roles in results:
+        roles += provider_roles
+    return list(dict.fromkeys(roles))
+
 
+async def get_user_course_ids_until(request: Request, username: str, deadline: float) -> Optional[Tuple]:
+    """Get the course IDs of the user, but do not wait longer than until `deadline` (`time.perf_counter()`).
 
-@AsyncTTL(time_to_live=300, maxsize=1024, skip_args=1)
-async def get_user_course_roles(request: Request, username: str):
-    """Get user roles based on course IDs, belongs to the user.
+    If the deadline passes, the lookup keeps running in the background and fills the cache
+    for the next request. The request is marked to have a negative result and an exceeded
+    latency budget (`request.ctx.latency_budget_exceeded`).
+
+    :param request: The request.
+    :param username: The username to get the course IDs for.
+    :param deadline: Time until the course IDs must be available
+    :return: Course IDs or None, if the deadline passed.
+    """
+    task = asyncio.ensure_future(get_user_course_ids(request, username))
+    done, _ = await asyncio.wait((task,), timeout=deadline - time.perf_counter())
+    if done:
+        return task.result()
+    background_tasks = getattr(request.app.ctx, 'background_tasks', None)
+    if background_tasks is None:
+        background_tasks = request.app.ctx.background_tasks = set()
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    get_metrics(request.app).inc('tobira_auth_latency_budget_exceeded_total')
+    logger.info('get_user_course_ids_until: Latency budget exceeded for %s, '
+                'returning roles without course roles.', username)
+    request.ctx.latency_budget_exceeded = True
+    mark_negative_result(request)
+    return None
+
+
+def get_course_roles(course_ids: Iterable) -> List[str]:
+    """Return the user roles for the given course IDs.
+
+    :param course_ids: Iterable of course IDs
+    :return: List of course roles
+    """
+    return [f'ROLE_COURSE_{course_id}_Learner' for course_id in course_ids]
+
+
+def compact_course_ids(course_ids: Iterable) -> Tuple:
+    """Return the course IDs as tuple sharing one object per course ID with the course IDs of all other users.
+
+    Numeric course IDs are stored as int, the course roles built from them are the same.
+    At most `COURSE_IDS_MAXSIZE` course IDs are shared, see `COURSE_IDS`.
+
+    :param course_ids: Iterable of course IDs
+    :return: Tuple of course IDs
+    """
+    compact = []
+    for course_id in course_ids:
+        if isinstance(course_id, str) and course_id.isascii() and course_id.isdigit() \
+                and str(int(course_id)) == course_id:
+            course_id = int(course_id)
+        if isinstance(course_id, (int, str)):
+            if len(COURSE_IDS) >= COURSE_IDS_MAXSIZE and course_id not in COURSE_IDS:
+                COURSE_IDS.clear()
+            course_id = COURSE_IDS.setdefault(course_id, course_id)
+        compact.append(course_id)
+    return tuple(compact)
+
+
+# The cache keeps its name, the metrics and the cache admin endpoints refer to it.
+@cached('user_course_roles', time_to_live=USER_COURSE_ROLES_TIME_TO_LIVE, maxsize=1024, stale_time_to_live=60,
+        negative_time_to_live=USER_COURSE_ROLES_NEGATIVE_TIME_TO_LIVE, negative_value=tuple, refresh_ahead=True)
+async def get_user_course_ids(request: Request, username: str) -> Tuple:
+    """Get the IDs of the courses the user belongs to. The course roles are built from them
+    when the response is rendered, see `get_course_roles`.
 
     For performance reasons the result will be cached for a limited amount of time.
+    The course IDs are cached as compact tuple, see `compact_course_ids`.
+    An expired result is served for another minute while it is refreshed in the background.
+    Results of frequently seen users are refreshed before they expire, if `REFRESH_AHEAD` is enabled.
+    If the course webservice fails or its circuit breaker is open, an empty tuple is returned
+    and cached for a few seconds only, see `tobiraauth.upstream`.
 
     :param request: The request.
-    :param username: The username to get the course roles for.
-    :return: List of user roles based on course IDs, may be empty.
+    :param username: The username to get the course IDs for.
+    :return: Tuple of course IDs, may be empty.
     """
-    logger.debug(f'get_user_course_roles: Query user course roles for {username}.')
-    roles = []
+    logger.debug('get_user_course_ids: Query user course IDs for %s.', username)
     # === Custom part begins here ===
-    # Call external endpoint to get the course IDs the user belongs to. For each ID, create a user role.
+    # Call external endpoint to get the course IDs the user belongs to.
     user_courses_ws_url = get_config(request.app, 'USER_COURSES_WS_URL', None)
     if not user_courses_ws_url:
-        return roles
+        return ()
     user_courses_ws_url = user_courses_ws_url.format(username=username)
-    async with AsyncClient() as http_client:
-        response = await http_client.get(user_courses_ws_url, follow_redirects=True)
-        if response.is_error:
-            logger.debug(f'get_user_course_roles: Unable to query user courses for {username}. '
-                         f'Status: {response.status_code}.')
-            return roles
-        user_courses = response.json()
-    for course_id in user_courses:
-        roles.append(f'ROLE_COURSE_{course_id}_Learner')
+    start = time.perf_counter()
+    response = await upstream_request(request.app, 'courses', 'GET', user_courses_ws_url, follow_redirects=True)
+    observe_stage(request.app, 'course_roles_upstream', start)
+    count_upstream_response(request.app, 'courses', response.status_code)
+    if response.is_error:
+        logger.debug('get_user_course_ids: Unable to query user courses for %s. Status: %s.',
+                     username, response.status_code)
+        response.raise_for_status()
+    user_courses = response.json()
     # === Custom part ends here ===
-    return roles
+    return compact_course_ids(user_courses)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import csv
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from sanic import Sanic
+from sanic.log import logger
+
+from tobiraauth.utils import get_config
+
+MAGIC = b'TACI'
+VERSION = 1
+# magic, version, entry count, source file mtime (ns), source file size
+HEADER = struct.Struct('<4sIQqQ')
+# username hash, data offset, data length
+ENTRY = struct.Struct('<QQI')
+
+
+def hash_username(username: str) -> int:
+    return int.from_bytes(hashlib.blake2b(username.encode(), digest_size=8).digest(), 'little')
+
+
+def read_export(export_path: str) -> Dict[str, List[str]]:
+    """Read a course membership export.
+
+    Json lines files (`.jsonl`, `.ndjson`, `.json`) contain one object per user like
+    `{"username": "jane", "courses": [1, 2]}`. Other files are read as CSV with one
+    `username,course_id` row per membership, an optional header row is skipped.
+
+    :param export_path: Path of the export file
+    :return: dict mapping usernames to course IDs
+    """
+    memberships = {}
+    with open(export_path, newline='') as f:
+        if export_path.endswith(('.jsonl', '.ndjson', '.json')):
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                courses = memberships.setdefault(str(record['username']), [])
+                courses.extend(str(course_id) for course_id in record.get('courses', ()))
+        else:
+            for row in csv.reader(f):
+                if len(row) < 2 or row[0].strip() in ('', 'username'):
+                    continue
+                memberships.setdefault(row[0].strip(), []).append(row[1].strip())
+    return memberships
+
+
+def build_course_index(export_path: str, index_path: str):
+    """Build the course membership index from the export and replace the index file atomically.
+
+    The index is a table of fixed size entries sorted by username hash, followed by the records
+    `username\\n course_id\\t course_id...`. Workers memory-map it and look up users by binary search.
+    """
+    source_stat = os.stat(export_path)
+    memberships = read_export(export_path)
+    entries = []
+    data = bytearray()
+    data_start = HEADER.size + ENTRY.size * len(memberships)
+    for username, courses in memberships.items():
+        record = username.encode() + b'\n' + '\t'.join(dict.fromkeys(courses)).encode()
+        entries.append((hash_username(username), data_start + len(data), len(record)))
+        data += record
+    entries.sort()
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), source_stat.st_mtime_ns, source_stat.st_size))
+        for entry in entries:
+            f.write(ENTRY.pack(*entry))
+        f.write(data)
+    os.replace(tmp_path, index_path)
+    logger.info(f'Course index {index_path} built with {len(entries)} users.')
+
+
+class CourseIndex:
+    """Read-only, memory-mapped course membership index."""
+
+    def __init__(self, index_path: str):
+        with open(index_path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, mtime_ns, size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{index_path} is not a course index file.')
+        self.source_stat: Tuple[int, int] = (mtime_ns, size)
+
+    def lookup(self, username: str) -> Optional[List[str]]:
+        """Return the course IDs of the user or None, if the user is not in the index."""
+        key = hash_username(username)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self._mmap, HEADER.size + middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        encoded_username = username.encode() + b'\n'
+        for position in range(low, self.count):
+            entry_hash, offset, length = ENTRY.unpack_from(self._mmap, HEADER.size + position * ENTRY.size)
+            if entry_hash != key:
+                break
+            record = self._mmap[offset:offset + length]
+            if record.startswith(encoded_username):
+                courses = record[len(encoded_username):]
+                return courses.decode().split('\t') if courses else []
+        return None
+
+    def close(self):
+        self._mmap.close()
+
+
+class CourseIndexProvider:
+    """Keep the course index of a worker up to date with the export file.
+
+    If the export file changed, the first worker acquiring the lock rebuilds the index.
+    Workers reopen the index file if it has been replaced.
+    """
+
+    def __init__(self, export_path: str, index_path: str):
+        self.export_path = export_path
+        self.index_path = index_path
+        self.index: Optional[CourseIndex] = None
+
+    def lookup(self, username: str) -> Optional[List[str]]:
+        if self.index is None:
+            return None
+        return self.index.lookup(username)
+
+    def is_outdated(self, index: Optional[CourseIndex]) -> bool:
+        try:
+            source_stat = os.stat(self.export_path)
+        except FileNotFoundError:
+            return False
+        return index is None or index.source_stat != (source_stat.st_mtime_ns, source_stat.st_size)
+
+    def open_index(self) -> Optional[CourseIndex]:
+        try:
+            return CourseIndex(self.index_path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def refresh(self):
+        """Rebuild the index if the export changed and reopen the index file if it was replaced."""
+        self.rebuild()
+        self.reopen()
+
+    def rebuild(self):
+        """Rebuild the index file if the export changed. May run in a thread."""
+        if self.is_outdated(self.index):
+            with open(f'{self.index_path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Another worker may have rebuilt the index while we were waiting for the lock.
+                    index = self.open_index()
+                    outdated = self.is_outdated(index)
+                    if index is not None:
+                        index.close()
+                    if outdated:
+                        build_course_index(self.export_path, self.index_path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def reopen(self):
+        """Open the index file if it was replaced. Must run in the event loop thread."""
+        try:
+            inode = os.stat(self.index_path).st_ino
+        except FileNotFoundError:
+            return
+        if self.index is None or self.index.inode != inode:
+            index = self.open_index()
+            if index is not None:
+                old_index, self.index = self.index, index
+                if old_index is not None:
+                    old_index.close()
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+def get_course_index(app: Sanic) -> Optional[CourseIndexProvider]:
+    """Return the course index provider, if `COURSE_INDEX_EXPORT_PATH` is configured.
+
+    The index is never built on the request path. It is opened on server start and built and reloaded
+    by a background task, see `setup_course_index`. Until then, lookups return None and the course
+    webservice is used.
+
+    :param app: Sanic app instance
+    :return: course index provider or None
+    """
+    provider = getattr(app.ctx, 'course_index', None)
+    if provider is None:
+        export_path = get_config(app, 'COURSE_INDEX_EXPORT_PATH', None)
+        if not export_path:
+            return None
+        index_path = get_config(app, 'COURSE_INDEX_PATH', None) or f'{export_path}.idx'
+        provider = app.ctx.course_index = CourseIndexProvider(export_path, index_path)
+    return provider
+
+
+async def update_course_index(provider: CourseIndexProvider):
+    """Rebuild the index in a thread, if the export changed, and reopen the index file, if it was replaced."""
+    await asyncio.get_running_loop().run_in_executor(None, provider.rebuild)
+    provider.reopen()
+
+
+async def reload_course_index(app: Sanic):
+    interval = float(get_config(app, 'COURSE_INDEX_RELOAD_INTERVAL', 60.0))
+    provider = get_course_index(app)
+    while True:
+        try:
+            await update_course_index(provider)
+        except Exception:
+            logger.exception(f'Unable to reload course index {provider.index_path}.')
+        await asyncio.sleep(interval)
+
+
+async def setup_course_index(app: Sanic):
+    """Server start listener opening the course index and starting the reload task, which builds the index
+    without blocking the event loop."""
+    provider = get_course_index(app)
+    if provider is not None and not getattr(app.ctx, 'course_index_reload', False):
+        # Opening an existing index is cheap, it is rebuilt by the reload task if the export changed.
+        provider.reopen()
+        app.ctx.course_index_reload = True
+        app.add_task(reload_course_index, name='tobira_auth_reload_course_index')
+
+
+async def close_course_index(app: Sanic):
+    """Server stop listener closing the course index."""
+    if getattr(app.ctx, 'course_index_reload', False):
+        app.ctx.course_index_reload = False
+        await app.cancel_task('tobira_auth_reload_course_index', raise_exception=False)
+    provider = getattr(app.ctx, 'course_index', None)
+    app.ctx.course_index = None
+    if provider is not None:
+        provider.close()
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from sanic import Blueprint
-from sanic.exceptions import Unauthorized
+import asyncio
+import random
+
+from sanic import Blueprint, Request
+from sanic.exceptions import ServiceUnavailable, Unauthorized
 from sanic.log import logger
 from sanic.response import json
 
+from tobiraauth.utils import get_config
+
 dummy_user_ws_blueprint = Blueprint('dummy_user_webservices', url_prefix='/user')
 
 
+async def simulate_upstream(request: Request):
+    """Inject the configured latency and error rate, e.g. for load tests."""
+    latency = float(get_config(request.app, 'DUMMY_USER_SERVICE_LATENCY', 0))
+    if latency > 0:
+        await asyncio.sleep(latency)
+    error_rate = float(get_config(request.app, 'DUMMY_USER_SERVICE_ERROR_RATE', 0))
+    if error_rate > 0 and random.random() < error_rate:
+        raise ServiceUnavailable()
+
+
 # Test endpoints
 @dummy_user_ws_blueprint.post('/login/<username:str>')
 async def login_user_backend(request, username: str):
     logger.warning(f'You are calling a dummy user service. DO NOT USE IT IN PRODUCTION!!!')
+    await simulate_upstream(request)
     userdata = request.get_form()
     password = userdata.get('password', None)
     if username == 'admin' and password == 'opencast':
@@ -23,16 +39,28 @@ async def login_user_backend(request, username: str):
             'email': 'admin@localhost',
         }
         return json(userdata)
+    if username.startswith('bench-') and password == 'opencast':
+        # Users of the load test, see benchmarks/load_test.py
+        userdata = {
+            'username': username,
+            'given_name': 'Bench',
+            'sur_name': username,
+            'email': f'{username}@localhost',
+        }
+        return json(userdata)
     raise Unauthorized()
 
 
 @dummy_user_ws_blueprint.get('/<username:str>/courses')
 async def get_user_courses(request, username: str):
     logger.warning(f'You are calling a dummy user service. DO NOT USE IT IN PRODUCTION!!!')
+    await simulate_upstream(request)
     return json([1, 2, 3, 4])
 
 
 @dummy_user_ws_blueprint.after_server_start
 async def configure_endpoints(app):
-    app.config.update({'USER_LOGIN_WS_URL': 'http://localhost:8000/user/login/{username}'})
-    app.config.update({'USER_COURSES_WS_URL': 'http://localhost:8000/user/{username}/courses'})
+    if not app.config.get('USER_LOGIN_WS_URL', None):
+        app.config.update({'USER_LOGIN_WS_URL': 'http://localhost:8000/user/login/{username}'})
+    if not app.config.get('USER_COURSES_WS_URL', None):
+        app.config.update({'USER_COURSES_WS_URL': 'http://localhost:8000/user/{username}/courses'})
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from typing import Any, Callable
+
+from sanic.log import logger
+from sanic.response import HTTPResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def get_json_encoder(name: str = 'auto') -> Callable[[Any], bytes]:
+    """Return a json encoder returning bytes.
+
+    :param name: `orjson`, `json` (standard library) or `auto` to use orjson if it is installed
+    :return: json encoder function
+    """
+    name = str(name or 'auto').lower()
+    if name in ('auto', 'orjson') and orjson is not None:
+        return orjson.dumps
+    if name == 'orjson':
+        logger.warning('The orjson json encoder is configured, but orjson is not installed. '
+                       'Falling back to the standard library json encoder.')
+    elif name not in ('auto', 'json'):
+        logger.warning(f'Unknown json encoder {name}. Falling back to the standard library json encoder.')
+    return stdlib_dumps
+
+
+NO_USER = stdlib_dumps({'outcome': 'no-user'})
+
+
+def json_bytes(body: bytes, status: int = 200, headers: dict = None) -> HTTPResponse:
+    """Return a json response with an already encoded body."""
+    return HTTPResponse(body, status=status, headers=headers, content_type='application/json')
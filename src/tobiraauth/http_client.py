@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from httpx import AsyncClient, Limits, Timeout
+from sanic import Sanic
+from sanic.log import logger
+
+from tobiraauth.utils import get_config
+
+
+def create_http_client(app: Sanic) -> AsyncClient:
+    """Create a pooled http client for upstream webservice calls based on the app configuration.
+
+    :param app: Sanic app instance
+    :return: http client
+    """
+    limits = Limits(
+        max_connections=int(get_config(app, 'HTTP_CLIENT_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(get_config(app, 'HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS', 20)),
+        keepalive_expiry=float(get_config(app, 'HTTP_CLIENT_KEEPALIVE_EXPIRY', 30.0)),
+    )
+    default_timeout = float(get_config(app, 'HTTP_CLIENT_TIMEOUT', 5.0))
+    timeout = Timeout(
+        default_timeout,
+        connect=float(get_config(app, 'HTTP_CLIENT_CONNECT_TIMEOUT', 2.0)),
+        read=float(get_config(app, 'HTTP_CLIENT_READ_TIMEOUT', default_timeout)),
+    )
+    http2 = bool(get_config(app, 'HTTP_CLIENT_HTTP2', False))
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning('HTTP/2 is enabled for the upstream http client, but the h2 package is not installed. '
+                           'Falling back to HTTP/1.1.')
+            http2 = False
+    return AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+def get_http_client(app: Sanic) -> AsyncClient:
+    """Return the http client of the current worker.
+
+    The client is created on server start. If it is missing (e.g. the listener has not run yet),
+    it will be created on first use.
+
+    :param app: Sanic app instance
+    :return: http client
+    """
+    http_client = getattr(app.ctx, 'http_client', None)
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client(app)
+        app.ctx.http_client = http_client
+    return http_client
+
+
+async def setup_http_client(app: Sanic):
+    """Server start listener creating the worker http client."""
+    get_http_client(app)
+
+
+async def close_http_client(app: Sanic):
+    """Server stop listener closing the worker http client."""
+    http_client = getattr(app.ctx, 'http_client', None)
+    app.ctx.http_client = None
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
@@ -1,26 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import re
+import hashlib
+import hmac
+import os
+import time
+from typing import Optional
 
-from cache import AsyncTTL
-from httpx import AsyncClient
-from sanic import Blueprint, Request
+from sanic import Blueprint, Request, Sanic
 from sanic.log import logger
-from sanic.response import json, JSONResponse
-from tobiraauth.common import get_user_roles, get_user_role
+from sanic.response import HTTPResponse
+from tobiraauth.caching import MISSING, get_cache_backend, get_single_flight, has_negative_result, \
+    limit_time_to_live
+from tobiraauth.common import get_user_roles, get_user_role, register_callback_middleware
+from tobiraauth.encoding import NO_USER, json_bytes
+from tobiraauth.metrics import count_upstream_response, observe_stage
+from tobiraauth.profile import get_request_profile
+from tobiraauth.rate_limit import RateLimitExceeded, check_rate_limits, count_shed, get_concurrency_limiter, \
+    retry_after_header
+from tobiraauth.upstream import upstream_request
 
 from tobiraauth.utils import get_config
 
 login_callback_bp = Blueprint('login_callback', url_prefix='/login')
+register_callback_middleware(login_callback_bp)
 
 
 @login_callback_bp.post('/')
-async def login_callback(request: Request) -> JSONResponse:
+async def login_callback(request: Request) -> HTTPResponse:
     """Tobira-Auth login callback endpoint
 
     Allways returns a json with `outcome` filed. If its value is `no-user`,
     the userid field is missing in the request or the password is invalid.
     Otherwise, the `outcome` value is `user` and additional fields describe the user metadata.
+    Logins exceeding a rate limit or the in-flight limit get the `no-user` outcome, with the
+    status code `LOGIN_SHED_STATUS` (200 or 429 with `Retry-After` header).
     The fields are:
 
     - `username`: The username
@@ -31,67 +44,194 @@ async def login_callback(request: Request) -> JSONResponse:
     :param request: The request
     :return: Tobira-Auth callback json.
     """
-    result = {'outcome': 'no-user'}
     try:
         body = request.json
         username = body.get('userid')
         password = body.get('password')
     except:
-        logger.warning(f'login_callback: Unable to read userdata from request.')
-        return json(result, status=400)
+        logger.warning('login_callback: Unable to read userdata from request.')
+        return json_bytes(NO_USER, status=400)
 
     if not username or not password:
-        return json(result, status=400)
+        return json_bytes(NO_USER, status=400)
 
-    result = await login_user(request, username, password)
-    return json(result, status=200)
+    try:
+        return json_bytes(await login_user(request, username, password), status=200)
+    except RateLimitExceeded as e:
+        logger.debug('login_callback: Login of %s rejected. %s', username, e)
+        return shed_response(request.app, e)
+
+
+def shed_response(app: Sanic, error: RateLimitExceeded) -> HTTPResponse:
+    """Return the `no-user` response of a login rejected by a rate limit or the in-flight limit."""
+    if int(get_config(app, 'LOGIN_SHED_STATUS', 200)) == 429:
+        return json_bytes(NO_USER, status=429, headers={'Retry-After': retry_after_header(error.retry_after)})
+    return json_bytes(NO_USER, status=200)
+
+
+def get_credential_cache_secret(app: Sanic) -> bytes:
+    """Return the secret key used to hash passwords for the credential cache.
+
+    Configure `CREDENTIAL_CACHE_SECRET` to share verified credentials between workers
+    using the sqlite cache backend. Otherwise a random secret is generated per worker.
+
+    :param app: Sanic app instance
+    :return: secret key
+    """
+    secret = getattr(app.ctx, 'credential_cache_secret', None)
+    if secret is None:
+        configured_secret = get_config(app, 'CREDENTIAL_CACHE_SECRET', None)
+        if configured_secret:
+            secret = hashlib.blake2b(str(configured_secret).encode()).digest()
+        else:
+            secret = os.urandom(64)
+        app.ctx.credential_cache_secret = secret
+    return secret
+
+
+def hash_password(app: Sanic, username: str, password: str) -> str:
+    """Return a keyed hash of the password, salted with the username.
+
+    :param app: Sanic app instance
+    :param username: The username
+    :param password: Users password
+    :return: hex encoded password hash
+    """
+    password_hash = hashlib.blake2b(key=get_credential_cache_secret(app), digest_size=32, person=b'tobira-auth')
+    password_hash.update(username.encode())
+    password_hash.update(b'\x00')
+    password_hash.update(password.encode())
+    return password_hash.hexdigest()
 
 
-@AsyncTTL(time_to_live=300, maxsize=1024, skip_args=1)
 async def login_user(request: Request, username: str, password: str) -> dict:
     """Login the user.
 
     The username and password will be checked, by an external webservice in this example.
     All user metadata including the user roles will be returned as Tobira-Auth callback json.
     On invalid username or password, the `outcome` value will be set to `no-user`.
-    For performance reason, the result will be cached a limited amount of time.
+    For performance reason, verified credentials and the user roles are cached separately,
+    see `verify_credentials` and `get_user_roles`. The encoded json of verified users is cached
+    as well, so a cache hit returns it without encoding it again. It is not cached longer than the
+    cached roles it is built from and not at all, if fallback roles were used (e.g. the course
+    webservice failed).
 
     :param request: The request
     :param username: The username
     :param password:  Users password
-    :return: Tobira-Auth callback dict
+    :return: Tobira-Auth callback json, encoded
+    :raises RateLimitExceeded: if the credentials must be verified, but a login limit is exceeded
     """
-    result = {'outcome': 'no-user'}
     if not username or not password:
-        return result
+        return NO_USER
+    userdata = await verify_credentials(request, username, password)
+    if userdata is None:
+        return NO_USER
+    payloads = get_cache_backend(request.app, 'login_payloads', maxsize=1024, time_to_live=300)
+    entry = await payloads.get(username)
+    if entry is not MISSING:
+        return entry.value
+    roles = await get_user_roles(request, username)
+    payload = get_request_profile(request.app).json_dumps({
+      'outcome': 'user',
+      'username': username,
+      'displayName': userdata.get('displayName'),
+      'email': userdata.get('email'),
+      'userRole': get_user_role(username),
+      'roles': roles,
+    })
+    if has_negative_result(request):
+        # Resolve the roles again on the next login instead of keeping the fallback roles.
+        return payload
+    time_to_live = limit_time_to_live(request, payloads.time_to_live)
+    if time_to_live is None or time_to_live > 0:
+        await payloads.set(username, payload, time_to_live=time_to_live)
+    return payload
+
+
+async def verify_credentials(request: Request, username: str, password: str) -> Optional[dict]:
+    """Verify the user credentials and return the user metadata.
+
+    The credential cache holds one entry per user with a keyed hash of the last verified password
+    and the user metadata. Wrong passwords are verified by the login webservice every time,
+    but never replace or evict the entry of the user. Verifications by the login webservice are
+    limited per username and client address (`LOGIN_USER_RATE_LIMIT`, `LOGIN_CLIENT_RATE_LIMIT`)
+    and in total (`LOGIN_MAX_IN_FLIGHT`), see `tobiraauth.rate_limit`. Concurrent logins with the same
+    credentials share one verification and are limited once. If the login webservice is unavailable
+    (e.g. its circuit breaker is open), the credentials are treated as invalid.
+
+    :param request: The request
+    :param username: The username
+    :param password:  Users password
+    :return: User metadata dict with `displayName` and `email`, None on invalid credentials
+    :raises RateLimitExceeded: if the credentials must be verified, but a login limit is exceeded
+    """
+    cache = get_cache_backend(request.app, 'credentials', maxsize=1024, time_to_live=300)
+    password_hash = hash_password(request.app, username, password)
+    entry = await cache.get(username)
+    if entry is not MISSING and not entry.stale and hmac.compare_digest(entry.value.get('password_hash'),
+                                                                         password_hash):
+        return entry.value.get('userdata')
+
+    async def limited_check_credentials():
+        # Only the verification made for all concurrent identical logins is limited.
+        check_rate_limits(request, username)
+        concurrency = get_concurrency_limiter(request.app)
+        if concurrency is not None and not concurrency.acquire():
+            count_shed(request.app, 'in_flight')
+            raise RateLimitExceeded('in_flight', 1.0)
+        try:
+            return await check_credentials(request, username, password)
+        finally:
+            if concurrency is not None:
+                concurrency.release()
+
+    try:
+        userdata = await get_single_flight(request.app, 'credentials').do(
+            f'{username}\x1f{password_hash}', limited_check_credentials)
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning('verify_credentials: Unable to check credentials of %s. %s: %s', username, type(e).__name__, e)
+        return None
+    if userdata is not None:
+        await cache.set(username, {'password_hash': password_hash, 'userdata': userdata},
+                        time_to_live=cache.time_to_live)
+        # The user metadata may have changed, the cached login json must be rebuilt.
+        await get_cache_backend(request.app, 'login_payloads', maxsize=1024, time_to_live=300).delete(username)
+    return userdata
+
+
+async def check_credentials(request: Request, username: str, password: str) -> Optional[dict]:
+    """Check the username and password against the login webservice.
+
+    :param request: The request
+    :param username: The username
+    :param password:  Users password
+    :return: User metadata dict with `displayName` and `email`, None on invalid credentials
+    """
     # === Custom part begins here ===
     # Check the username and password against an external webservice.
-    # On success, get the user roles.
     user_login_ws_url = get_config(request.app, 'USER_LOGIN_WS_URL', None)
     if not user_login_ws_url:
-        return result
+        return None
     user_login_ws_url = user_login_ws_url.format(username=username)
     params = {
         'password': password
     }
-    async with AsyncClient() as http_client:
-        response = await http_client.post(user_login_ws_url, data=params)
-        if response.is_error:
-            logger.debug(f'login_user: User credentials check for {username} failed. '
-                         f'Status: {response.status_code}.')
-            return result
-        userdata = response.json()
+    start = time.perf_counter()
+    response = await upstream_request(request.app, 'login', 'POST', user_login_ws_url, data=params)
+    observe_stage(request.app, 'login_upstream', start)
+    count_upstream_response(request.app, 'login', response.status_code)
+    if response.is_error:
+        logger.debug('login_user: User credentials check for %s failed. Status: %s.',
+                     username, response.status_code)
+        return None
+    userdata = response.json()
     if not userdata or 'username' not in userdata or 'email' not in userdata:
-        return result
-    user_role = get_user_role(username)
-    roles = await get_user_roles(request, username)
-    result = {
-      'outcome': 'user',
-      'username': username,
+        return None
+    return {
       'displayName': f'{userdata.get("given_name")} {userdata.get("sur_name")}',
       'email': userdata.get('email'),
-      'userRole': user_role,
-      'roles': roles,
     }
     # === Custom part ends here ===
-    return result
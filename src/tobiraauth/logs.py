@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import os
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List
+
+from sanic import Request, Sanic
+from sanic.response import HTTPResponse
+
+from tobiraauth.encoding import stdlib_dumps
+from tobiraauth.utils import get_config
+
+access_logger = logging.getLogger('tobiraauth.access')
+
+QUEUED_LOGGERS = ('sanic.root', 'sanic.error', 'sanic.access', 'tobiraauth.access')
+
+
+class LoggerQueueHandler(QueueHandler):
+    """Queue handler replacing the handlers of a logger, see `LoggerQueueListener`.
+
+    Unlike `QueueHandler`, records are not formatted before they are queued,
+    so formatting happens in the listener thread.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, logger_name: str):
+        super().__init__(log_queue)
+        self.logger_name = logger_name
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.queue_logger_name = self.logger_name
+        return record
+
+
+class LoggerQueueListener(QueueListener):
+    """Queue listener thread passing records to the original handlers of the logger they were queued by."""
+
+    def __init__(self, log_queue: queue.SimpleQueue, handlers: Dict[str, List[logging.Handler]]):
+        super().__init__(log_queue, respect_handler_level=True)
+        self.logger_handlers = handlers
+
+    def handle(self, record: logging.LogRecord):
+        for handler in self.logger_handlers.get(record.queue_logger_name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def setup_access_logger(app: Sanic):
+    """Write the json access log to stdout, if `ACCESS_LOG_JSON` is enabled."""
+    if get_config(app, 'ACCESS_LOG_JSON', False) and not access_logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        access_logger.addHandler(handler)
+        access_logger.setLevel(logging.INFO)
+        access_logger.propagate = False
+
+
+async def setup_logging(app: Sanic):
+    """Server start listener moving log output to a separate thread, if `LOG_QUEUE` is enabled.
+
+    The handlers of the Sanic loggers and the access logger are replaced by a queue handler.
+    A listener thread takes the records from the queue and passes them to the original handlers.
+    """
+    setup_access_logger(app)
+    if not get_config(app, 'LOG_QUEUE', True) or getattr(app.ctx, 'log_listener', None) is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    handlers = {}
+    for name in QUEUED_LOGGERS:
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            handlers[name] = logger.handlers
+            logger.handlers = [LoggerQueueHandler(log_queue, name)]
+    listener = app.ctx.log_listener = LoggerQueueListener(log_queue, handlers)
+    listener.start()
+
+
+async def stop_logging(app: Sanic):
+    """Server stop listener writing the queued records and restoring the original log handlers."""
+    listener = getattr(app.ctx, 'log_listener', None)
+    if listener is None:
+        return
+    app.ctx.log_listener = None
+    for name, handlers in listener.logger_handlers.items():
+        logging.getLogger(name).handlers = handlers
+    listener.stop()
+
+
+async def log_access(request: Request, response: HTTPResponse):
+    """Response middleware of the callback blueprints writing a sampled json access log.
+
+    Enabled by `ACCESS_LOG_JSON`. Only a share of `ACCESS_LOG_SAMPLE_RATE` (0..1) of the requests is logged.
+    """
+    if not access_logger.handlers:
+        return
+    sample_rate = float(get_config(request.app, 'ACCESS_LOG_SAMPLE_RATE', 1.0))
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    start = getattr(request.ctx, 'metrics_start', None)
+    access_logger.info('%s', AccessLogRecord({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'pid': os.getpid(),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status if response is not None else 500,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 3) if start is not None else None,
+        'size': len(response.body) if response is not None and response.body is not None else None,
+        'remote_addr': request.remote_addr or request.ip,
+    }))
+
+
+class AccessLogRecord(dict):
+    """Access log entry, encoded as json when the record is formatted."""
+
+    def __str__(self):
+        return stdlib_dumps(self).decode()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from sanic import Blueprint, Request, Sanic
+from sanic.log import logger
+from sanic.response import HTTPResponse, text
+
+from tobiraauth.utils import get_config, get_private_dir
+
+metrics_bp = Blueprint('metrics', url_prefix='/metrics')
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'tobira_auth_requests_total': ('counter', 'Number of handled callback requests.'),
+    'tobira_auth_request_duration_seconds': ('histogram', 'Callback request latency.'),
+    'tobira_auth_stage_duration_seconds': ('histogram', 'Latency of the stages of a callback request.'),
+    'tobira_auth_upstream_responses_total': ('counter', 'Number of upstream webservice responses by status code.'),
+    'tobira_auth_upstream_retries_total': ('counter', 'Number of retried upstream webservice requests.'),
+    'tobira_auth_circuit_breaker_open': ('gauge', 'Number of workers with an open upstream circuit breaker.'),
+    'tobira_auth_circuit_breaker_rejected_total': ('counter', 'Number of upstream calls rejected by an open '
+                                                              'circuit breaker.'),
+    'tobira_auth_latency_budget_exceeded_total': ('counter', 'Number of auth callbacks answered without course '
+                                                             'roles because the latency budget was exceeded.'),
+    'tobira_auth_login_shed_total': ('counter', 'Number of logins rejected without upstream verification because '
+                                                'a rate limit (user, client) or the in-flight limit was exceeded.'),
+    'tobira_auth_login_in_flight': ('gauge', 'Number of login verifications in flight.'),
+    'tobira_auth_login_max_in_flight': ('gauge', 'Limit of login verifications in flight of all workers.'),
+    'tobira_auth_role_provider_failures_total': ('counter', 'Number of failed or timed out role provider calls.'),
+    'tobira_auth_cache_hits_total': ('counter', 'Number of cache hits.'),
+    'tobira_auth_cache_misses_total': ('counter', 'Number of cache misses.'),
+    'tobira_auth_cache_evictions_total': ('counter', 'Number of cache entries evicted due to the cache size limit.'),
+    'tobira_auth_cache_rejections_total': ('counter', 'Number of new cache entries not admitted by the eviction '
+                                                      'policy or exceeding the byte limit.'),
+    'tobira_auth_cache_entries': ('gauge', 'Number of entries of the in-memory caches of all workers.'),
+    'tobira_auth_cache_bytes': ('gauge', 'Approximate memory of the in-memory caches with a byte limit.'),
+    'tobira_auth_cache_upstream_calls_total': ('counter', 'Number of function calls on cache misses.'),
+    'tobira_auth_cache_refresh_ahead_total': ('counter', 'Number of cache entries refreshed before they expired.'),
+    'tobira_auth_cache_coalesced_total': ('counter', 'Number of cache misses coalesced into a running call.'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Counters and histograms of a worker process."""
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = ()):
+        """Add an observation to a histogram. Buckets are stored non-cumulative, followed by sum and count."""
+        key = (name, labels)
+        histogram = self.histograms.get(key, None)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def get_metrics(app: Sanic) -> Metrics:
+    """Return the metrics of the current worker, create them on first use.
+
+    :param app: Sanic app instance
+    :return: metrics
+    """
+    metrics = getattr(app.ctx, 'metrics', None)
+    if metrics is None:
+        metrics = app.ctx.metrics = Metrics()
+    return metrics
+
+
+def observe_stage(app: Sanic, stage: str, start: float):
+    """Observe the duration of a request stage started at `start` (`time.perf_counter()`)."""
+    get_metrics(app).observe('tobira_auth_stage_duration_seconds', time.perf_counter() - start, (('stage', stage),))
+
+
+def count_upstream_response(app: Sanic, upstream: str, status_code: int):
+    get_metrics(app).inc('tobira_auth_upstream_responses_total',
+                         (('upstream', upstream), ('status', str(status_code))))
+
+
+async def start_request_timer(request: Request):
+    """Request middleware of the callback blueprints starting the request latency measurement."""
+    request.ctx.metrics_start = time.perf_counter()
+
+
+async def record_request(request: Request, response: HTTPResponse):
+    """Response middleware of the callback blueprints recording request count and latency."""
+    start = getattr(request.ctx, 'metrics_start', None)
+    if start is None or request.route is None:
+        return
+    endpoint = f'/{request.route.path.rstrip("/")}/'
+    metrics = get_metrics(request.app)
+    status = response.status if response is not None else 500
+    metrics.inc('tobira_auth_requests_total', (('endpoint', endpoint), ('status', str(status))))
+    metrics.observe('tobira_auth_request_duration_seconds', time.perf_counter() - start, (('endpoint', endpoint),))
+
+
+def snapshot(app: Sanic) -> dict:
+    """Return the metrics of this worker as json serializable dict, including the cache statistics,
+    login limits and circuit breaker states."""
+    metrics = get_metrics(app)
+    counters = dict(metrics.counters)
+    for name, cache in (getattr(app.ctx, 'caches', None) or {}).items():
+        labels = (('cache', name),)
+        counters[('tobira_auth_cache_hits_total', labels)] = cache.hits
+        counters[('tobira_auth_cache_misses_total', labels)] = cache.misses
+        counters[('tobira_auth_cache_evictions_total', labels)] = cache.evictions
+        counters[('tobira_auth_cache_rejections_total', labels)] = cache.rejections
+        if cache.size is not None:
+            counters[('tobira_auth_cache_entries', labels)] = cache.size
+        if cache.bytes is not None:
+            counters[('tobira_auth_cache_bytes', labels)] = cache.bytes
+    for name, single_flight in (getattr(app.ctx, 'single_flights', None) or {}).items():
+        labels = (('cache', name),)
+        counters[('tobira_auth_cache_upstream_calls_total', labels)] = single_flight.calls
+        counters[('tobira_auth_cache_coalesced_total', labels)] = single_flight.coalesced
+    for name, scheduler in (getattr(app.ctx, 'refresh_ahead', None) or {}).items():
+        if scheduler is not None:
+            counters[('tobira_auth_cache_refresh_ahead_total', (('cache', name),))] = scheduler.refreshes
+    login_concurrency = getattr(app.ctx, 'login_concurrency', None)
+    if login_concurrency is not None:
+        counters[('tobira_auth_login_in_flight', ())] = login_concurrency.in_flight
+        counters[('tobira_auth_login_max_in_flight', ())] = login_concurrency.limit
+    for name, circuit_breaker in (getattr(app.ctx, 'circuit_breakers', None) or {}).items():
+        counters[('tobira_auth_circuit_breaker_open', (('upstream', name),))] = int(circuit_breaker.state != 'closed')
+    return {
+        'pid': os.getpid(),
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, values] for (name, labels), values in metrics.histograms.items()],
+    }
+
+
+def get_metrics_dir(app: Sanic) -> str:
+    return get_private_dir(app, 'METRICS_DIR', 'metrics')
+
+
+def write_snapshot(app: Sanic):
+    """Write the metrics snapshot of this worker into the metrics directory shared by all workers."""
+    path = os.path.join(get_metrics_dir(app), f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot(app), f)
+    os.replace(f'{path}.tmp', path)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(app: Sanic) -> Metrics:
+    """Merge the metrics snapshots of all running workers."""
+    merged = Metrics()
+    metrics_dir = get_metrics_dir(app)
+    for filename in os.listdir(metrics_dir):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(metrics_dir, filename)
+        try:
+            with open(path) as f:
+                worker_snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not is_running(worker_snapshot.get('pid')):
+            # Remove metrics of stopped workers, the counters are reset like on a service restart.
+            # Another worker may remove them at the same time.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        for name, labels, value in worker_snapshot.get('counters'):
+            merged.inc(name, tuple(map(tuple, labels)), value)
+        for name, labels, values in worker_snapshot.get('histograms'):
+            key = (name, tuple(map(tuple, labels)))
+            histogram = merged.histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                histogram[i] += value
+    return merged
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render(metrics: Metrics) -> str:
+    """Render metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type in ('counter', 'gauge'):
+            for (counter_name, labels), value in sorted(metrics.counters.items()):
+                if counter_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        else:
+            for (histogram_name, labels), values in sorted(metrics.histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bucket, count in zip(BUCKETS + ('+Inf',), values):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bucket),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {values[-2]}')
+                lines.append(f'{name}_count{format_labels(labels)} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+@metrics_bp.get('/')
+async def metrics_endpoint(request: Request) -> HTTPResponse:
+    """Prometheus metrics endpoint
+
+    Returns the metrics of all Sanic workers in the Prometheus text exposition format.
+    Each worker writes its metrics to `METRICS_DIR` every `METRICS_FLUSH_INTERVAL` seconds.
+    """
+    write_snapshot(request.app)
+    return text(render(collect(request.app)), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+async def flush_metrics(app: Sanic):
+    interval = float(get_config(app, 'METRICS_FLUSH_INTERVAL', 5.0))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_snapshot(app)
+        except OSError as e:
+            logger.warning(f'Unable to write metrics snapshot. {e}')
+
+
+@metrics_bp.after_server_start
+async def start_metrics_flush(app: Sanic):
+    try:
+        write_snapshot(app)
+    except OSError as e:
+        logger.warning(f'Unable to write metrics snapshot. {e}')
+    app.add_task(flush_metrics, name='tobira_auth_flush_metrics')
+
+
+@metrics_bp.before_server_stop
+async def stop_metrics_flush(app: Sanic):
+    await app.cancel_task('tobira_auth_flush_metrics', raise_exception=False)
+    try:
+        os.remove(os.path.join(get_metrics_dir(app), f'{os.getpid()}.json'))
+    except OSError:
+        pass
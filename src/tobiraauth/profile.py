@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable, NamedTuple, Tuple
+
+from sanic import Sanic
+
+from tobiraauth.config import ConfigConstants
+from tobiraauth.encoding import get_json_encoder
+from tobiraauth.rules import RoleRules, compile_role_rules
+from tobiraauth.utils import get_config
+
+
+class RequestProfile(NamedTuple):
+    """Immutable, precompiled view of the configuration used while handling a callback request.
+
+    The profile is compiled once per app on server start, so request handlers
+    only need to do header lookups and fill in templates.
+    """
+    username_header: str
+    display_name_header: str
+    given_name_header: str
+    surname_header: str
+    email_header: str
+    affiliation_header: str
+    home_organization_header: str
+    format_display_name: Callable[..., str]
+    static_roles: Tuple[str, ...]
+    templated_roles: Tuple[Callable[..., str], ...]
+    role_rules: RoleRules
+    json_dumps: Callable[[Any], bytes]
+    latency_budget: float
+
+
+def compile_request_profile(app: Sanic) -> RequestProfile:
+    """Resolve header names, display name format, custom roles, role rules, the json encoder
+    and the latency budget from the app configuration.
+
+    Custom roles are split into static roles and templated roles. Templated roles are stored as
+    bound `str.format` methods and must be called with `username`, `email` and `home_organization`.
+
+    :param app: Sanic app instance
+    :return: request profile
+    """
+    static_roles = []
+    templated_roles = []
+    custom_roles = get_config(app, 'custom_roles', None)
+    if custom_roles:
+        for role in custom_roles.split(','):
+            role = role.strip()
+            if role == '':
+                continue
+            if '{' in role:
+                templated_roles.append(role.format)
+            else:
+                static_roles.append(role)
+    display_name_format = get_config(app, 'display_name_format', '{given_name} {surname}')
+    return RequestProfile(
+        username_header=get_config(app, 'username_header', ConfigConstants.USERNAME_HEADER),
+        display_name_header=get_config(app, 'display_name_header', ConfigConstants.DISPLAY_NAME_HEADER),
+        given_name_header=get_config(app, 'given_name_header', ConfigConstants.GIVEN_NAME_HEADER),
+        surname_header=get_config(app, 'surname_header', ConfigConstants.SURNAME_HEADER),
+        email_header=get_config(app, 'email_header', ConfigConstants.EMAIL_HEADER),
+        affiliation_header=get_config(app, 'affiliation_header', ConfigConstants.AFFILIATION_HEADER),
+        home_organization_header=get_config(app, 'home_organization', ConfigConstants.HOME_ORGANIZATION_HEADER),
+        format_display_name=display_name_format.format,
+        static_roles=tuple(static_roles),
+        templated_roles=tuple(templated_roles),
+        role_rules=compile_role_rules(app),
+        json_dumps=get_json_encoder(get_config(app, 'JSON_ENCODER', 'auto')),
+        latency_budget=float(get_config(app, 'AUTH_LATENCY_BUDGET', 0) or 0),
+    )
+
+
+def get_request_profile(app: Sanic) -> RequestProfile:
+    """Return the request profile of the app, compile it on first use.
+
+    :param app: Sanic app instance
+    :return: request profile
+    """
+    profile = getattr(app.ctx, 'request_profile', None)
+    if profile is None:
+        profile = compile_request_profile(app)
+        app.ctx.request_profile = profile
+    return profile
+
+
+async def setup_request_profile(app: Sanic):
+    """Server start listener compiling the request profile."""
+    app.ctx.request_profile = compile_request_profile(app)
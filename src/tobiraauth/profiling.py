@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import cProfile
+import inspect
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import List, Optional
+
+from sanic import Blueprint, Request
+from sanic.response import HTTPResponse, json, text
+
+from tobiraauth.utils import get_config, is_authorized
+
+profiling_bp = Blueprint('profiling', url_prefix='/profiling')
+
+MODES = ('sample', 'pstats', 'lag')
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    """Return the stack of the frame in collapsed format (`module:function;module:function`, outermost first)."""
+    names = []
+    while frame is not None:
+        names.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def find_coroutine(frame: Optional[FrameType]) -> Optional[str]:
+    """Return the name of the innermost coroutine function of the stack."""
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return f'{frame.f_globals.get("__name__", "?")}.{getattr(frame.f_code, "co_qualname", frame.f_code.co_name)}'
+        frame = frame.f_back
+    return None
+
+
+class StackSampler(threading.Thread):
+    """Thread sampling the stack of another thread every `interval` seconds."""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        super().__init__(name='tobira-auth-stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def report(self) -> str:
+        """Return the sampled stacks in collapsed format, one `stack count` line per stack."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class LoopLagMonitor(threading.Thread):
+    """Detect event loop blocking longer than `threshold` seconds.
+
+    A heartbeat task on the event loop updates a timestamp every `interval` seconds. If the
+    heartbeat is late, the monitor thread captures the stack of the event loop thread, so
+    the blocking code and the coroutine running it can be reported.
+    """
+
+    def __init__(self, thread_id: int, threshold: float = 0.05, interval: float = 0.01):
+        super().__init__(name='tobira-auth-loop-lag-monitor', daemon=True)
+        self.thread_id = thread_id
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.blocking = None
+        self.events: List[dict] = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            if self.blocking is None and time.monotonic() - heartbeat > self.threshold:
+                frame = sys._current_frames().get(self.thread_id, None)
+                self.blocking = (heartbeat, collapse_stack(frame), find_coroutine(frame))
+
+    def beat(self):
+        """Update the heartbeat. Must be called from the event loop every `interval` seconds."""
+        now = time.monotonic()
+        lag = now - self.heartbeat - self.interval
+        blocking, self.blocking = self.blocking, None
+        self.heartbeat = now
+        if lag > self.threshold:
+            stack, coroutine = (blocking[1], blocking[2]) if blocking is not None else (None, None)
+            self.events.append({'lag': round(lag, 6), 'coroutine': coroutine, 'stack': stack})
+
+    async def run_heartbeat(self, seconds: float):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.interval)
+            self.beat()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+@profiling_bp.get('/')
+async def profiling_endpoint(request: Request) -> HTTPResponse:
+    """Profile the worker handling this request
+
+    Requires the `Authorization: Bearer <PROFILING_TOKEN>` header. Query parameters:
+
+    - `seconds`: Profiling duration, at most `PROFILING_MAX_SECONDS` (default 10)
+    - `mode`: `sample` returns sampled event loop stacks in collapsed format (flame graph input),
+      `pstats` returns a cProfile report of the event loop thread, `lag` returns event loop
+      blocking longer than `threshold` seconds (default `PROFILING_LAG_THRESHOLD`) with the stack
+      and coroutine causing it as json.
+
+    Only one profiling run per worker at a time is possible.
+    """
+    if not is_authorized(request, 'PROFILING_TOKEN'):
+        return json({'error': 'Unauthorized.'}, status=401)
+    mode = request.args.get('mode', 'sample')
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        threshold = float(request.args.get('threshold', get_config(request.app, 'PROFILING_LAG_THRESHOLD', 0.05)))
+    except ValueError:
+        return json({'error': 'Invalid seconds or threshold.'}, status=400)
+    max_seconds = float(get_config(request.app, 'PROFILING_MAX_SECONDS', 60.0))
+    if mode not in MODES or not 0 < seconds <= max_seconds:
+        return json({'error': f'Expected mode {", ".join(MODES)} and up to {max_seconds} seconds.'}, status=400)
+    if getattr(request.app.ctx, 'profiling', False):
+        return json({'error': 'Profiling is already running on this worker.'}, status=409)
+
+    request.app.ctx.profiling = True
+    thread_id = threading.get_ident()
+    try:
+        if mode == 'sample':
+            sampler = StackSampler(thread_id)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                sampler.stop()
+            return text(sampler.report())
+        if mode == 'pstats':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(100)
+            return text(report.getvalue())
+        monitor = LoopLagMonitor(thread_id, threshold=threshold)
+        monitor.start()
+        try:
+            await monitor.run_heartbeat(seconds)
+        finally:
+            monitor.stop()
+        return json({'threshold': threshold, 'seconds': seconds, 'events': monitor.events})
+    finally:
+        request.app.ctx.profiling = False
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sanic import Request, Sanic
+
+from tobiraauth.metrics import get_metrics
+from tobiraauth.utils import get_config
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of verifying credentials upstream if a login limit is exceeded."""
+
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f'Login {limit} limit exceeded.')
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Token buckets per key, e.g. per username or client address.
+
+    Each bucket holds up to `burst` tokens and is refilled with `rate` tokens per second.
+    A call takes one token and is rejected if the bucket is empty. At most `maxsize` buckets
+    are kept, the least recently used bucket is dropped first, which resets it to a full bucket.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, maxsize: int = 10000):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token from the bucket of the key.
+
+        :param key: The bucket key
+        :param now: Current `time.monotonic()` time
+        :return: 0 if a token was taken, otherwise the seconds until a token is available
+        """
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = float(self.burst)
+        else:
+            tokens, updated = bucket
+            tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        if tokens >= 1.0:
+            tokens -= 1.0
+            retry_after = 0.0
+        else:
+            self.rejected += 1
+            retry_after = (1.0 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class ConcurrencyLimiter:
+    """Limit of concurrent calls. Calls over the limit are rejected instead of queued."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self) -> bool:
+        """Return True, if a call may be made. Callers must release allowed calls."""
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+
+def get_rate_limiter(app: Sanic, name: str) -> Optional[TokenBucketLimiter]:
+    """Return the login rate limiter, create it on first use.
+
+    The limit is configured in attempts per minute by `LOGIN_<NAME>_RATE_LIMIT` with the burst size
+    `LOGIN_<NAME>_RATE_BURST`. The limiter is disabled, if the limit is 0.
+
+    :param app: Sanic app instance
+    :param name: The limiter name, `user` or `client`
+    :return: rate limiter, None if disabled
+    """
+    rate_limiters = getattr(app.ctx, 'rate_limiters', None)
+    if rate_limiters is None:
+        rate_limiters = app.ctx.rate_limiters = {}
+    if name not in rate_limiters:
+        defaults = {'user': (30, 10), 'client': (0, 50)}.get(name, (0, 10))
+        per_minute = float(get_config(app, f'LOGIN_{name}_RATE_LIMIT', defaults[0]))
+        burst = int(get_config(app, f'LOGIN_{name}_RATE_BURST', defaults[1]))
+        rate_limiters[name] = TokenBucketLimiter(
+            name, per_minute / 60, burst, maxsize=int(get_config(app, 'LOGIN_RATE_LIMIT_MAXSIZE', 10000)),
+        ) if per_minute > 0 else None
+    return rate_limiters[name]
+
+
+def get_concurrency_limiter(app: Sanic) -> Optional[ConcurrencyLimiter]:
+    """Return the limiter of concurrent login verifications, configured by `LOGIN_MAX_IN_FLIGHT`.
+
+    :param app: Sanic app instance
+    :return: concurrency limiter, None if disabled
+    """
+    if not hasattr(app.ctx, 'login_concurrency'):
+        limit = int(get_config(app, 'LOGIN_MAX_IN_FLIGHT', 64))
+        app.ctx.login_concurrency = ConcurrencyLimiter('login', limit) if limit > 0 else None
+    return app.ctx.login_concurrency
+
+
+def get_client_address(request: Request) -> str:
+    """Return the client address, the forwarded address if Sanic is configured to trust a proxy
+    (`REAL_IP_HEADER`, `PROXIES_COUNT`, `FORWARDED_SECRET`), otherwise the peer address."""
+    return request.remote_addr or request.ip or ''
+
+
+def check_rate_limits(request: Request, username: str):
+    """Take a token from the bucket of the username and of the client address.
+
+    :param request: The request
+    :param username: The username
+    :raises RateLimitExceeded: if a bucket is empty
+    """
+    for name, key in (('user', username), ('client', get_client_address(request))):
+        rate_limiter = get_rate_limiter(request.app, name)
+        if rate_limiter is None:
+            continue
+        retry_after = rate_limiter.acquire(key)
+        if retry_after:
+            count_shed(request.app, name)
+            raise RateLimitExceeded(name, retry_after)
+
+
+def count_shed(app: Sanic, limit: str):
+    get_metrics(app).inc('tobira_auth_login_shed_total', (('limit', limit),))
+
+
+def retry_after_header(retry_after: float) -> str:
+    return str(max(1, math.ceil(retry_after)))
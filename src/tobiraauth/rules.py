@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sanic import Sanic
+from sanic.log import logger
+
+from tobiraauth.utils import get_config
+
+ADMIN_ROLES = (
+    'ROLE_TOBIRA_ADMIN',
+    'ROLE_TOBIRA_UPLOAD',
+    'ROLE_TOBIRA_STUDIO',
+    'ROLE_TOBIRA_EDITOR',
+)
+
+RULE_TYPES = ('affiliation', 'email_domain', 'home_organization')
+
+DEFAULT_RULES = {
+    'affiliation': {
+        'staff': ['ROLE_TOBIRA_UPLOAD', 'ROLE_TOBIRA_STUDIO', 'ROLE_TOBIRA_EDITOR'],
+    },
+}
+
+
+class RoleRules:
+    """Compiled rules mapping affiliations, email domains and home organizations to roles.
+
+    All lookups are hashed and case-insensitive. Scoped affiliations like `staff@edu.org`
+    match rules for the scoped value and the unscoped value `staff`.
+    """
+
+    def __init__(self, rules: Dict[str, Dict[str, Iterable[str]]],
+                 admin_usernames: Iterable[str] = (), admin_mails: Iterable[str] = ()):
+        self.affiliation: Dict[str, Tuple[str, ...]] = {}
+        self.email_domain: Dict[str, Tuple[str, ...]] = {}
+        self.home_organization: Dict[str, Tuple[str, ...]] = {}
+        for rule_type, mapping in rules.items():
+            if rule_type not in RULE_TYPES:
+                logger.warning(f'Ignoring unknown role rule type {rule_type}.')
+                continue
+            table = getattr(self, rule_type)
+            for value, roles in mapping.items():
+                key = value.strip().lower()
+                table[key] = tuple(dict.fromkeys(table.get(key, ()) + tuple(roles)))
+        self.admin_usernames: FrozenSet[str] = frozenset(admin_usernames)
+        self.admin_mails: FrozenSet[str] = frozenset(admin_mails)
+
+    def is_admin(self, username: Optional[str], mail: Optional[str] = None) -> bool:
+        """Return True, if the username or email address is defined as admin in the config file."""
+        return username in self.admin_usernames or (mail is not None and mail in self.admin_mails)
+
+    def get_roles(self, affiliations: Iterable[str] = (), mail: Optional[str] = None,
+                  home_organization: Optional[str] = None) -> List[str]:
+        """Return the roles matching the user attributes, without duplicates.
+
+        :param affiliations: The users affiliation values, each may contain multiple affiliations concatenated by ';'
+        :param mail: The users email address
+        :param home_organization: The users home organization
+        :return: list of roles
+        """
+        roles = {}
+        if self.affiliation:
+            for user_affiliations in affiliations:
+                for affiliation in user_affiliations.split(';'):
+                    affiliation = affiliation.strip().lower()
+                    matched = self.affiliation.get(affiliation, None)
+                    if matched is None and '@' in affiliation:
+                        matched = self.affiliation.get(affiliation.split('@', 1)[0], None)
+                    if matched:
+                        roles.update(dict.fromkeys(matched))
+        if self.email_domain and mail and '@' in mail:
+            roles.update(dict.fromkeys(self.email_domain.get(mail.rsplit('@', 1)[1].strip().lower(), ())))
+        if self.home_organization and home_organization:
+            roles.update(dict.fromkeys(self.home_organization.get(home_organization.strip().lower(), ())))
+        return list(roles)
+
+
+def parse_list(value: Optional[str]) -> List[str]:
+    """Split a comma-separated config value, skip empty values."""
+    if not value:
+        return []
+    return [item.strip() for item in str(value).split(',') if item.strip() != '']
+
+
+def parse_rules(value: str) -> Dict[str, Dict[str, List[str]]]:
+    """Parse inline role rules like `affiliation:staff=ROLE_A,ROLE_B;email_domain:edu.org=ROLE_C`."""
+    rules = {}
+    for rule in value.split(';'):
+        if not rule.strip():
+            continue
+        matcher, _, roles = rule.partition('=')
+        rule_type, _, match_value = matcher.partition(':')
+        if not match_value.strip():
+            logger.warning(f'Ignoring invalid role rule {rule}.')
+            continue
+        rules.setdefault(rule_type.strip().lower(), {}).setdefault(match_value.strip(), []).extend(parse_list(roles))
+    return rules
+
+
+def compile_role_rules(app: Sanic) -> RoleRules:
+    """Compile the role rules and admin lists from the app configuration.
+
+    Rules are read from the json file `ROLE_RULES_FILE` and the inline rules `ROLE_RULES`.
+    If none of them is configured, users with the `staff` affiliation get the upload, studio and editor roles.
+
+    :param app: Sanic app instance
+    :return: compiled role rules
+    """
+    rules = {}
+    rules_file = get_config(app, 'ROLE_RULES_FILE', None)
+    if rules_file:
+        with open(rules_file) as f:
+            rules = json.load(f)
+    inline_rules = get_config(app, 'ROLE_RULES', None)
+    if inline_rules:
+        for rule_type, mapping in parse_rules(inline_rules).items():
+            for value, roles in mapping.items():
+                rules.setdefault(rule_type, {}).setdefault(value, [])
+                rules[rule_type][value] = list(rules[rule_type][value]) + roles
+    if not rules_file and not inline_rules:
+        rules = DEFAULT_RULES
+    return RoleRules(rules,
+                     admin_usernames=parse_list(get_config(app, 'ADMIN_USERS_USERNAME', None)),
+                     admin_mails=parse_list(get_config(app, 'ADMIN_USERS_MAIL', None)))
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 from sanic import Sanic
+from sanic.log import logger
 from sanic.response import text
 
-from tobiraauth.utils import format_env_name
+from tobiraauth.logs import setup_logging, stop_logging
+from tobiraauth.utils import format_env_name, get_config
 
 
 def create_app(app_name: str = 'tobira-auth'):
@@ -12,11 +14,29 @@ def create_app(app_name: str = 'tobira-auth'):
 
     Register all endpoints respecting configuration.
 
+    With the `production` startup profile (`STARTUP_PROFILE`), Sanic Extensions and the API
+    documentation are not loaded, blueprints are registered on app creation instead of on
+    server start and the request profile and role providers are compiled before the server accepts requests.
+    The server listeners are registered on the app in all profiles, see `register_listeners`.
+
     :param app_name: The app name. It will also be used as configuration prefix (in UPPER_CASE).
     :return: Sanic app.
     """
     app = Sanic(app_name, env_prefix=f'{format_env_name(app_name)}_')
-    register_blueprints(app)
+    app.main_process_start(configure_server_socket)
+    app.before_server_start(setup_logging)
+    app.after_server_stop(stop_logging)
+    register_listeners(app)
+    production = str(app.config.get('STARTUP_PROFILE', 'default')).lower() == 'production'
+    if production:
+        app.config.AUTO_EXTEND = False
+        add_blueprints(app)
+        from tobiraauth.common import get_role_providers
+        from tobiraauth.profile import get_request_profile
+        get_request_profile(app)
+        get_role_providers(app)
+    else:
+        register_blueprints(app)
 
     @app.get('/')
     async def index(request):
@@ -25,26 +45,71 @@ def create_app(app_name: str = 'tobira-auth'):
         This endpoint can be used for testing purpose."""
         return text('This is the Tobira-Auth callback service endpoint.')
 
-    # Initialize documentation.
-    app.ext.openapi.describe(
-        title='Tobira-Auth callback service',
-        description='Provide auth or login callback service for Tobira authentication system.',
-        version='1.0')
+    if not production:
+        # Initialize documentation.
+        app.ext.openapi.describe(
+            title='Tobira-Auth callback service',
+            description='Provide auth or login callback service for Tobira authentication system.',
+            version='1.0')
     return app
 
 
+async def configure_server_socket(app: Sanic):
+    """Main process start listener applying the listener socket configuration before the socket is bound.
+
+    If `UNIX_SOCKET` is set, the service listens on this Unix domain socket instead of the TCP host and port,
+    unless a socket is given on the command line (`--unix`). The listen backlog is set to `BACKLOG`
+    (the Sanic command line has no option for it).
+    """
+    unix_socket = get_config(app, 'UNIX_SOCKET', None)
+    backlog = int(get_config(app, 'BACKLOG', 1024))
+    for server_info in app.state.server_info:
+        server_info.settings['backlog'] = backlog
+        if unix_socket and not server_info.settings.get('unix'):
+            server_info.settings['unix'] = unix_socket
+            logger.info('Listening on unix socket %s.', unix_socket)
+
+
+def register_listeners(app: Sanic):
+    """Register the server listeners of the endpoints enabled in the application configuration.
+
+    The listeners are registered on the app on creation in all startup profiles, Sanic does not run
+    server listeners of blueprints added on server start, see `register_blueprints`."""
+    if any(app.config.get(name, False) for name in ('ENABLE_AUTH_CALLBACK', 'ENABLE_AUTH_BATCH',
+                                                     'ENABLE_LOGIN_CALLBACK')):
+        from tobiraauth.common import register_callback_listeners
+        register_callback_listeners(app)
+
+
 def register_blueprints(app: Sanic):
     """Register application endpoints.
 
     Based on application configuration some endpoints (Blueprints) should be enabled or disabled on startup."""
     @app.before_server_start
     async def registration(app):
-        if app.config.get('ENABLE_AUTH_CALLBACK', False):
-            from tobiraauth.auth_callback import auth_callback_bp
-            app.blueprint(auth_callback_bp)
-        if app.config.get('ENABLE_LOGIN_CALLBACK', False):
-            from tobiraauth.login_callback import login_callback_bp
-            app.blueprint(login_callback_bp)
-        if app.config.get('ENABLE_DUMMY_USER_SERVICE', False):
-            from tobiraauth.dummy_user_webservices import dummy_user_ws_blueprint
-            app.blueprint(dummy_user_ws_blueprint)
+        add_blueprints(app)
+
+
+def add_blueprints(app: Sanic):
+    """Add the blueprints of the endpoints enabled in the application configuration."""
+    if app.config.get('ENABLE_AUTH_CALLBACK', False):
+        from tobiraauth.auth_callback import auth_callback_bp
+        app.blueprint(auth_callback_bp)
+    if app.config.get('ENABLE_AUTH_BATCH', False):
+        from tobiraauth.auth_callback import auth_batch_bp
+        app.blueprint(auth_batch_bp)
+    if app.config.get('ENABLE_LOGIN_CALLBACK', False):
+        from tobiraauth.login_callback import login_callback_bp
+        app.blueprint(login_callback_bp)
+    if app.config.get('ENABLE_METRICS', False):
+        from tobiraauth.metrics import metrics_bp
+        app.blueprint(metrics_bp)
+    if app.config.get('ENABLE_ADMIN', False):
+        from tobiraauth.admin import admin_bp
+        app.blueprint(admin_bp)
+    if app.config.get('ENABLE_PROFILING', False):
+        from tobiraauth.profiling import profiling_bp
+        app.blueprint(profiling_bp)
+    if app.config.get('ENABLE_DUMMY_USER_SERVICE', False):
+        from tobiraauth.dummy_user_webservices import dummy_user_ws_blueprint
+        app.blueprint(dummy_user_ws_blueprint)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import time
+
+from httpx import Response, TransportError
+from sanic import Sanic
+from sanic.log import logger
+
+from tobiraauth.http_client import get_http_client
+from tobiraauth.metrics import get_metrics
+from tobiraauth.utils import get_config
+
+# Status codes of idempotent requests worth retrying, the upstream or a proxy is (temporarily) unavailable.
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream webservice while its circuit breaker is open."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f'Circuit breaker of upstream {upstream} is open.')
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """Circuit breaker of an upstream webservice.
+
+    After `failure_threshold` consecutive failures the breaker opens and calls fail fast.
+    After `reset_timeout` seconds one trial call is allowed (half open). The breaker closes
+    if the trial call succeeds and opens again otherwise.
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Return True, if a call may be made. Callers must report the outcome of allowed calls."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.trial_running:
+                self.rejected += 1
+                return False
+            self.trial_running = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info('Circuit breaker of upstream %s closed.', self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            logger.warning('Circuit breaker of upstream %s opened after %s failures.', self.name, self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Report an allowed call that has been aborted without outcome."""
+        self.trial_running = False
+
+
+def get_circuit_breaker(app: Sanic, upstream: str) -> CircuitBreaker:
+    """Return the circuit breaker of the upstream webservice, create it on first use.
+
+    :param app: Sanic app instance
+    :param upstream: The upstream name, e.g. `courses` or `login`
+    :return: circuit breaker
+    """
+    circuit_breakers = getattr(app.ctx, 'circuit_breakers', None)
+    if circuit_breakers is None:
+        circuit_breakers = app.ctx.circuit_breakers = {}
+    circuit_breaker = circuit_breakers.get(upstream, None)
+    if circuit_breaker is None:
+        circuit_breaker = circuit_breakers[upstream] = CircuitBreaker(
+            upstream,
+            failure_threshold=int(get_config(app, 'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5)),
+            reset_timeout=float(get_config(app, 'CIRCUIT_BREAKER_RESET_TIMEOUT', 30.0)),
+        )
+    return circuit_breaker
+
+
+def retry_delay(app: Sanic, attempt: int) -> float:
+    """Return the exponential backoff delay with full jitter before retry `attempt` (starting at 1)."""
+    backoff = float(get_config(app, 'UPSTREAM_RETRY_BACKOFF', 0.05))
+    max_backoff = float(get_config(app, 'UPSTREAM_RETRY_MAX_BACKOFF', 1.0))
+    return random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+
+
+async def upstream_request(app: Sanic, upstream: str, method: str, url: str, **kwargs) -> Response:
+    """Send a request to an upstream webservice using the shared http client.
+
+    Transport errors and 5xx responses count as failures of the upstream circuit breaker.
+    GET requests are retried up to `UPSTREAM_RETRIES` times on transport errors (including timeouts)
+    and on the status codes `RETRY_STATUS_CODES`. Other methods are never retried.
+
+    :param app: Sanic app instance
+    :param upstream: The upstream name, e.g. `courses` or `login`
+    :param method: HTTP method
+    :param url: Request url
+    :param kwargs: Additional arguments of `httpx.AsyncClient.request`
+    :return: The response, may have an error status code
+    :raises CircuitOpenError: if the circuit breaker of the upstream is open
+    :raises httpx.TransportError: if the last attempt failed on transport level
+    """
+    circuit_breaker = get_circuit_breaker(app, upstream)
+    retries = int(get_config(app, 'UPSTREAM_RETRIES', 2)) if method.upper() == 'GET' else 0
+    attempt = 0
+    while True:
+        if not circuit_breaker.allow():
+            get_metrics(app).inc('tobira_auth_circuit_breaker_rejected_total', (('upstream', upstream),))
+            raise CircuitOpenError(upstream)
+        try:
+            response = await get_http_client(app).request(method, url, **kwargs)
+        except TransportError as e:
+            circuit_breaker.record_failure()
+            if attempt >= retries:
+                raise
+            logger.debug('%s: Retrying %s %s. %s: %s', upstream, method, url, type(e).__name__, e)
+        except BaseException:
+            circuit_breaker.release()
+            raise
+        else:
+            if response.status_code >= 500:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            if attempt >= retries or response.status_code not in RETRY_STATUS_CODES:
+                return response
+            logger.debug('%s: Retrying %s %s. Status: %s.', upstream, method, url, response.status_code)
+            await response.aclose()
+        attempt += 1
+        get_metrics(app).inc('tobira_auth_upstream_retries_total', (('upstream', upstream),))
+        await asyncio.sleep(retry_delay(app, attempt))
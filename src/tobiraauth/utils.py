@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hmac
+import os
+import tempfile
 from functools import lru_cache
-from typing import Any
+from typing import Any, Optional
 
-from sanic import Sanic
+from sanic import Request, Sanic
 
 
 @lru_cache(maxsize=32)
@@ -25,41 +28,50 @@ def get_config(app: Sanic, env_name: str, default: Any = None):
     return app.config.get(config_key, default)
 
 
-def is_admin(app: Sanic, username: str) -> bool:
-    """Return True, if the username is defined as admin in the config file.
+def check_private_dir(path: str):
+    """Raise `PermissionError`, if the directory is not owned by the service user or writable by others.
 
-    :app: Sanic app instance
-    :username: username to test
-    :return: True if the username is defined as admin, False otherwise.
+    :param path: The directory path
     """
-    if getattr(app.ctx, 'admin_users', None) is None:
-        admin_users_config = get_config(app=app, env_name='ADMIN_USERS_USERNAME', default=None)
-        if admin_users_config is not None:
-            if ',' in admin_users_config:
-                app.ctx.admin_users = [username.strip() for username in admin_users_config.split(',')
-                                       if username.strip() != '']
-            else:
-                app.ctx.admin_users = [admin_users_config,]
-        else:
-            app.ctx.admin_users = []
-    return username in app.ctx.admin_users
-
-
-def is_admin_mail(app: Sanic, mail: str) -> bool:
-    """Return True, if the email address is defined as admin in the config file.
-
-    :app: Sanic app instance
-    :mail: email address to test
-    :return: True if the email address is defined as admin, False otherwise.
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError(f'Directory {path} must be owned by the service user and not writable by others.')
+
+
+def get_private_dir(app: Sanic, env_name: Optional[str], name: str) -> str:
+    """Return the directory configured by `env_name` or the directory `name` in the runtime directory
+    of the service instance, create it on first use.
+
+    The runtime directory is `RUNTIME_DIRECTORY`, set by systemd for the `RuntimeDirectory` of the service,
+    or `<system temp directory>/<app name>-<uid>`. Other users may create directories in the temp directory,
+    so the directories are checked before they are used, see `check_private_dir`.
+
+    :param app: Sanic app instance
+    :param env_name: Name of the config value of the directory, None if it is not configurable
+    :param name: Name of the directory in the runtime directory
+    :return: directory path
+    :raises PermissionError: if the directory is owned by another user or writable by others
+    """
+    path = get_config(app, env_name, None) if env_name else None
+    if not path:
+        runtime_dir = os.environ.get('RUNTIME_DIRECTORY', '').split(':')[0]
+        if not runtime_dir:
+            runtime_dir = os.path.join(tempfile.gettempdir(), f'{format_env_name(app.name).lower()}-{os.getuid()}')
+            os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+            check_private_dir(runtime_dir)
+        path = os.path.join(runtime_dir, name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    check_private_dir(path)
+    return path
+
+
+def is_authorized(request: Request, token_env_name: str) -> bool:
+    """Return True, if the request has the `Authorization: Bearer <token>` header with the configured token.
+
+    :param request: The request
+    :param token_env_name: Name of the config value holding the token, requests are never authorized without token
+    :return: True, if the request is authorized
     """
-    if getattr(app.ctx, 'admin_users_mail', None) is None:
-        admin_users_mail_config = get_config(app=app, env_name='ADMIN_USERS_MAIL', default=None)
-        if admin_users_mail_config is not None:
-            if ',' in admin_users_mail_config:
-                app.ctx.admin_users_mail = [mail.strip() for mail in admin_users_mail_config.split(',')
-                                            if mail.strip() != '']
-            else:
-                app.ctx.admin_users_mail = [admin_users_mail_config,]
-        else:
-            app.ctx.admin_users_mail = []
-    return mail in app.ctx.admin_users_mail
+    token = get_config(request.app, token_env_name, None)
+    authorization = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
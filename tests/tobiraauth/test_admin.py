@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.admin import admin_bp, apply_pending_invalidations, get_invalidation_dir
+from tobiraauth.caching import MISSING, MemoryCacheBackend, get_cache_backend
+
+HEADERS = {'Authorization': 'Bearer secret'}
+
+
+@pytest.fixture
+def app(tmp_path):
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(admin_bp)
+    sanic_app.config.ADMIN_TOKEN = 'secret'
+    sanic_app.config.CACHE_INVALIDATION_DIR = str(tmp_path / 'invalidations')
+    return sanic_app
+
+
+def fill_caches(app: Sanic):
+    course_roles = get_cache_backend(app, 'user_course_roles')
+    course_roles.set_nowait('jane', ['ROLE_COURSE_1_LEARNER'], 300)
+    course_roles.set_nowait('bob', ['ROLE_COURSE_2_LEARNER'], 300)
+    responses = app.ctx.caches['auth_responses'] = MemoryCacheBackend('auth_responses')
+    responses.set_nowait(('jane', 'Jane', None, None, None, None, ()), b'{}', 300)
+    return course_roles, responses
+
+
+@pytest.mark.asyncio
+async def test_admin_requires_token(app):
+    request, response = await app.asgi_client.get('/admin/caches')
+    assert response.status == 401
+    request, response = await app.asgi_client.post('/admin/caches/clear', headers={'Authorization': 'Bearer x'})
+    assert response.status == 401
+
+
+@pytest.mark.asyncio
+async def test_admin_cache_stats(app):
+    course_roles, _ = fill_caches(app)
+    course_roles.get_nowait('jane')
+    course_roles.get_nowait('alice')
+    request, response = await app.asgi_client.get('/admin/caches', headers=HEADERS)
+    assert response.status == 200
+    stats = response.json['caches']['user_course_roles']
+    assert stats['size'] == 2
+    assert stats['hit_rate'] == 0.5
+    assert stats['age_seconds'] == {'60': 2, '300': 0, '900': 0, '3600': 0, '14400': 0, '86400': 0, '+Inf': 0}
+
+
+@pytest.mark.asyncio
+async def test_admin_invalidate_users(app):
+    course_roles, responses = fill_caches(app)
+    request, response = await app.asgi_client.post('/admin/caches/invalidate', headers=HEADERS,
+                                                    json={'username': 'jane'})
+    assert response.status == 200
+    assert response.json == {'usernames': ['jane'], 'invalidated': 2}
+    assert course_roles.get_nowait('jane') is MISSING
+    assert course_roles.get_nowait('bob') is not MISSING
+    assert len(responses._entries) == 0
+    assert len(os.listdir(app.config.CACHE_INVALIDATION_DIR)) == 1
+
+    request, response = await app.asgi_client.post('/admin/caches/invalidate', headers=HEADERS,
+                                                    json={'usernames': 'bob'})
+    assert response.status == 400
+
+
+@pytest.mark.asyncio
+async def test_admin_clear_caches(app):
+    course_roles, responses = fill_caches(app)
+    request, response = await app.asgi_client.post('/admin/caches/clear', headers=HEADERS)
+    assert response.status == 200
+    assert course_roles.get_nowait('bob') is MISSING
+    assert len(responses._entries) == 0
+
+
+@pytest.mark.asyncio
+async def test_invalidations_of_other_workers_are_applied(app):
+    course_roles, _ = fill_caches(app)
+    await apply_pending_invalidations(app)
+    invalidation_dir = app.config.CACHE_INVALIDATION_DIR
+    with open(os.path.join(invalidation_dir, f'{time.time_ns():020d}-1.json'), 'w') as f:
+        json.dump({'usernames': ['bob']}, f)
+    await apply_pending_invalidations(app)
+    assert course_roles.get_nowait('bob') is MISSING
+    assert course_roles.get_nowait('jane') is not MISSING
+    # Applied once only
+    course_roles.set_nowait('bob', [], 300)
+    await apply_pending_invalidations(app)
+    assert course_roles.get_nowait('bob') is not MISSING
+
+
+def test_invalidation_dir_in_runtime_directory(tmp_path, monkeypatch):
+    sanic_app = Sanic('test')
+    monkeypatch.setenv('RUNTIME_DIRECTORY', str(tmp_path))
+    assert get_invalidation_dir(sanic_app) == str(tmp_path / 'invalidations')
+    # Other users must not be able to publish invalidations.
+    os.chmod(tmp_path / 'invalidations', 0o777)
+    with pytest.raises(PermissionError):
+        get_invalidation_dir(sanic_app)
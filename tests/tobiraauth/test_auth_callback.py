@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import json
+import time
+
+import httpx
 import pytest
 from pytest_httpx import HTTPXMock
 from sanic import Sanic
 
-from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth import common
+from tobiraauth.auth_callback import auth_batch_bp, auth_callback_bp, get_response_cache
+from tobiraauth.caching import MISSING, MemoryCacheBackend, get_cache_backend
+from tobiraauth.common import compact_course_ids
 from tobiraauth.config import ConfigConstants
 
 
@@ -228,3 +236,159 @@ async def test_auth_callback_is_not_admin_user_mail(app):
     assert userdata.get('username') == headers.get(ConfigConstants.USERNAME_HEADER)
     roles = userdata.get('roles')
     assert 'ROLE_TOBIRA_ADMIN' not in roles
+
+
+@pytest.mark.asyncio
+async def test_auth_batch(app, httpx_mock: HTTPXMock):
+    app.blueprint(auth_batch_bp)
+    app.config['AUTH_BATCH_CONCURRENCY'] = 2
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/batch-jane/courses', json=[1])
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/batch-bob/courses', json=[2])
+    users = [
+        {'username': 'batch-jane', 'displayName': 'Jane Doe', 'email': 'jane@edu.org', 'affiliations': 'staff'},
+        {'email': 'nobody@edu.org'},
+        {'username': 'batch-bob', 'givenName': 'Bob', 'surname': 'Doe', 'affiliations': ['member', 'student']},
+    ]
+    request, response = await app.asgi_client.post('/auth/batch', json=users)
+    assert response.status == 200
+    assert response.content_type == 'application/x-ndjson'
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert len(results) == 3
+    assert results[0].get('username') == 'batch-jane'
+    assert results[0].get('displayName') == 'Jane Doe'
+    assert 'ROLE_TOBIRA_UPLOAD' in results[0].get('roles')
+    assert 'ROLE_COURSE_1_Learner' in results[0].get('roles')
+    assert results[1].get('outcome') == 'no-user'
+    assert results[2].get('displayName') == 'Bob Doe'
+    assert 'ROLE_TOBIRA_UPLOAD' not in results[2].get('roles')
+    assert 'ROLE_COURSE_2_Learner' in results[2].get('roles')
+
+
+@pytest.mark.asyncio
+async def test_auth_batch_invalid_body(app):
+    app.blueprint(auth_batch_bp)
+    request, response = await app.asgi_client.post('/auth/batch', json={'username': 'jane'})
+    assert response.status == 400
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_response_cache(app, httpx_mock: HTTPXMock):
+    app.config['AUTH_RESPONSE_CACHE'] = True
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/jane/courses', json=[1])
+    headers = {
+        ConfigConstants.USERNAME_HEADER: 'jane',
+        ConfigConstants.DISPLAY_NAME_HEADER: 'Jane Doe',
+    }
+    request, first_response = await app.asgi_client.get('/auth', headers=headers)
+    request, second_response = await app.asgi_client.get('/auth', headers=headers)
+    assert first_response.body == second_response.body
+    assert 'ROLE_COURSE_1_Learner' in second_response.json.get('roles')
+    response_cache = app.ctx.caches['auth_responses']
+    assert response_cache.hits == 1
+
+    # Other identity header values are cached separately.
+    headers[ConfigConstants.DISPLAY_NAME_HEADER] = 'Jane Roe'
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert response.json.get('displayName') == 'Jane Roe'
+    assert response_cache.hits == 1
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_response_cache_negative_result(app, httpx_mock: HTTPXMock):
+    app.config['AUTH_RESPONSE_CACHE'] = True
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/jane/courses', status_code=503)
+    headers = {ConfigConstants.USERNAME_HEADER: 'jane'}
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert response.status == 200
+    assert 'ROLE_USER_JANE' in response.json.get('roles')
+    entry = app.ctx.caches['auth_responses'].get_nowait(('jane', None, None, None, None, None, ()))
+    assert entry.negative
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_response_cache_time_to_live(app, httpx_mock: HTTPXMock):
+    app.config['AUTH_RESPONSE_CACHE'] = True
+    # Refresh of the stale course IDs
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/bob/courses', json=[1])
+    app.config['CACHE_USER_COURSE_ROLES_TIME_TO_LIVE'] = 60
+    course_ids = get_cache_backend(app, 'user_course_roles')
+    course_ids.set_nowait('jane', (1,), 5)
+    course_ids.set_nowait('bob', (1,), -1, stale_time_to_live=60)
+    response_cache = get_response_cache(app)
+    assert response_cache.time_to_live == 60
+    for username in ('jane', 'bob'):
+        request, response = await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: username})
+        assert 'ROLE_COURSE_1_Learner' in response.json.get('roles')
+    # Responses expire with the course IDs they are built from, responses of stale course IDs are not cached.
+    entry = response_cache.get_nowait(('jane', None, None, None, None, None, ()))
+    assert entry.fresh_until <= time.time() + 5
+    assert response_cache.get_nowait(('bob', None, None, None, None, None, ())) is MISSING
+    await asyncio.sleep(0.01)
+
+
+def test_response_cache_config(app, tmp_path):
+    app.config['AUTH_RESPONSE_CACHE'] = True
+    app.config['CACHE_BACKEND'] = 'sqlite'
+    app.config['CACHE_SQLITE_PATH'] = str(tmp_path / 'cache.sqlite')
+    app.config['CACHE_MAXSIZE'] = 500
+    app.config['CACHE_AUTH_RESPONSES_TIME_TO_LIVE'] = 30
+    app.config['CACHE_AUTH_RESPONSES_POLICY'] = 'lfu'
+    response_cache = get_response_cache(app)
+    # The responses are cached in memory, configured like the other caches.
+    assert isinstance(response_cache, MemoryCacheBackend)
+    assert (response_cache.maxsize, response_cache.time_to_live, response_cache.policy) == (500, 30, 'lfu')
+    assert app.ctx.caches['auth_responses'] is response_cache
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('response_cache', [False, True])
+async def test_auth_callback_latency_budget(app, httpx_mock: HTTPXMock, response_cache):
+    app.config['AUTH_LATENCY_BUDGET'] = 0.05
+    app.config['AUTH_RESPONSE_CACHE'] = response_cache
+
+    async def slow_courses(request: httpx.Request):
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json=[1])
+
+    httpx_mock.add_callback(slow_courses, method='GET', url='http://localhost:4567/user/jane/courses')
+    headers = {ConfigConstants.USERNAME_HEADER: 'jane'}
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    roles = response.json.get('roles')
+    assert 'ROLE_USER_JANE' in roles
+    assert 'ROLE_COURSE_1_Learner' not in roles
+    assert app.ctx.metrics.counters[('tobira_auth_latency_budget_exceeded_total', ())] == 1
+
+    # The course lookup completed in the background and filled the cache.
+    await asyncio.sleep(0.3)
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert 'ROLE_COURSE_1_Learner' in response.json.get('roles')
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_caches_compact_course_ids(app, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/jane/courses', json=[1001, '1002', '007'])
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/bob/courses', json=['1001'])
+    for username in ('jane', 'bob'):
+        request, response = await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: username})
+        assert response.status == 200
+    roles = (await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: 'jane'}))[1].json['roles']
+    assert {'ROLE_COURSE_1001_Learner', 'ROLE_COURSE_1002_Learner', 'ROLE_COURSE_007_Learner'} <= set(roles)
+    cache = app.ctx.caches['user_course_roles']
+    jane_course_ids = cache.get_nowait('jane').value
+    bob_course_ids = cache.get_nowait('bob').value
+    assert jane_course_ids == (1001, 1002, '007')
+    # Course IDs are shared between the cached entries of all users.
+    assert jane_course_ids[0] is bob_course_ids[0]
+
+
+def test_compact_course_ids_bounded(monkeypatch):
+    monkeypatch.setattr(common, 'COURSE_IDS', {})
+    monkeypatch.setattr(common, 'COURSE_IDS_MAXSIZE', 3)
+    assert compact_course_ids(['1', '2', 'a']) == (1, 2, 'a')
+    assert compact_course_ids(['1', '2']) == (1, 2)
+    assert len(common.COURSE_IDS) == 3
+    # A new course ID clears the full table.
+    assert compact_course_ids(['3', 'a']) == (3, 'a')
+    assert common.COURSE_IDS == {3: 3, 'a': 'a'}
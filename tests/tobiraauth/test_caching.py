@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.caching import MISSING, MemoryCacheBackend, RefreshAheadScheduler, SQLiteCacheBackend, cached, \
+    create_cache_backend, get_cache_backend, get_refresh_ahead, get_single_flight, run_refresh_ahead
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    return sanic_app
+
+
+class DummyRequest:
+    def __init__(self, app):
+        self.app = app
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_lru_eviction():
+    cache = MemoryCacheBackend('test', maxsize=2)
+    await cache.set('a', 1, 300)
+    await cache.set('b', 2, 300)
+    assert (await cache.get('a')).value == 1
+    await cache.set('c', 3, 300)
+    assert await cache.get('b') is MISSING
+    assert (await cache.get('a')).value == 1
+    assert (await cache.get('c')).value == 3
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_expiration():
+    cache = MemoryCacheBackend('test')
+    await cache.set('a', 1, -1)
+    assert await cache.get('a') is MISSING
+    await cache.set('b', 2, None)
+    assert (await cache.get('b')).value == 2
+
+
+def test_memory_cache_lfu_admission_resists_scans():
+    cache = MemoryCacheBackend('test', maxsize=100, policy='lfu')
+    for _ in range(3):
+        for i in range(100):
+            if cache.get_nowait(f'hot{i}') is MISSING:
+                cache.set_nowait(f'hot{i}', i, 300)
+    # A scan over users seen once, e.g. by a batch job, does not displace the frequently used entries.
+    # The frequencies are approximate, a few scanned entries may be admitted.
+    hot_misses = 0
+    for i in range(1000):
+        if cache.get_nowait(f'scan{i}') is MISSING:
+            cache.set_nowait(f'scan{i}', i, 300)
+        if cache.get_nowait(f'hot{i % 100}') is MISSING:
+            hot_misses += 1
+            cache.set_nowait(f'hot{i % 100}', i, 300)
+    assert hot_misses <= 20
+    assert cache.rejections >= 980
+
+    lru_cache = MemoryCacheBackend('test', maxsize=100)
+    for i in range(100):
+        lru_cache.set_nowait(f'hot{i}', i, 300)
+    for i in range(1000):
+        lru_cache.set_nowait(f'scan{i}', i, 300)
+    assert all(lru_cache.get_nowait(f'hot{i}') is MISSING for i in range(100))
+
+
+def test_memory_cache_max_bytes():
+    cache = MemoryCacheBackend('test', maxsize=None, max_bytes=2000)
+    for i in range(10):
+        cache.set_nowait(f'user{i}', ['ROLE_COURSE_1_Learner'] * 3, 300)
+    assert 0 < cache.bytes <= 2000
+    assert cache.size < 10
+    assert cache.get_nowait('user9') is not MISSING
+    assert cache.evictions == 10 - cache.size
+    cache.set_nowait('large', 'x' * 5000, 300)
+    assert cache.get_nowait('large') is MISSING
+    assert cache.rejections == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_backend_config(app):
+    app.config.CACHE_MAXSIZE = 10
+    app.config.CACHE_TEST_MAXSIZE = 20
+    app.config.CACHE_TEST_TIME_TO_LIVE = '3600'
+    app.config.CACHE_TEST_POLICY = 'LFU'
+    app.config.CACHE_MAX_BYTES = 4096
+    cache = get_cache_backend(app, 'test', maxsize=1024, time_to_live=300)
+    assert (cache.maxsize, cache.time_to_live, cache.policy, cache.max_bytes) == (20, 3600.0, 'lfu', 4096)
+    other = get_cache_backend(app, 'other', maxsize=1024, time_to_live=300)
+    assert (other.maxsize, other.time_to_live, other.policy) == (10, 300.0, 'lru')
+    stats = await cache.stats()
+    assert stats['policy'] == 'lfu'
+    assert stats['bytes'] == 0
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    worker_1 = SQLiteCacheBackend('test', maxsize=2, path=path)
+    worker_2 = SQLiteCacheBackend('test', maxsize=2, path=path)
+    await worker_1.set('a', ['ROLE_A'], 300)
+    assert (await worker_2.get('a')).value == ['ROLE_A']
+    await worker_2.set('b', ['ROLE_B'], 300)
+    await worker_1.set('c', ['ROLE_C'], 300)
+    assert await worker_2.get('a') is MISSING
+    assert (await worker_2.get('b')).value == ['ROLE_B']
+    assert (await worker_1.get('c')).value == ['ROLE_C']
+    await worker_2.set('d', ['ROLE_D'], -1)
+    assert await worker_1.get('d') is MISSING
+    await worker_1.clear()
+    assert await worker_2.get('c') is MISSING
+    worker_1.close()
+    worker_2.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_evicts_beyond_margin(tmp_path):
+    cache = SQLiteCacheBackend('test', maxsize=100, path=str(tmp_path / 'cache.sqlite'))
+    for i in range(50):
+        await cache.set(f'user{i}', [i], 300)
+    # Hits update the access times in batches, the recently used entries are kept.
+    for i in range(10):
+        assert (await cache.get(f'user{i}')).value == [i]
+    for i in range(50, 130):
+        await cache.set(f'user{i}', [i], 300)
+    size = (await cache.stats())['size']
+    assert 100 <= size <= 100 + cache.eviction_margin
+    assert cache.evictions == 130 - size
+    assert (await cache.get('user0')).value == [0]
+    assert await cache.get('user10') is MISSING
+    assert (await cache.get('user129')).value == [129]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_private_path(app, tmp_path, monkeypatch):
+    app.config.CACHE_BACKEND = 'sqlite'
+    monkeypatch.setenv('RUNTIME_DIRECTORY', str(tmp_path))
+    cache = create_cache_backend(app, 'test', 16)
+    assert cache.path == str(tmp_path / 'cache' / 'cache.sqlite')
+    await cache.set('jane', ['ROLE_A'], 300)
+    assert os.stat(cache.path).st_mode & 0o777 == 0o600
+    cache.close()
+    # A database file accessible by other users, e.g. created by another user, is not used.
+    path = tmp_path / 'shared.sqlite'
+    path.touch(mode=0o666)
+    os.chmod(path, 0o666)
+    cache = SQLiteCacheBackend('test', path=str(path))
+    with pytest.raises(PermissionError):
+        await cache.get('jane')
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator(app, tmp_path):
+    app.config.CACHE_BACKEND = 'sqlite'
+    app.config.CACHE_SQLITE_PATH = str(tmp_path / 'cache.sqlite')
+    calls = []
+
+    @cached('test', time_to_live=300, maxsize=16)
+    async def lookup(request, username):
+        calls.append(username)
+        return [username]
+
+    request = DummyRequest(app)
+    assert await lookup(request, 'jane') == ['jane']
+    assert await lookup(request, 'jane') == ['jane']
+    assert await lookup(request, 'bob') == ['bob']
+    assert calls == ['jane', 'bob']
+    assert isinstance(get_cache_backend(app, 'test'), SQLiteCacheBackend)
+    get_cache_backend(app, 'test').close()
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator_coalesces_concurrent_misses(app):
+    calls = []
+    release = asyncio.Event()
+
+    @cached('test', time_to_live=300, maxsize=16)
+    async def lookup(request, username):
+        calls.append(username)
+        await release.wait()
+        return [username]
+
+    request = DummyRequest(app)
+    lookups = [asyncio.ensure_future(lookup(request, 'jane')) for _ in range(5)]
+    lookups.append(asyncio.ensure_future(lookup(request, 'bob')))
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*lookups)
+    assert results == [['jane']] * 5 + [['bob']]
+    assert calls == ['jane', 'bob']
+    single_flight = get_single_flight(app, 'test')
+    assert single_flight.calls == 2
+    assert single_flight.coalesced == 4
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator_negative_result(app):
+    calls = []
+
+    @cached('test', time_to_live=300, negative_time_to_live=300, negative_value=list)
+    async def lookup(request, username):
+        calls.append(username)
+        raise ConnectionError()
+
+    request = DummyRequest(app)
+    assert await lookup(request, 'jane') == []
+    assert await lookup(request, 'jane') == []
+    assert calls == ['jane']
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator_stale_while_revalidate(app):
+    results = [['ROLE_A'], ConnectionError(), ['ROLE_B']]
+
+    @cached('test', time_to_live=-1, stale_time_to_live=300)
+    async def lookup(request, username):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    request = DummyRequest(app)
+    assert await lookup(request, 'jane') == ['ROLE_A']
+    # The entry is stale, the failing refresh keeps the stale value.
+    assert await lookup(request, 'jane') == ['ROLE_A']
+    await asyncio.sleep(0.01)
+    assert await lookup(request, 'jane') == ['ROLE_A']
+    await asyncio.sleep(0.01)
+    assert await lookup(request, 'jane') == ['ROLE_B']
+    assert results == []
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator_miss_during_refresh(app):
+    calls = []
+    release = asyncio.Event()
+
+    @cached('test', time_to_live=0.05, stale_time_to_live=300)
+    async def lookup(request, username):
+        calls.append(username)
+        if len(calls) == 2:
+            await release.wait()
+        return [f'ROLE_{len(calls)}']
+
+    request = DummyRequest(app)
+    assert await lookup(request, 'jane') == ['ROLE_1']
+    await asyncio.sleep(0.06)
+    # The stale entry is returned, its refresh is still running when the entry is invalidated.
+    assert await lookup(request, 'jane') == ['ROLE_1']
+    await asyncio.sleep(0)
+    await get_cache_backend(app, 'test').delete('jane')
+    # The miss does not await the refresh.
+    assert await asyncio.wait_for(lookup(request, 'jane'), 1.0) == ['ROLE_3']
+    release.set()
+    await asyncio.sleep(0.01)
+    assert calls == ['jane'] * 3
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_bytes(tmp_path):
+    cache = SQLiteCacheBackend('test', path=str(tmp_path / 'cache.sqlite'))
+    await cache.set('a', b'{"outcome":"user"}', 300)
+    assert (await cache.get('a')).value == b'{"outcome":"user"}'
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_negative_entry(tmp_path):
+    cache = SQLiteCacheBackend('test', path=str(tmp_path / 'cache.sqlite'))
+    await cache.set('a', [], 300, negative=True)
+    await cache.set('b', ['ROLE_A'], 300)
+    assert (await cache.get('a')).negative
+    assert not (await cache.get('b')).negative
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_invalidate_and_stats(tmp_path):
+    cache = SQLiteCacheBackend('test', path=str(tmp_path / 'cache.sqlite'))
+    for key in ('jane', 'jane\x1fcourse', 'janet', 'bob'):
+        await cache.set(key, [key], 300)
+    assert await cache.invalidate(['jane', 'alice']) == 2
+    assert await cache.get('jane') is MISSING
+    assert (await cache.get('janet')).value == ['janet']
+    stats = await cache.stats()
+    assert stats['size'] == 2
+    assert stats['age_seconds']['60'] == 2
+    assert stats['hit_rate'] == 0.5
+    cache.close()
+
+
+def test_refresh_ahead_scheduler_due():
+    scheduler = RefreshAheadScheduler('test', window=10, min_accesses=2)
+    for key in ('hot', 'cold'):
+        scheduler.touch(key, (key,))
+        scheduler.loaded(key, 100)
+    scheduler.touch('hot', ('hot',))
+    scheduler.touch('hot', ('hot',))
+    scheduler.touch('cold', ('cold',))
+    assert scheduler.due(80, 10) == []
+    assert scheduler.due(95, 10) == [('hot', ('hot',))]
+    # Due keys are not due again until they are loaded.
+    assert scheduler.due(95, 10) == []
+    # Rarely used keys are dropped after they expired.
+    scheduler.due(101, 10)
+    assert len(scheduler) == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_decorator_refresh_ahead(app):
+    app.config.REFRESH_AHEAD = True
+    app.config.REFRESH_AHEAD_INTERVAL = 0.01
+    app.config.REFRESH_AHEAD_WINDOW = 60
+    calls = []
+
+    @cached('test', time_to_live=30, maxsize=5000, refresh_ahead=True)
+    async def lookup(request, username):
+        calls.append(username)
+        assert request.app is app
+        return [f'ROLE_{len(calls)}']
+
+    request = DummyRequest(app)
+    for _ in range(3):
+        assert await lookup(request, 'jane') == ['ROLE_1']
+    task = asyncio.ensure_future(run_refresh_ahead(app))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert calls == ['jane', 'jane']
+    assert await lookup(request, 'jane') == ['ROLE_2']
+    scheduler = get_refresh_ahead(app, 'test')
+    assert scheduler.refreshes == 1
+    # The scheduler tracks as many keys as the cache holds and keeps the arguments, not the requests.
+    assert scheduler.maxsize == 5000
+    assert scheduler._keys['jane'][2] == ('jane',)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from pytest_httpx import HTTPXMock
+from sanic import Sanic
+
+from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth.config import ConfigConstants
+from tobiraauth.common import register_callback_listeners
+from tobiraauth.course_index import CourseIndex, CourseIndexProvider, build_course_index, get_course_index, \
+    update_course_index
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(auth_callback_bp)
+    register_callback_listeners(sanic_app)
+    sanic_app.config.USER_COURSES_WS_URL = 'http://localhost:4567/user/{username}/courses'
+    return sanic_app
+
+
+def test_course_index_csv(tmp_path):
+    export_path = tmp_path / 'courses.csv'
+    export_path.write_text('username,course_id\njane,1\njane,2\nbob,3\njane,2\n')
+    index_path = str(tmp_path / 'courses.idx')
+    build_course_index(str(export_path), index_path)
+    index = CourseIndex(index_path)
+    assert index.lookup('jane') == ['1', '2']
+    assert index.lookup('bob') == ['3']
+    assert index.lookup('alice') is None
+    index.close()
+
+
+def test_course_index_reload(tmp_path):
+    export_path = tmp_path / 'courses.jsonl'
+    export_path.write_text('{"username": "jane", "courses": [1, 2]}\n{"username": "bob", "courses": []}\n')
+    provider = CourseIndexProvider(str(export_path), str(tmp_path / 'courses.idx'))
+    provider.refresh()
+    assert provider.lookup('jane') == ['1', '2']
+    assert provider.lookup('bob') == []
+    other_worker = CourseIndexProvider(str(export_path), str(tmp_path / 'courses.idx'))
+    other_worker.refresh()
+    assert other_worker.lookup('jane') == ['1', '2']
+
+    export_path.write_text('{"username": "jane", "courses": [5]}\n')
+    os.utime(export_path, ns=(0, 1))
+    provider.refresh()
+    assert provider.lookup('jane') == ['5']
+    assert provider.lookup('bob') is None
+    other_worker.refresh()
+    assert other_worker.lookup('jane') == ['5']
+    provider.close()
+    other_worker.close()
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_course_index(app, tmp_path, httpx_mock: HTTPXMock):
+    export_path = tmp_path / 'courses.csv'
+    export_path.write_text('index-jane,7\n')
+    build_course_index(str(export_path), f'{export_path}.idx')
+    app.config['COURSE_INDEX_EXPORT_PATH'] = str(export_path)
+    headers = {
+        ConfigConstants.USERNAME_HEADER: 'index-jane',
+    }
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert 'ROLE_COURSE_7_Learner' in response.json.get('roles')
+    assert len(httpx_mock.get_requests()) == 0
+
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/index-bob/courses', json=[8])
+    headers = {
+        ConfigConstants.USERNAME_HEADER: 'index-bob',
+    }
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert 'ROLE_COURSE_8_Learner' in response.json.get('roles')
+
+
+@pytest.mark.asyncio
+async def test_course_index_not_built_on_request_path(app, tmp_path):
+    export_path = tmp_path / 'courses.csv'
+    export_path.write_text('index-jane,7\n')
+    app.config['COURSE_INDEX_EXPORT_PATH'] = str(export_path)
+    provider = get_course_index(app)
+    # Users are looked up by the course webservice until the index is built in the background.
+    assert provider.lookup('index-jane') is None
+    assert not os.path.exists(f'{export_path}.idx')
+    await update_course_index(provider)
+    assert provider.lookup('index-jane') == ['7']
+    provider.close()
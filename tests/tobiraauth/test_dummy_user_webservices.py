@@ -41,3 +41,20 @@ async def test_get_user_courses(app):
     assert 2 in course_list
     assert 3 in course_list
     assert 4 in course_list
+
+
+@pytest.mark.asyncio
+async def test_get_user_courses_injected_errors(app):
+    app.config['DUMMY_USER_SERVICE_ERROR_RATE'] = 1
+    request, response = await app.asgi_client.get('/user/anyuser/courses')
+    assert response.status == 503
+
+
+@pytest.mark.asyncio
+async def test_login_user_backend_bench_user(app):
+    data = {
+        'password': 'opencast'
+    }
+    request, response = await app.asgi_client.post('/user/login/bench-1', data=data)
+    assert response.status == 200
+    assert response.json.get('username') == 'bench-1'
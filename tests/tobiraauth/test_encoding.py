@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+
+from tobiraauth.encoding import NO_USER, get_json_encoder, stdlib_dumps
+
+
+def test_no_user_payload():
+    assert json.loads(NO_USER) == {'outcome': 'no-user'}
+
+
+def test_json_encoders():
+    data = {'outcome': 'user', 'displayName': 'Jürgen', 'email': None, 'roles': ['ROLE_USER']}
+    for name in ('auto', 'orjson', 'json', 'unknown'):
+        encoded = get_json_encoder(name)(data)
+        assert isinstance(encoded, bytes)
+        assert json.loads(encoded) == data
+    assert get_json_encoder('json') is stdlib_dumps
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pytest
+from sanic import Sanic
+
+from tobiraauth.http_client import close_http_client, get_http_client, setup_http_client
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    return sanic_app
+
+
+@pytest.mark.asyncio
+async def test_http_client_is_reused(app):
+    await setup_http_client(app)
+    http_client = get_http_client(app)
+    assert get_http_client(app) is http_client
+    await close_http_client(app)
+    assert http_client.is_closed
+    assert get_http_client(app) is not http_client
+
+
+@pytest.mark.asyncio
+async def test_http_client_config(app):
+    app.config.HTTP_CLIENT_TIMEOUT = 3
+    app.config.HTTP_CLIENT_CONNECT_TIMEOUT = 1
+    await setup_http_client(app)
+    http_client = get_http_client(app)
+    assert http_client.timeout.read == 3
+    assert http_client.timeout.connect == 1
+    await close_http_client(app)
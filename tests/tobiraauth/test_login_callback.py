@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import time
+
 import pytest
 from pytest_httpx import HTTPXMock
 from sanic import Sanic
 
+from tobiraauth.caching import MISSING, get_cache_backend
 from tobiraauth.login_callback import login_callback_bp
 
 
@@ -83,3 +86,54 @@ async def test_login_callback_invalid_password(app, httpx_mock: HTTPXMock):
     userdata = response.json
     assert userdata.get('outcome') == 'no-user'
     assert 'username' not in userdata
+
+
+@pytest.mark.asyncio
+async def test_login_callback_credential_cache(app, httpx_mock: HTTPXMock):
+    login_ws_response = {
+        'username': 'jane_cached',
+        'given_name': 'Jane',
+        'sur_name': 'Doe',
+        'email': 'jane@edu.org',
+    }
+    httpx_mock.add_response(method='POST', url='http://localhost:4567/user/login/jane_cached',
+                            json=login_ws_response)
+    data = {
+        'userid': 'jane_cached',
+        'password': 'secret'
+    }
+    request, response = await app.asgi_client.post('/login', json=data)
+    assert response.json.get('outcome') == 'user'
+    # A wrong password is checked by the login webservice, but must not replace the verified credentials.
+    httpx_mock.reset(assert_all_responses_were_requested=True)
+    httpx_mock.add_response(method='POST', url='http://localhost:4567/user/login/jane_cached', status_code=401)
+    request, response = await app.asgi_client.post('/login', json={'userid': 'jane_cached', 'password': 'wrong'})
+    assert response.json.get('outcome') == 'no-user'
+    httpx_mock.reset(assert_all_responses_were_requested=True)
+    request, response = await app.asgi_client.post('/login', json=data)
+    assert response.json.get('outcome') == 'user'
+    assert response.json.get('displayName') == 'Jane Doe'
+    assert len(httpx_mock.get_requests()) == 0
+
+
+@pytest.mark.asyncio
+async def test_login_callback_payload_cache_time_to_live(app, httpx_mock: HTTPXMock):
+    app.config.USER_COURSES_WS_URL = 'http://localhost:4567/user/{username}/courses'
+    httpx_mock.add_response(method='POST', url='http://localhost:4567/user/login/jane', json={
+        'username': 'jane', 'given_name': 'Jane', 'sur_name': 'Doe', 'email': 'jane@edu.org',
+    })
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/jane/courses', status_code=500)
+    data = {'userid': 'jane', 'password': 'secret'}
+    request, response = await app.asgi_client.post('/login', json=data)
+    assert response.json.get('outcome') == 'user'
+    assert not any(role.startswith('ROLE_COURSE_') for role in response.json.get('roles'))
+    # Payloads built from fallback roles are not cached.
+    payloads = get_cache_backend(app, 'login_payloads')
+    assert payloads.get_nowait('jane') is MISSING
+
+    # The course roles expire in 5 seconds, the payload does not outlive them.
+    course_ids = get_cache_backend(app, 'user_course_roles')
+    course_ids.set_nowait('jane', ('1',), 5)
+    request, response = await app.asgi_client.post('/login', json=data)
+    assert 'ROLE_COURSE_1_Learner' in response.json.get('roles')
+    assert payloads.get_nowait('jane').fresh_until <= time.time() + 5
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth.config import ConfigConstants
+from tobiraauth.logs import access_logger, setup_logging, stop_logging
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((self.format(record), threading.current_thread()))
+
+
+@pytest.fixture
+def handler():
+    collecting_handler = CollectingHandler()
+    access_logger.addHandler(collecting_handler)
+    access_logger.setLevel(logging.INFO)
+    yield collecting_handler
+    access_logger.removeHandler(collecting_handler)
+
+
+@pytest.mark.asyncio
+async def test_queue_logging(handler):
+    app = Sanic('test')
+    await setup_logging(app)
+    access_logger.info('Hello %s', 'world')
+    await stop_logging(app)
+    message, thread = handler.records[0]
+    assert message == 'Hello world'
+    assert thread is not threading.current_thread()
+    assert access_logger.handlers == [handler]
+
+
+@pytest.mark.asyncio
+async def test_json_access_log(handler):
+    app = Sanic('test')
+    app.blueprint(auth_callback_bp)
+    app.config.ACCESS_LOG_JSON = True
+    app.before_server_start(setup_logging)
+    app.after_server_stop(stop_logging)
+    request, response = await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: 'jane'})
+    assert response.status == 200
+    entry = json.loads(handler.records[-1][0])
+    assert entry['path'] == '/auth'
+    assert entry['status'] == 200
+    assert entry['duration_ms'] > 0
+
+    app.config.ACCESS_LOG_SAMPLE_RATE = 0
+    handler.records.clear()
+    request, response = await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: 'jane'})
+    assert handler.records == []
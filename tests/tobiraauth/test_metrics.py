@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from pytest_httpx import HTTPXMock
+from sanic import Sanic
+
+from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth.config import ConfigConstants
+from tobiraauth.metrics import Metrics, collect, get_metrics_dir, metrics_bp, render
+
+
+@pytest.fixture
+def app(tmp_path):
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(auth_callback_bp)
+    sanic_app.blueprint(metrics_bp)
+    sanic_app.config.USER_COURSES_WS_URL = 'http://localhost:4567/user/{username}/courses'
+    sanic_app.config.METRICS_DIR = str(tmp_path)
+    return sanic_app
+
+
+def test_render_histogram():
+    metrics = Metrics()
+    metrics.observe('tobira_auth_request_duration_seconds', 0.003, (('endpoint', '/auth/'),))
+    metrics.observe('tobira_auth_request_duration_seconds', 20, (('endpoint', '/auth/'),))
+    output = render(metrics)
+    assert 'tobira_auth_request_duration_seconds_bucket{endpoint="/auth/",le="0.0025"} 0' in output
+    assert 'tobira_auth_request_duration_seconds_bucket{endpoint="/auth/",le="0.005"} 1' in output
+    assert 'tobira_auth_request_duration_seconds_bucket{endpoint="/auth/",le="+Inf"} 2' in output
+    assert 'tobira_auth_request_duration_seconds_count{endpoint="/auth/"} 2' in output
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(app, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method='GET', url='http://localhost:4567/user/metrics-jane/courses', status_code=500)
+    headers = {
+        ConfigConstants.USERNAME_HEADER: 'metrics-jane',
+    }
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert response.status == 200
+    request, response = await app.asgi_client.get('/metrics')
+    assert response.status == 200
+    assert response.content_type.startswith('text/plain')
+    output = response.text
+    assert 'tobira_auth_requests_total{endpoint="/auth/",status="200"} 1' in output
+    assert 'tobira_auth_stage_duration_seconds_count{stage="header_parsing"} 1' in output
+    assert 'tobira_auth_stage_duration_seconds_count{stage="course_roles_upstream"} 1' in output
+    assert 'tobira_auth_upstream_responses_total{upstream="courses",status="500"} 1' in output
+    assert 'tobira_auth_cache_misses_total{cache="user_course_roles"} 1' in output
+
+
+def test_collect_snapshots_of_stopped_workers(app, tmp_path, monkeypatch):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    with open(tmp_path / f'{process.pid}.json', 'w') as f:
+        json.dump({'pid': process.pid, 'counters': [['tobira_auth_requests_total', [], 1]], 'histograms': []}, f)
+
+    def removed_by_other_worker(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, 'remove', removed_by_other_worker)
+    assert collect(app).counters == {}
+
+
+def test_metrics_dir_in_runtime_directory(tmp_path, monkeypatch):
+    sanic_app = Sanic('test')
+    monkeypatch.setenv('RUNTIME_DIRECTORY', str(tmp_path))
+    assert get_metrics_dir(sanic_app) == str(tmp_path / 'metrics')
+    # Directories writable by other users are not trusted.
+    os.chmod(tmp_path / 'metrics', 0o777)
+    with pytest.raises(PermissionError):
+        get_metrics_dir(sanic_app)
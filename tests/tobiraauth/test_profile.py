@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pytest
+from sanic import Sanic
+
+from tobiraauth.config import ConfigConstants
+from tobiraauth.profile import compile_request_profile, get_request_profile
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    return sanic_app
+
+
+def test_request_profile_defaults(app):
+    profile = compile_request_profile(app)
+    assert profile.username_header == ConfigConstants.USERNAME_HEADER
+    assert profile.home_organization_header == ConfigConstants.HOME_ORGANIZATION_HEADER
+    assert profile.format_display_name(given_name='Jane', surname='Doe') == 'Jane Doe'
+    assert profile.static_roles == ()
+    assert profile.templated_roles == ()
+
+
+def test_request_profile_custom_roles(app):
+    app.config['CUSTOM_ROLES'] = 'ROLE_A, ROLE_USER_{username}, ,ROLE_B,ROLE_ORG_{home_organization}'
+    profile = compile_request_profile(app)
+    assert profile.static_roles == ('ROLE_A', 'ROLE_B')
+    roles = [format_role(username='jane', email=None, home_organization='edu.org')
+             for format_role in profile.templated_roles]
+    assert roles == ['ROLE_USER_jane', 'ROLE_ORG_edu.org']
+
+
+def test_request_profile_is_cached(app):
+    app.config['USERNAME_HEADER'] = 'X-User'
+    profile = get_request_profile(app)
+    assert profile.username_header == 'X-User'
+    assert get_request_profile(app) is profile
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.profiling import LoopLagMonitor, profiling_bp
+
+HEADERS = {'Authorization': 'Bearer secret'}
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(profiling_bp)
+    sanic_app.config.PROFILING_TOKEN = 'secret'
+    return sanic_app
+
+
+@pytest.mark.asyncio
+async def test_profiling_requires_token(app):
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.01})
+    assert response.status == 401
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.01},
+                                                   headers={'Authorization': 'Bearer wrong'})
+    assert response.status == 401
+    app.config.PROFILING_TOKEN = ''
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.01},
+                                                   headers={'Authorization': 'Bearer '})
+    assert response.status == 401
+
+
+@pytest.mark.asyncio
+async def test_profiling_rejects_invalid_arguments(app):
+    app.config.PROFILING_MAX_SECONDS = 1
+    for params in ({'seconds': 2}, {'seconds': 'x'}, {'seconds': 0.01, 'mode': 'unknown'}):
+        request, response = await app.asgi_client.get('/profiling/', params=params, headers=HEADERS)
+        assert response.status == 400
+
+
+@pytest.mark.asyncio
+async def test_profiling_sample(app):
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.1}, headers=HEADERS)
+    assert response.status == 200
+    lines = response.text.splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+    assert ';' in stack
+
+
+@pytest.mark.asyncio
+async def test_profiling_pstats(app):
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.05, 'mode': 'pstats'},
+                                                   headers=HEADERS)
+    assert response.status == 200
+    assert 'function calls' in response.text
+
+
+@pytest.mark.asyncio
+async def test_profiling_lag(app):
+    request, response = await app.asgi_client.get('/profiling/', params={'seconds': 0.05, 'mode': 'lag'},
+                                                   headers=HEADERS)
+    assert response.status == 200
+    assert response.json['events'] == []
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_reports_blocking_coroutine():
+    async def blocking_coroutine():
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+
+    monitor = LoopLagMonitor(threading.get_ident(), threshold=0.1)
+    monitor.start()
+    try:
+        await asyncio.gather(monitor.run_heartbeat(0.4), blocking_coroutine())
+    finally:
+        monitor.stop()
+    assert len(monitor.events) == 1
+    event = monitor.events[0]
+    assert event['lag'] >= 0.15
+    assert event['coroutine'].endswith('blocking_coroutine')
+    assert 'blocking_coroutine' in event['stack']
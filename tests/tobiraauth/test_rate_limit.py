@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+
+import httpx
+import pytest
+from pytest_httpx import HTTPXMock
+from sanic import Sanic
+
+from tobiraauth.login_callback import login_callback_bp
+from tobiraauth.metrics import get_metrics, snapshot
+from tobiraauth.rate_limit import ConcurrencyLimiter, TokenBucketLimiter, get_concurrency_limiter
+
+LOGIN_URL = 'http://localhost:4567/user/login/jane'
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(login_callback_bp)
+    sanic_app.config.USER_LOGIN_WS_URL = 'http://localhost:4567/user/login/{username}'
+    return sanic_app
+
+
+def test_token_bucket_limiter():
+    limiter = TokenBucketLimiter('test', rate=0.5, burst=2, maxsize=2)
+    assert limiter.acquire('jane', now=0) == 0
+    assert limiter.acquire('jane', now=0) == 0
+    assert limiter.acquire('jane', now=0) == 2.0
+    # Rejected calls take no tokens, one token is refilled after 2 seconds.
+    assert limiter.acquire('jane', now=1) == 1.0
+    assert limiter.acquire('jane', now=2) == 0
+    assert limiter.acquire('bob', now=2) == 0
+    assert limiter.rejected == 2
+    # The least recently used bucket is dropped.
+    limiter.acquire('alice', now=2)
+    assert len(limiter) == 2
+    assert limiter.acquire('jane', now=2) == 0
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter('test', limit=1)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+    assert limiter.rejected == 1
+
+
+@pytest.mark.asyncio
+async def test_login_callback_user_rate_limit(app, httpx_mock: HTTPXMock):
+    app.config.LOGIN_USER_RATE_LIMIT = 1
+    app.config.LOGIN_USER_RATE_BURST = 2
+    app.config.LOGIN_SHED_STATUS = 429
+    httpx_mock.add_response(method='POST', url=LOGIN_URL, status_code=401)
+    httpx_mock.add_response(method='POST', url=LOGIN_URL, status_code=401)
+    for status in (200, 200, 429):
+        request, response = await app.asgi_client.post('/login', json={'userid': 'jane', 'password': 'guess'})
+        assert response.status == status
+        assert response.json.get('outcome') == 'no-user'
+    assert int(response.headers['retry-after']) > 0
+    assert len(httpx_mock.get_requests()) == 2
+    assert get_metrics(app).counters[('tobira_auth_login_shed_total', (('limit', 'user'),))] == 1
+
+
+@pytest.mark.asyncio
+async def test_login_callback_cached_credentials_not_limited(app, httpx_mock: HTTPXMock):
+    app.config.LOGIN_USER_RATE_LIMIT = 1
+    app.config.LOGIN_USER_RATE_BURST = 1
+    httpx_mock.add_response(method='POST', url=LOGIN_URL, json={
+        'username': 'jane', 'given_name': 'Jane', 'sur_name': 'Doe', 'email': 'jane@edu.org',
+    })
+    for _ in range(3):
+        request, response = await app.asgi_client.post('/login', json={'userid': 'jane', 'password': 'secret'})
+        assert response.json.get('outcome') == 'user'
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_login_callback_max_in_flight(app):
+    app.config.LOGIN_MAX_IN_FLIGHT = 1
+    # Another login verification is in flight.
+    assert get_concurrency_limiter(app).acquire()
+    request, response = await app.asgi_client.post('/login', json={'userid': 'jane', 'password': 'secret'})
+    assert response.status == 200
+    assert response.json.get('outcome') == 'no-user'
+    counters = {(name, tuple(map(tuple, labels))): value for name, labels, value in snapshot(app)['counters']}
+    assert counters[('tobira_auth_login_shed_total', (('limit', 'in_flight'),))] == 1
+    assert counters[('tobira_auth_login_in_flight', ())] == 1
+    assert counters[('tobira_auth_login_max_in_flight', ())] == 1
+
+
+@pytest.mark.asyncio
+async def test_login_callback_concurrent_identical_logins_not_limited(app, httpx_mock: HTTPXMock):
+    app.config.LOGIN_USER_RATE_LIMIT = 1
+    app.config.LOGIN_USER_RATE_BURST = 1
+    app.config.LOGIN_MAX_IN_FLIGHT = 1
+    app.config.LOGIN_SHED_STATUS = 429
+
+    async def slow_login(request: httpx.Request):
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, json={
+            'username': 'jane', 'given_name': 'Jane', 'sur_name': 'Doe', 'email': 'jane@edu.org',
+        })
+
+    httpx_mock.add_callback(slow_login, method='POST', url=LOGIN_URL)
+    # Concurrent logins with the same credentials share one verification, which takes one token and slot.
+    responses = await asyncio.gather(*(
+        app.asgi_client.post('/login', json={'userid': 'jane', 'password': 'secret'}) for _ in range(5)
+    ))
+    for request, response in responses:
+        assert response.status == 200
+        assert response.json.get('outcome') == 'user'
+    assert len(httpx_mock.get_requests()) == 1
+    assert ('tobira_auth_login_shed_total', (('limit', 'user'),)) not in get_metrics(app).counters
+    assert get_concurrency_limiter(app).in_flight == 0
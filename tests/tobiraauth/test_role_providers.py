@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth.common import RoleProvider, UserAttributes
+from tobiraauth.config import ConfigConstants
+
+
+CALLS = []
+
+
+class GroupRoleProvider(RoleProvider):
+    name = 'groups'
+
+    async def load_roles(self, request, user: UserAttributes):
+        CALLS.append(('groups', time.perf_counter()))
+        await asyncio.sleep(0.1)
+        return [f'ROLE_GROUP_{user.username.upper()}']
+
+
+class OrganizationRoleProvider(RoleProvider):
+    name = 'organizations'
+
+    def cache_key(self, user: UserAttributes) -> str:
+        return f'{user.username}\x1f{user.home_organization}'
+
+    async def load_roles(self, request, user: UserAttributes):
+        CALLS.append(('organizations', time.perf_counter()))
+        await asyncio.sleep(0.1)
+        return [f'ROLE_ORG_{user.home_organization}']
+
+
+class SlowRoleProvider(RoleProvider):
+    name = 'slow'
+    timeout = 0.05
+
+    async def load_roles(self, request, user: UserAttributes):
+        await asyncio.sleep(1)
+        return ['ROLE_SLOW']
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(auth_callback_bp)
+    sanic_app.config.ROLE_PROVIDERS = (f'rules,{__name__}:GroupRoleProvider,{__name__}:OrganizationRoleProvider,'
+                                       f'{__name__}:SlowRoleProvider')
+    return sanic_app
+
+
+@pytest.mark.asyncio
+async def test_role_providers_run_concurrently(app):
+    CALLS.clear()
+    headers = {
+        ConfigConstants.USERNAME_HEADER: 'jane',
+        ConfigConstants.AFFILIATION_HEADER: 'staff',
+        ConfigConstants.HOME_ORGANIZATION_HEADER: 'edu.org',
+    }
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    # The second provider started before the first one finished.
+    assert [provider for provider, _ in CALLS] == ['groups', 'organizations']
+    assert CALLS[1][1] - CALLS[0][1] < 0.05
+    roles = response.json.get('roles')
+    assert 'ROLE_TOBIRA_UPLOAD' in roles
+    assert 'ROLE_GROUP_JANE' in roles
+    assert 'ROLE_ORG_edu.org' in roles
+    assert 'ROLE_SLOW' not in roles
+    assert len(roles) == len(set(roles))
+    assert app.ctx.metrics.counters[('tobira_auth_role_provider_failures_total',
+                                     (('provider', 'slow'), ('reason', 'timeout')))] == 1
+
+    # The roles of the providers are cached.
+    request, response = await app.asgi_client.get('/auth', headers=headers)
+    assert 'ROLE_GROUP_JANE' in response.json.get('roles')
+    assert len(CALLS) == 2
+
+
+@pytest.mark.asyncio
+async def test_role_provider_cache_config(app):
+    app.config.ROLE_PROVIDER_GROUPS_TIME_TO_LIVE = 60
+    app.config.ROLE_PROVIDER_ORGANIZATIONS_TIME_TO_LIVE = 60
+    app.config.CACHE_ROLE_PROVIDER_ORGANIZATIONS_TIME_TO_LIVE = 10
+    app.config.CACHE_ROLE_PROVIDER_ORGANIZATIONS_MAXSIZE = 5
+    user = UserAttributes('jane', None, (), 'edu.org')
+    request = SimpleNamespace(app=app, ctx=SimpleNamespace())
+    for provider in (GroupRoleProvider(app), OrganizationRoleProvider(app)):
+        await provider.get_roles(request, user)
+    groups = app.ctx.caches['role_provider_groups']
+    assert groups.time_to_live == 60
+    assert groups.get_nowait('jane').fresh_until > time.time() + 50
+    # The cache settings take precedence over the time to live of the provider.
+    organizations = app.ctx.caches['role_provider_organizations']
+    assert (organizations.maxsize, organizations.time_to_live) == (5, 10)
+    assert organizations.get_nowait('jane\x1fedu.org').fresh_until <= time.time() + 10
+    assert request.ctx.fresh_until <= time.time() + 10
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from sanic import Sanic
+
+from tobiraauth.rules import RoleRules, compile_role_rules, parse_rules
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    return sanic_app
+
+
+def test_default_rules(app):
+    rules = compile_role_rules(app)
+    assert rules.get_roles(['member;staff', 'staff@edu.org']) == [
+        'ROLE_TOBIRA_UPLOAD', 'ROLE_TOBIRA_STUDIO', 'ROLE_TOBIRA_EDITOR']
+    assert rules.get_roles(['member;student']) == []
+    assert not rules.is_admin('jane', 'jane@edu.org')
+
+
+def test_parse_rules():
+    rules = parse_rules('affiliation:staff=ROLE_A, ROLE_B; email_domain:edu.org=ROLE_C;invalid')
+    assert rules == {
+        'affiliation': {'staff': ['ROLE_A', 'ROLE_B']},
+        'email_domain': {'edu.org': ['ROLE_C']},
+    }
+
+
+def test_configured_rules(app, tmp_path):
+    rules_file = tmp_path / 'rules.json'
+    rules_file.write_text(json.dumps({
+        'affiliation': {'Faculty': ['ROLE_FACULTY']},
+        'home_organization': {'edu.org': ['ROLE_EDU']},
+    }))
+    app.config['ROLE_RULES_FILE'] = str(rules_file)
+    app.config['ROLE_RULES'] = 'email_domain:Edu.org=ROLE_EDU,ROLE_MAIL;affiliation:faculty=ROLE_TEACHER'
+    app.config['ADMIN_USERS_USERNAME'] = 'admin, root'
+    app.config['ADMIN_USERS_MAIL'] = 'admin@edu.org'
+    rules = compile_role_rules(app)
+    assert rules.get_roles(['faculty@edu.org;staff'], 'jane@EDU.org', 'edu.org') == [
+        'ROLE_FACULTY', 'ROLE_TEACHER', 'ROLE_EDU', 'ROLE_MAIL']
+    assert rules.get_roles([], None, None) == []
+    assert rules.is_admin('root')
+    assert rules.is_admin('jane', 'admin@edu.org')
+    assert not rules.is_admin('jane', None)
+
+
+def test_role_rules_deduplicate_roles():
+    rules = RoleRules({'affiliation': {'staff': ['ROLE_A', 'ROLE_A', 'ROLE_B']}})
+    assert rules.get_roles(['staff;staff']) == ['ROLE_A', 'ROLE_B']
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import pytest
+from sanic.response import text
+
+from tobiraauth.server import create_app
+
+SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+# Budgets in seconds, generous enough for slow CI machines.
+IMPORT_TIME_BUDGET = 3.0
+WORKER_READY_TIME_BUDGET = 15.0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, env: dict) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        'PYTHONPATH': SRC_PATH,
+        'TOBIRA_AUTH_STARTUP_PROFILE': 'production',
+        'TOBIRA_AUTH_ENABLE_AUTH_CALLBACK': 'true',
+        **env,
+    }
+    return subprocess.Popen([sys.executable, '-m', 'sanic', 'tobiraauth.server:create_app', '--factory',
+                             '--host', '127.0.0.1', '--port', str(port), '--workers', '1', '--no-motd'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def stop_server(process: subprocess.Popen):
+    # Stop the main process and the worker processes.
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def test_create_app_production_profile(monkeypatch):
+    monkeypatch.setenv('TOBIRA_AUTH_PRODUCTION_STARTUP_PROFILE', 'production')
+    monkeypatch.setenv('TOBIRA_AUTH_PRODUCTION_ENABLE_AUTH_CALLBACK', 'true')
+    app = create_app('tobira-auth-production')
+    assert 'auth_callback' in app.blueprints
+    assert 'login_callback' not in app.blueprints
+    assert getattr(app, '_ext', None) is None
+    assert app.ctx.request_profile is not None
+    assert app.ctx.role_providers
+
+
+@pytest.mark.asyncio
+async def test_create_app_default_profile_listeners(monkeypatch, tmp_path):
+    monkeypatch.setenv('TOBIRA_AUTH_DEFAULT_ENABLE_AUTH_CALLBACK', 'true')
+    export_path = tmp_path / 'courses.csv'
+    export_path.write_text('jane,1\n')
+    monkeypatch.setenv('TOBIRA_AUTH_DEFAULT_COURSE_INDEX_EXPORT_PATH', str(export_path))
+    monkeypatch.setenv('TOBIRA_AUTH_DEFAULT_REFRESH_AHEAD', 'true')
+    app = create_app('tobira-auth-default')
+    state = {}
+
+    @app.get('/state')
+    async def server_state(request):
+        state.update(vars(request.app.ctx))
+        state['tasks'] = [task.get_name() for task in request.app.tasks]
+        return text('')
+
+    # The blueprints are added on server start, their listeners would not run.
+    request, response = await app.asgi_client.get('/state')
+    assert response.status == 200
+    assert 'auth_callback' in app.blueprints
+    assert state['http_client'] is not None
+    assert state['request_profile'] is not None
+    assert state['role_providers']
+    assert 'tobira_auth_reload_course_index' in state['tasks']
+    assert state['refresh_ahead_running']
+    assert 'tobira_auth_refresh_ahead' in state['tasks']
+    # The http client is closed on server stop.
+    assert state['http_client'].is_closed
+
+
+def test_import_time():
+    code = ('import time; start = time.perf_counter(); '
+            'import tobiraauth.server, tobiraauth.auth_callback, tobiraauth.login_callback; '
+            'print(time.perf_counter() - start)')
+    output = subprocess.check_output([sys.executable, '-c', code], env={**os.environ, 'PYTHONPATH': SRC_PATH})
+    import_time = float(output.decode().strip().splitlines()[-1])
+    assert import_time < IMPORT_TIME_BUDGET
+
+
+def test_worker_ready_time():
+    port = free_port()
+    start = time.perf_counter()
+    process = start_server(port, {})
+    try:
+        ready_time = None
+        while time.perf_counter() - start < WORKER_READY_TIME_BUDGET:
+            try:
+                if httpx.get(f'http://127.0.0.1:{port}/auth/', timeout=1.0).status_code == 200:
+                    ready_time = time.perf_counter() - start
+                    break
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None:
+                pytest.fail('The server process exited during startup.')
+            time.sleep(0.05)
+        assert ready_time is not None, f'The worker was not ready within {WORKER_READY_TIME_BUDGET} seconds.'
+    finally:
+        stop_server(process)
+
+
+def test_unix_socket():
+    # pytest's tmp_path may exceed the maximum length of socket paths.
+    socket_dir = tempfile.TemporaryDirectory()
+    path = os.path.join(socket_dir.name, 'tobira-auth.sock')
+    process = start_server(free_port(), {'TOBIRA_AUTH_UNIX_SOCKET': path, 'TOBIRA_AUTH_BACKLOG': '64'})
+    try:
+        response = None
+        deadline = time.perf_counter() + WORKER_READY_TIME_BUDGET
+        with httpx.Client(transport=httpx.HTTPTransport(uds=path), base_url='http://localhost') as client:
+            while response is None and time.perf_counter() < deadline:
+                try:
+                    response = client.get('/auth/', timeout=1.0)
+                except httpx.TransportError:
+                    if process.poll() is not None:
+                        pytest.fail('The server process exited during startup.')
+                    time.sleep(0.05)
+        assert response is not None, f'The worker was not ready within {WORKER_READY_TIME_BUDGET} seconds.'
+        assert response.json().get('outcome') == 'no-user'
+    finally:
+        stop_server(process)
+        socket_dir.cleanup()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import httpx
+import pytest
+from pytest_httpx import HTTPXMock
+from sanic import Sanic
+
+from tobiraauth.auth_callback import auth_callback_bp
+from tobiraauth.config import ConfigConstants
+from tobiraauth.upstream import CircuitBreaker, CircuitOpenError, get_circuit_breaker, upstream_request
+
+COURSES_URL = 'http://localhost:4567/user/jane/courses'
+
+
+@pytest.fixture
+def app():
+    sanic_app = Sanic('test')
+    sanic_app.blueprint(auth_callback_bp)
+    sanic_app.config.USER_COURSES_WS_URL = 'http://localhost:4567/user/{username}/courses'
+    sanic_app.config.UPSTREAM_RETRY_BACKOFF = 0
+    return sanic_app
+
+
+def test_circuit_breaker_states():
+    circuit_breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0)
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    # The reset timeout passed, one trial call is allowed.
+    assert circuit_breaker.allow()
+    assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    assert not circuit_breaker.allow()
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    assert circuit_breaker.allow()
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    assert circuit_breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_upstream_request_retries_get(app, httpx_mock: HTTPXMock):
+    httpx_mock.add_exception(httpx.ConnectTimeout('timeout'), method='GET', url=COURSES_URL)
+    httpx_mock.add_response(method='GET', url=COURSES_URL, status_code=503)
+    httpx_mock.add_response(method='GET', url=COURSES_URL, json=[1])
+    response = await upstream_request(app, 'courses', 'GET', COURSES_URL)
+    assert response.json() == [1]
+    assert len(httpx_mock.get_requests()) == 3
+    assert get_circuit_breaker(app, 'courses').failures == 0
+
+
+@pytest.mark.asyncio
+async def test_upstream_request_does_not_retry_post(app, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method='POST', url='http://localhost:4567/user/login/jane', status_code=503)
+    response = await upstream_request(app, 'login', 'POST', 'http://localhost:4567/user/login/jane')
+    assert response.status_code == 503
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_upstream_request_circuit_breaker(app, httpx_mock: HTTPXMock):
+    app.config.UPSTREAM_RETRIES = 0
+    app.config.CIRCUIT_BREAKER_FAILURE_THRESHOLD = 2
+    httpx_mock.add_response(method='GET', url=COURSES_URL, status_code=500)
+    for _ in range(2):
+        await upstream_request(app, 'courses', 'GET', COURSES_URL)
+    with pytest.raises(CircuitOpenError):
+        await upstream_request(app, 'courses', 'GET', COURSES_URL)
+    assert len(httpx_mock.get_requests()) == 2
+
+
+@pytest.mark.asyncio
+async def test_auth_callback_circuit_breaker_open(app, httpx_mock: HTTPXMock):
+    circuit_breaker = get_circuit_breaker(app, 'courses')
+    circuit_breaker.state = CircuitBreaker.OPEN
+    circuit_breaker.opened_at = float('inf')
+    request, response = await app.asgi_client.get('/auth', headers={ConfigConstants.USERNAME_HEADER: 'jane'})
+    assert response.status == 200
+    roles = response.json.get('roles')
+    assert 'ROLE_USER_JANE' in roles
+    assert not any(role.startswith('ROLE_COURSE_') for role in roles)
+    assert httpx_mock.get_requests() == []